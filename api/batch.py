@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import time
+
+import tracing
+from cache import normalize_question
+
+log = tracing.get_logger("batch")
+
+BATCH_CONFIG = {
+    "max_questions": int(os.getenv("BATCH_MAX_QUESTIONS", "200")),
+    "concurrency": int(os.getenv("BATCH_CONCURRENCY", "8")),       # workers לכל batch (עד חיבור DB אחד לכל worker)
+    "max_concurrency": int(os.getenv("BATCH_MAX_CONCURRENCY", "32")),
+}
+
+
+def dedupe(questions):
+    """[(question, [indices])] - שאלות זהות (אחרי נרמול) רצות פעם אחת, לפי סדר ההופעה הראשונה"""
+    unique = {}
+    for index, question in enumerate(questions):
+        unique.setdefault(normalize_question(question), (question, []))[1].append(index)
+    return list(unique.values())
+
+
+def concurrency_for(requested, unique):
+    requested = requested or BATCH_CONFIG["concurrency"]
+    return max(1, min(requested, BATCH_CONFIG["max_concurrency"], unique))
+
+
+async def run_batch(questions, answer, concurrency):
+    """async generator: (question, indices, result, error, ms) לכל שאלה ייחודית, לפי סדר הסיום.
+    ה-request scope נפתח בתוך answer (כמו ב-/ask): ההרצה יכולה להמשיך ב-task משותף של ה-single-flight
+    אחרי שה-worker בוטל, והחיבור שלה לא יכול להיות של ה-worker"""
+    unique = dedupe(questions)
+    pending = asyncio.Queue()
+    for item in unique:
+        pending.put_nowait(item)
+    done = asyncio.Queue()
+
+    async def worker():
+        while True:
+            try:
+                question, indices = pending.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            start = time.perf_counter()
+            try:
+                result, error = await answer(question), None
+            except Exception as e:
+                log.error("batch question failed: %s", e)
+                result, error = None, e
+            await done.put((question, indices, result, error, round((time.perf_counter() - start) * 1000, 3)))
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency_for(concurrency, len(unique)))]
+    try:
+        for _ in unique:
+            yield await done.get()
+    finally:
+        # הלקוח התנתק באמצע - לא ממשיכים להריץ את השאר
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+async def ndjson(questions, answer, payload, concurrency=None):
+    """שורת NDJSON לכל שאלה מהבקשה (כולל כפילויות) ברגע שהיא מסתיימת, ושורת סיכום בסוף"""
+    start = time.perf_counter()
+    unique = errors = 0
+    async for question, indices, result, error, ms in run_batch(questions, answer, concurrency):
+        unique += 1
+        errors += error is not None
+        body = {"error": str(error)} if error is not None else payload(result)
+        for n, index in enumerate(indices):
+            line = {"index": index, "question": questions[index], "ms": ms, **body}
+            if n:
+                line["deduplicated"] = True
+            yield json.dumps(line, default=str, ensure_ascii=False) + "\n"
+    yield json.dumps({"done": True, "questions": len(questions), "unique": unique, "errors": errors,
+                      "ms": round((time.perf_counter() - start) * 1000, 3)}) + "\n"
@@ -0,0 +1,72 @@
+"""בנצ'מרק throughput של /ask: גרף סינכרוני ב-threadpool מול גרף async, על LLM ו-DB מדומים
+
+    python bench/async_throughput.py --requests 200 --concurrency 10 50 200
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import stubs
+
+
+def run_sync(graph, questions, concurrency, threads):
+    # uvicorn מריץ endpoint סינכרוני ב-threadpool של anyio (40 threads כברירת מחדל)
+    workers = min(concurrency, threads)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda q: graph.invoke({"query": q}), questions))
+    return time.perf_counter() - start
+
+
+async def run_async(graph, questions, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(q):
+        async with sem:
+            await graph.ainvoke({"query": q})
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(q) for q in questions))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--threads", type=int, default=40, help="גודל ה-threadpool של ה-worker")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--db-latency", type=float, default=0.01)
+    parser.add_argument("--json", action="store_true", help="פלט JSON")
+    args = parser.parse_args()
+
+    graph_module = stubs.install(args.llm_latency, args.db_latency)
+    sync_graph = graph_module.build_graph()
+    async_graph = graph_module.build_graph(use_async=True)
+    questions = [f"show customers #{i}" for i in range(args.requests)]
+
+    results = []
+    for concurrency in args.concurrency:
+        sync_time = run_sync(sync_graph, questions, concurrency, args.threads)
+        async_time = asyncio.run(run_async(async_graph, questions, concurrency))
+        results.append({
+            "concurrency": concurrency,
+            "sync_rps": round(args.requests / sync_time, 1),
+            "async_rps": round(args.requests / async_time, 1),
+            "speedup": round(sync_time / async_time, 2),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.requests} requests, LLM {args.llm_latency * 1000:.0f}ms, DB {args.db_latency * 1000:.0f}ms, "
+          f"{args.threads} sync threads")
+    print(f"{'concurrency':>12} {'sync req/s':>12} {'async req/s':>12} {'speedup':>8}")
+    for r in results:
+        print(f"{r['concurrency']:>12} {r['sync_rps']:>12} {r['async_rps']:>12} {r['speedup']:>7}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""בנצ'מרק /ask/batch מול N קריאות /ask סדרתיות (כמו job של דוחות היום), על LLM ו-DB מדומים
+
+    python bench/batch.py --questions 50 --unique 40 --concurrency 1 4 8 16
+
+הקריאות עוברות דרך ה-app עצמו (TestClient) - כולל ה-endpoint, ה-single-flight והגרף האסינכרוני.
+"""
+import argparse
+import json
+import time
+
+import stubs
+
+
+def run_sequential(client, questions):
+    start = time.perf_counter()
+    for q in questions:
+        response = client.post("/ask", json={"question": q})
+        response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def run_batch(client, questions, concurrency):
+    start = time.perf_counter()
+    response = client.post("/ask/batch", json={"questions": questions, "concurrency": concurrency})
+    response.raise_for_status()
+    lines = [json.loads(line) for line in response.text.splitlines() if line]
+    elapsed = time.perf_counter() - start
+    summary = lines[-1]
+    assert summary.get("done") and len(lines) - 1 == len(questions), summary
+    return elapsed, summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--unique", type=int, default=None, help="שאלות שונות (השאר כפילויות); ברירת מחדל: כולן")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--db-latency", type=float, default=0.01)
+    parser.add_argument("--json", action="store_true", help="פלט JSON")
+    args = parser.parse_args()
+
+    stubs.install(args.llm_latency, args.db_latency, dedup=True)
+    import tracing
+    tracing.setup_logging().setLevel("WARNING")
+    from fastapi.testclient import TestClient
+    import main as app_module
+    from result_cache import result_cache
+    from singleflight import singleflight
+
+    client = TestClient(app_module.app)
+    unique = args.unique or args.questions
+    questions = [f"show customers #{i % unique}" for i in range(args.questions)]
+
+    def fresh():
+        # כל הרצה מתחילה בלי תוצאות מהרצה קודמת
+        result_cache.clear()
+        singleflight._recent.clear()
+
+    fresh()
+    sequential = run_sequential(client, questions)
+    results = []
+    for concurrency in args.concurrency:
+        fresh()
+        elapsed, summary = run_batch(client, questions, concurrency)
+        results.append({
+            "concurrency": concurrency,
+            "unique": summary["unique"],
+            "batch_qps": round(args.questions / elapsed, 1),
+            "sequential_qps": round(args.questions / sequential, 1),
+            "speedup": round(sequential / elapsed, 2),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.questions} questions ({unique} unique), LLM {args.llm_latency * 1000:.0f}ms, "
+          f"DB {args.db_latency * 1000:.0f}ms; sequential /ask: {args.questions / sequential:.1f} q/s")
+    print(f"{'concurrency':>12} {'batch q/s':>10} {'speedup':>8}")
+    for r in results:
+        print(f"{r['concurrency']:>12} {r['batch_qps']:>10} {r['speedup']:>7}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""הערכה offline של המסווג המקומי (intent.py) מול קובץ שאלות מתויג
+
+    python bench/eval_intent.py [--labels docs/intent_eval.csv] [--threshold 0.75] [--llm]
+
+מדווח accuracy, אחוז הבקשות שדילגו על ה-LLM (fast path) ו-latency של הסיווג.
+בלי --llm, שאלות עמומות מוערכות לפי הניחוש של המסווג; עם --llm הן נשלחות ל-gpt-4o-mini.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from intent import FAST_PATH_THRESHOLD, classify_intent  # noqa: E402
+
+DEFAULT_LABELS = next(
+    (p for p in ("docs/intent_eval.csv", os.path.normpath(os.path.join(ROOT, "..", "docs", "intent_eval.csv"))) if os.path.exists(p)),
+    "docs/intent_eval.csv",
+)
+
+
+def llm_intent(question):
+    import graph
+
+    state = {"query": question}
+    response = graph.client.chat.completions.create(**graph.intent_request(question))
+    graph.apply_intent(state, response)
+    return state["intent"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--labels", default=DEFAULT_LABELS)
+    parser.add_argument("--threshold", type=float, default=FAST_PATH_THRESHOLD)
+    parser.add_argument("--llm", action="store_true", help="לשלוח שאלות עמומות ל-LLM")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--verbose", "-v", action="store_true", help="להדפיס כל שאלה שלא עברה fast path או טעתה")
+    args = parser.parse_args()
+
+    with open(args.labels, newline="", encoding="utf-8") as f:
+        rows = [r for r in csv.DictReader(f) if r.get("question")]
+
+    fast = fast_correct = correct = 0
+    timings = []
+    misses = []
+    for row in rows:
+        question, label = row["question"], row["intent"].strip()
+        start = time.perf_counter()
+        intent, confidence = classify_intent(question)
+        timings.append(time.perf_counter() - start)
+
+        if confidence >= args.threshold:
+            fast += 1
+            fast_correct += intent == label
+            predicted = intent
+        else:
+            predicted = llm_intent(question) if args.llm else intent
+        correct += predicted == label
+        if predicted != label or confidence < args.threshold:
+            misses.append({"question": question, "label": label, "predicted": intent,
+                           "confidence": confidence, "fast_path": confidence >= args.threshold})
+
+    total = len(rows)
+    timings.sort()
+    report = {
+        "labels": args.labels,
+        "questions": total,
+        "threshold": args.threshold,
+        "accuracy": round(correct / total, 3) if total else 0.0,
+        "fast_path_rate": round(fast / total, 3) if total else 0.0,
+        "fast_path_accuracy": round(fast_correct / fast, 3) if fast else 0.0,
+        "ambiguous_resolved_by": "llm" if args.llm else "local_guess",
+        "classify_us_p50": round(timings[len(timings) // 2] * 1e6, 1) if timings else 0.0,
+        "classify_us_max": round(timings[-1] * 1e6, 1) if timings else 0.0,
+    }
+
+    if args.json:
+        print(json.dumps({**report, "misses": misses}, ensure_ascii=False, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:>22}: {value}")
+    if args.verbose:
+        for m in misses:
+            flag = "fast" if m["fast_path"] else "llm "
+            print(f"  [{flag}] {m['label']:>3} <- {m['predicted']:>3} ({m['confidence']:.2f})  {m['question']}")
+
+
+if __name__ == "__main__":
+    main()
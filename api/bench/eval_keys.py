@@ -0,0 +1,61 @@
+"""בדיקת רגרסיה למפתחות השאלה (normalize_question) ולקיצור few-shot - בלי DB ובלי LLM
+
+    python bench/eval_keys.py
+
+זוגות שחייבים לקבל אותו מפתח (ניסוח/פיסוק שונה) וזוגות שחייבים להיפרד (משמעות שונה).
+המפתח משותף ל-sql_cache, single-flight, dedupe של batch ו-few-shot, אז התנגשות כאן מחזירה SQL של שאלה אחרת.
+זוגות EXAMPLE_MISS אסור שיעברו את סף ה-exact של few-shot (ה-SQL של הדוגמה נלקח בלי LLM).
+יוצא עם קוד 1 אם זוג כלשהו נכשל.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cache import normalize_question  # noqa: E402
+from fewshot import FEWSHOT_CONFIG, SEED_EXAMPLES, similarity  # noqa: E402
+
+SAME = [
+    ("Show customers?", "show customers"),
+    ("orders with total>100", "orders with total > 100"),
+    ('כמה הזמנות יש לצה"ל?', "כמה הזמנות יש לצהל"),
+    ("price of 1.5, please", "price of 1.5 please"),
+]
+
+DIFFERENT = [
+    ("orders with total > 100", "orders with total < 100"),
+    ("orders with total >= 100", "orders with total > 100"),
+    ("customers where country = Israel", "customers where country != Israel"),
+    ("growth of -5%", "growth of 5%"),
+    ("growth of 5%", "growth of 5"),
+]
+
+# (שאלה, דוגמה) - משמעות הפוכה, למרות שרוב התווים משותפים
+EXAMPLE_MISS = [
+    ("תן לי את כל הלקוחות מישראל", SEED_EXAMPLES[2]["question"]),
+    ("orders with total > 100", "orders with total < 100"),
+    ("customers without orders", "customers with orders"),
+]
+
+
+def main():
+    failures = []
+    for a, b in SAME:
+        if normalize_question(a) != normalize_question(b):
+            failures.append(("same", a, b))
+    for a, b in DIFFERENT:
+        if normalize_question(a) == normalize_question(b):
+            failures.append(("different", a, b))
+    threshold = FEWSHOT_CONFIG["exact_similarity"]
+    for a, b in EXAMPLE_MISS:
+        if similarity(a, b) >= threshold:
+            failures.append(("example", a, b))
+    for kind, a, b in failures:
+        print(f"  [{kind:>9}] {a!r} / {b!r} -> {normalize_question(a)!r} / {normalize_question(b)!r}")
+    print(f"pairs: {len(SAME) + len(DIFFERENT) + len(EXAMPLE_MISS)}, failures: {len(failures)}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+"""בנצ'מרק + accuracy על זוגות שאלה/SQL מ-docs/gold.md, דרך כל הגרף (build_graph)
+
+    python bench/gold.py [--gold docs/gold.md] [--repeat 5] [--concurrency 1 10 50]
+                         [--out bench.json] [--baseline baseline.json] [--tolerance 0.2]
+
+ה-LLM מדומה ודטרמיניסטי: לכל שאלה מהקובץ הוא מחזיר את ה-SQL של ה-gold (כך נמדד
+ה-pipeline עצמו - guardrails, הרצה, המרה - ולא המודל). --llm שולח ל-gpt-4o-mini אמיתי.
+השאילתות רצות על ה-Postgres שב-DATABASE_URL (db/init/003_random_mass.sql);
+--stub-db מריץ על DB מדומה (בלי accuracy).
+
+מדווח p50/p95/p99 לכל node ולכל הבקשה, throughput לכל רמת concurrency, שיא זיכרון
+(tracemalloc) ו-accuracy: תוצאת ההרצה מול תוצאת ה-SQL של ה-gold.
+עם --baseline: exit code 1 אם אחד המדדים הידרדר יותר מ-tolerance (ל-CI).
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+import stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import db  # noqa: E402
+import sqlcheck  # noqa: E402
+import tracing  # noqa: E402
+from encoding import columns_to_rows  # noqa: E402
+from executor import RowBudget, fetch_columnar  # noqa: E402
+from fewshot import parse_gold  # noqa: E402
+from guardrails import add_limit_to_sql  # noqa: E402
+
+DEFAULT_GOLD = next(
+    (p for p in ("docs/gold.md", os.path.normpath(os.path.join(ROOT, "..", "docs", "gold.md"))) if os.path.exists(p)),
+    "docs/gold.md",
+)
+
+_USER_QUERY = re.compile(r"שאילתת המשתמש: (.*)")
+
+
+def gold_answer(gold):
+    """LLM מדומה: ה-SQL של ה-gold לשאלה שבפרומפט"""
+    by_question = {g["question"]: g["sql"] for g in gold}
+
+    def answer(messages):
+        prompt = messages[-1]["content"]
+        if "Vega-Lite" in prompt:
+            return json.dumps(stubs.VIZ_SPEC)
+        m = _USER_QUERY.search(prompt)
+        sql = by_question.get(m.group(1).strip() if m else "", "SELECT 1;")
+        if "הכוונה:" in prompt:
+            return "sql"
+        if "החזר JSON בלבד" in prompt:
+            return json.dumps({"intent": "sql", "sql": sql, "action": "display"})
+        return sql
+
+    return answer
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "n": 0}
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+    return {"p50": round(rank(50), 3), "p95": round(rank(95), 3), "p99": round(rank(99), 3), "n": len(values)}
+
+
+# ---------- accuracy ----------
+
+def _normalize(value):
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def result_key(rows, ordered):
+    # השוואה לפי ערכים (שמות העמודות/aliases לא משנים); בלי ORDER BY - כ-multiset
+    tuples = [tuple(_normalize(v) for v in row.values()) for row in rows]
+    return tuples if ordered else sorted(tuples, key=repr)
+
+
+def gold_rows(sql):
+    """תוצאת ה-SQL של ה-gold, עם אותו LIMIT בטיחות שה-pipeline מוסיף (רק טעויות סמנטיות נספרות)"""
+    sql, _ = add_limit_to_sql(sql)
+    with db.checkout(readonly=True) as conn:
+        return columns_to_rows(fetch_columnar(conn, sql, RowBudget()))
+
+
+def is_ordered(sql):
+    try:
+        return sqlcheck.parse(sql).args.get("order") is not None
+    except ValueError:
+        return False
+
+
+# ---------- הרצות ----------
+
+async def run_one(graph, question):
+    with tracing.request_trace("bench") as trace:
+        async with db.arequest_scope():
+            state = await graph.ainvoke({"query": question})
+    return state, trace.summary()
+
+
+async def latency_pass(graph, gold, repeat, check_accuracy):
+    """הרצה סדרתית (בלי תחרות) - latency לכל node + accuracy בסיבוב הראשון"""
+    traces, results = [], []
+    for i in range(repeat):
+        for item in gold:
+            state, summary = await run_one(graph, item["question"])
+            traces.append(summary)
+            if i == 0:
+                results.append(check(item, state) if check_accuracy else {"question": item["question"]})
+    return traces, results
+
+
+def check(item, state):
+    result = {"question": item["question"], "sql": state.get("sql"), "blocked": state.get("guardrail_ok") is False}
+    try:
+        expected = gold_rows(item["sql"])
+    except Exception as e:
+        result.update(correct=False, error=f"gold SQL failed: {e}")
+        return result
+    ordered = is_ordered(item["sql"])
+    actual = state.get("rows") or []
+    result["correct"] = not result["blocked"] and result_key(actual, ordered) == result_key(expected, ordered)
+    result["rows"], result["expected_rows"] = len(actual), len(expected)
+    return result
+
+
+async def throughput_pass(graph, gold, concurrency, requests):
+    sem = asyncio.Semaphore(concurrency)
+    questions = [gold[i % len(gold)]["question"] for i in range(requests)]
+
+    async def one(q):
+        async with sem:
+            await run_one(graph, q)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(q) for q in questions))
+    return time.perf_counter() - start
+
+
+def stage_latency(traces):
+    stages = {}
+    for t in traces:
+        for name, ms in t["nodes_ms"].items():
+            stages.setdefault(name, []).append(ms)
+    return {
+        "total_ms": percentiles([t["total_ms"] for t in traces]),
+        "db_ms": percentiles([t["db_ms"] for t in traces]),
+        "nodes_ms": {name: percentiles(values) for name, values in stages.items()},
+    }
+
+
+# ---------- רגרסיות ----------
+
+def regressions(report, baseline, tolerance):
+    """[(מדד, baseline, נוכחי)] לכל מדד שהידרדר יותר מ-tolerance (יחסי)"""
+    found = []
+
+    def worse(name, base, current, higher_is_better):
+        if base is None or current is None or base == 0:
+            return
+        change = (base - current) / base if higher_is_better else (current - base) / base
+        if change > tolerance:
+            found.append({"metric": name, "baseline": base, "current": current, "change": round(change, 3)})
+
+    worse("accuracy", baseline.get("accuracy"), report["accuracy"], True)
+    worse("latency.total_ms.p95", baseline.get("latency", {}).get("total_ms", {}).get("p95"),
+          report["latency"]["total_ms"]["p95"], False)
+    worse("memory_peak_mb", baseline.get("memory_peak_mb"), report["memory_peak_mb"], False)
+    base_rps = {t["concurrency"]: t["rps"] for t in baseline.get("throughput", [])}
+    for t in report["throughput"]:
+        worse(f"throughput.c{t['concurrency']}.rps", base_rps.get(t["concurrency"]), t["rps"], True)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--gold", default=DEFAULT_GOLD)
+    parser.add_argument("--repeat", type=int, default=5, help="סיבובים סדרתיים למדידת latency")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--requests", type=int, default=200, help="בקשות לכל רמת concurrency")
+    parser.add_argument("--mode", default=None, help="two_step / combined (ברירת מחדל: NL2SQL_PIPELINE_MODE)")
+    parser.add_argument("--llm", action="store_true", help="LLM אמיתי במקום המדומה")
+    parser.add_argument("--llm-latency", type=float, default=0.0)
+    parser.add_argument("--stub-db", action="store_true", help="DB מדומה (בלי Postgres, בלי accuracy)")
+    parser.add_argument("--out", help="קובץ לפלט ה-JSON (ברירת מחדל: stdout)")
+    parser.add_argument("--baseline", help="דוח קודם להשוואה; הידרדרות -> exit code 1")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--min-accuracy", type=float, default=None)
+    args = parser.parse_args()
+
+    # שורת לוג לכל בקשה מאטה את המדידה
+    tracing.setup_logging().setLevel("WARNING")
+
+    with open(args.gold, encoding="utf-8") as f:
+        gold = parse_gold(f.read())
+    if not gold:
+        sys.exit(f"No gold pairs in {args.gold}")
+
+    if args.llm:
+        import graph as graph_module
+        from cache import NullCache, QuestionCache
+        graph_module.sql_cache = QuestionCache(NullCache())
+    else:
+        graph_module = stubs.install(args.llm_latency, 0, answer=gold_answer(gold), stub_db=args.stub_db)
+    # ה-gold הוא קבוצת הבדיקה - לא דוגמאות few-shot ולא קיצור בלי LLM
+    from fewshot import fewshot_index
+    fewshot_index.enabled = False
+    graph = graph_module.build_graph(use_async=True, mode=args.mode)
+
+    tracemalloc.start()
+    traces, results = asyncio.run(latency_pass(graph, gold, args.repeat, not args.stub_db))
+    throughput = []
+    for concurrency in args.concurrency:
+        elapsed = asyncio.run(throughput_pass(graph, gold, concurrency, args.requests))
+        throughput.append({"concurrency": concurrency, "rps": round(args.requests / elapsed, 1),
+                           "seconds": round(elapsed, 3)})
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    checked = [r for r in results if "correct" in r]
+    report = {
+        "gold": args.gold,
+        "pairs": len(gold),
+        "mode": args.mode or graph_module.PIPELINE_MODE,
+        "llm": "openai" if args.llm else "stub",
+        "db": "stub" if args.stub_db else "postgres",
+        "accuracy": round(sum(r["correct"] for r in checked) / len(checked), 3) if checked else None,
+        "latency": stage_latency(traces),
+        "throughput": throughput,
+        "memory_peak_mb": round(peak / 1024 / 1024, 2),
+        "results": results,
+    }
+
+    failed = []
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            failed = regressions(report, json.load(f), args.tolerance)
+    if args.min_accuracy is not None and (report["accuracy"] or 0) < args.min_accuracy:
+        failed.append({"metric": "accuracy", "baseline": args.min_accuracy, "current": report["accuracy"]})
+    report["regressions"] = failed
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""השרשרת הקריטית של בקשה: הגרף הסדרתי (two_step) מול הגרף המקבילי (parallel), על LLM ו-DB מדומים
+
+    python bench/parallel.py --llm-latency 0.3 --db-latency 0.1 --repeat 5
+
+לכל מצב ולכל סוג שאלה (טבלה / גרף שה-stylist מעצב): זמן הבקשה, סכום זמני ה-nodes, כמה מהם רצו
+במקביל, וה-nodes שעל השרשרת הקריטית (ציר הזמן מ-Trace.timeline_summary).
+"""
+import argparse
+import asyncio
+import json
+import statistics
+
+import stubs
+
+QUESTIONS = {
+    "sql": "list the customers",
+    "viz": "draw the customers",
+}
+
+
+def answer(messages):
+    # intent לפי השאלה (ה-fast path המקומי לא מכריע על השאלות האלה)
+    prompt = messages[-1]["content"]
+    if "הכוונה:" in prompt:
+        return "viz" if "draw" in prompt else "sql"
+    return stubs.default_answer(messages)
+
+
+async def run_one(graph, question):
+    import db
+    import tracing
+    with tracing.request_trace("bench") as trace:
+        async with db.arequest_scope():
+            await graph.ainvoke({"query": question})
+    return trace.timeline_summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--db-latency", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="פלט JSON")
+    args = parser.parse_args()
+
+    graph_module = stubs.install(args.llm_latency, args.db_latency, answer=answer)
+    import tracing
+    tracing.setup_logging().setLevel("WARNING")
+
+    results = []
+    for mode in ("two_step", "parallel"):
+        graph = graph_module.build_graph(use_async=True, mode=mode)
+        for kind, question in QUESTIONS.items():
+            timelines = [asyncio.run(run_one(graph, question)) for _ in range(args.repeat)]
+            results.append({
+                "mode": mode,
+                "question": kind,
+                "critical_path_ms": round(statistics.median(t["critical_path_ms"] for t in timelines), 1),
+                "serial_ms": round(statistics.median(t["serial_ms"] for t in timelines), 1),
+                "overlap_ms": round(statistics.median(t["overlap_ms"] for t in timelines), 1),
+                "critical_path": timelines[-1]["critical_path"],
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"LLM {args.llm_latency * 1000:.0f}ms, DB {args.db_latency * 1000:.0f}ms, median of {args.repeat}")
+    print(f"{'mode':>9} {'question':>8} {'critical ms':>12} {'serial ms':>10} {'overlap ms':>11}  critical path")
+    for r in results:
+        path = " > ".join(n for n in r["critical_path"] if n not in ("start_request", "sql_ready", "join_plan"))
+        print(f"{r['mode']:>9} {r['question']:>8} {r['critical_path_ms']:>12} {r['serial_ms']:>10} "
+              f"{r['overlap_ms']:>11}  {path}")
+
+
+if __name__ == "__main__":
+    main()
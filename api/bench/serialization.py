@@ -0,0 +1,87 @@
+"""בנצ'מרק סריאליזציה של תוצאת שאילתה: dict לכל שורה (הפורמט הישן) מול columnar JSON מול Arrow IPC
+
+    python bench/serialization.py --rows 10000
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import stubs  # noqa: F401  (sys.path ל-api/)
+import encoding
+from stubs import Column
+from utils import convert_to_json_serializable
+
+# עמודות בסגנון orders: int4, int4, date, numeric, text, timestamp
+DESCRIPTION = [
+    Column("order_id", 23),
+    Column("customer_id", 23),
+    Column("order_date", 1082),
+    Column("total_amount", 1700),
+    Column("status", 25),
+    Column("created_at", 1114),
+]
+
+
+def make_rows(n):
+    start = datetime(2024, 1, 1)
+    statuses = ["new", "paid", "shipped", "cancelled"]
+    return [
+        (i, i % 500, (start + timedelta(days=i % 365)).date(), Decimal(f"{i % 1000}.{i % 100:02d}"),
+         statuses[i % 4], start + timedelta(minutes=i))
+        for i in range(n)
+    ]
+
+
+def baseline(rows):
+    # הקוד הקודם של execute_sql: המרה לכל תא ו-dict לכל שורה
+    colnames = [desc[0] for desc in DESCRIPTION]
+    result = []
+    for row in rows:
+        result.append({col: convert_to_json_serializable(val) for col, val in zip(colnames, row)})
+    return json.dumps({"rows": result}, default=str).encode("utf-8")
+
+
+def columnar(rows):
+    result = encoding.to_columns(DESCRIPTION, rows)
+    return json.dumps({"columns": result["columns"], "data": result["data"]}).encode("utf-8")
+
+
+def arrow(rows):
+    return encoding.to_arrow_ipc(encoding.to_columns(DESCRIPTION, rows), {"sql": "SELECT ..."})
+
+
+def measure(fn, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = fn(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"ms": round(best * 1000, 2), "bytes": len(payload)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    results = {"rows": measure(baseline, rows, args.repeat), "columnar": measure(columnar, rows, args.repeat)}
+    if encoding.pa is not None:
+        results["arrow"] = measure(arrow, rows, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.rows} rows, best of {args.repeat}")
+    print(f"{'format':>10} {'ms':>10} {'bytes':>12}")
+    for name, r in results.items():
+        print(f"{name:>10} {r['ms']:>10} {r['bytes']:>12}")
+
+
+if __name__ == "__main__":
+    main()
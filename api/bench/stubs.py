@@ -0,0 +1,189 @@
+"""LLM ו-DB מדומים לבנצ'מרקים - בלי רשת ובלי Postgres, עם latency קבוע"""
+import asyncio
+import functools
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager, contextmanager
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "stub")
+
+Column = namedtuple("Column", "name type_code")
+
+EXPLAIN_PLAN = [{"Plan": {
+    "Node Type": "Limit", "Plan Rows": 10, "Plan Width": 40, "Total Cost": 1.5,
+    "Plans": [{"Node Type": "Seq Scan", "Relation Name": "customers", "Plan Rows": 1000, "Plan Width": 40}],
+}}]
+ROWS = [(i, f"Customer {i}", "US") for i in range(1, 11)]
+DESCRIPTION = [Column("id", 23), Column("name", 25), Column("country", 25)]
+
+VIZ_SPEC = {"mark": "bar", "encoding": {"x": {"field": "name", "type": "nominal"},
+                                        "y": {"field": "id", "type": "quantitative"}}}
+
+
+def default_answer(messages):
+    """תשובת LLM דטרמיניסטית לפי סוג הפרומפט"""
+    prompt = messages[-1]["content"]
+    if "Vega-Lite" in prompt:
+        return json.dumps(VIZ_SPEC)
+    if "הכוונה:" in prompt:
+        return "sql"
+    if "החזר JSON בלבד" in prompt:
+        return json.dumps({"intent": "sql", "sql": "SELECT id, name, country FROM customers LIMIT 10;",
+                           "action": "display"})
+    return "SELECT id, name, country FROM customers LIMIT 10;"
+
+
+def _response(text, messages):
+    prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(text) // 4),
+    )
+
+
+class StubLLM:
+    def __init__(self, latency, answer=default_answer):
+        self.latency = latency
+        self.answer = answer
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def with_options(self, timeout=None, **kwargs):
+        """כמו OpenAI.with_options: קריאה ארוכה מה-timeout נכשלת אחריו"""
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            create=functools.partial(self.create, timeout=timeout))))
+
+    def create(self, messages, timeout=None, **kwargs):
+        self.calls += 1
+        if timeout is not None and timeout < self.latency:
+            time.sleep(timeout)
+            raise TimeoutError("Request timed out.")
+        time.sleep(self.latency)
+        return _response(self.answer(messages), messages)
+
+
+class AsyncStubLLM(StubLLM):
+    async def create(self, messages, timeout=None, **kwargs):
+        self.calls += 1
+        if timeout is not None and timeout < self.latency:
+            await asyncio.sleep(timeout)
+            raise TimeoutError("Request timed out.")
+        await asyncio.sleep(self.latency)
+        return _response(self.answer(messages), messages)
+
+
+class StubCursor:
+    def __init__(self, latency):
+        self.latency = latency
+        self.description = None
+        self._result = []
+
+    def _run(self, sql):
+        if sql.lstrip().upper().startswith("EXPLAIN"):
+            self.description = [Column("QUERY PLAN", 114)]
+            self._result = [(EXPLAIN_PLAN,)]
+        else:
+            self.description = DESCRIPTION
+            self._result = list(ROWS)
+
+    def execute(self, sql, params=None):
+        time.sleep(self.latency)
+        self._run(sql)
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+    def fetchmany(self, size=None):
+        batch, self._result = self._result[:size], self._result[size:]
+        return batch
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class AsyncStubCursor(StubCursor):
+    async def execute(self, sql, params=None):
+        await asyncio.sleep(self.latency)
+        self._run(sql)
+
+    async def fetchone(self):
+        return StubCursor.fetchone(self)
+
+    async def fetchall(self):
+        return StubCursor.fetchall(self)
+
+    async def fetchmany(self, size=None):
+        return StubCursor.fetchmany(self, size)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class StubConnection:
+    closed = 0
+
+    def __init__(self, latency, cursor_cls=StubCursor):
+        self.latency = latency
+        self.cursor_cls = cursor_cls
+
+    def cursor(self, *args, **kwargs):
+        return self.cursor_cls(self.latency)
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+def install(llm_latency=0.3, db_latency=0.01, answer=default_answer, stub_db=True, dedup=False):
+    """מחליף את ה-LLM וה-DB של graph/db במדומים ומכבה את ה-caches (SQL חוזר היה נמדד כ-hit).
+    stub_db=False: רק ה-LLM מדומה, השאילתות רצות על ה-DB שב-DATABASE_URL.
+    dedup=True: ה-result cache וה-single-flight נשארים (bench/batch.py מודד אותם)"""
+    import db
+    import graph
+    from cache import NullCache, QuestionCache
+    from result_cache import result_cache
+    from singleflight import singleflight
+
+    graph.client = StubLLM(llm_latency, answer)
+    graph.aclient = AsyncStubLLM(llm_latency, answer)
+    graph.sql_cache = QuestionCache(NullCache())
+    if not dedup:
+        result_cache.memory = NullCache()
+        result_cache.disk = NullCache()
+        singleflight.enabled = False
+    if not stub_db:
+        return graph
+
+    @contextmanager
+    def checkout(scoped=True, readonly=False):
+        yield StubConnection(db_latency)
+
+    @asynccontextmanager
+    async def acheckout(scoped=True, readonly=False):
+        yield StubConnection(db_latency, AsyncStubCursor)
+
+    db.checkout = checkout
+    db.acheckout = acheckout
+    return graph
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# גרש/גרשיים ומרכאות נמחקים (צה"ל, don't); שאר הפיסוק הופך לרווח, חוץ ממה שמשנה את המשמעות:
+# נקודה/פסיק בין ספרות (1.5, 1,000), אופרטורי השוואה (> 100 / < 100), סימן לפני מספר (-5) ו-% אחרי מספר
+_QUOTES_RE = re.compile(r"""['"`\u05f3\u05f4\u2018\u2019\u201c\u201d]""")
+_OPERATOR_RE = re.compile(r"<=|>=|<>|!=|=|<|>")
+_PUNCT_RE = re.compile(r"(?<!\d)[.,]|[.,](?!\d)|!(?!=)|[-+](?!\d)|(?<!\d)%|[^\w\s.,!<>=+\-%]")
+
+
+def normalize_question(question):
+    """נרמול שאלה למפתח cache: אותיות קטנות, ללא ניקוד ופיסוק, רווחים מאוחדים"""
+    q = unicodedata.normalize("NFKC", question or "").lower()
+    q = "".join(ch for ch in q if unicodedata.category(ch) != "Mn")  # ניקוד וטעמים
+    q = _QUOTES_RE.sub("", q)
+    q = _PUNCT_RE.sub(" ", q).replace("_", " ")
+    q = _OPERATOR_RE.sub(lambda m: f" {m.group()} ", q)   # "total>100" == "total > 100"
+    return " ".join(q.split())
+
+
+def fingerprint(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()[:16]
+
+
+class NullCache:
+    """cache כבוי"""
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, size=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {"backend": "none"}
+
+
+class MemoryCache:
+    """LRU בזיכרון עם TTL; max_bytes - גם גבול על הגודל הכולל (לפי אורך ה-JSON של הערכים)"""
+
+    def __init__(self, max_entries=1000, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def _pop(self, key):
+        # תחת lock
+        _, _, size = self._data.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._stats["misses"] += 1
+                return None
+            value, expires_at, _ = item
+            if expires_at is not None and expires_at < time.monotonic():
+                self._pop(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set(self, key, value, size=None):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        if size is None:
+            size = len(json.dumps(value, default=str)) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                self._pop(next(iter(self._data)))
+                self._stats["evictions"] += 1
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "backend": "memory",
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                **({"bytes": self._bytes, "max_bytes": self.max_bytes} if self.max_bytes else {}),
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+            }
+
+
+class SQLiteCache:
+    """cache על דיסק (SQLite) עם LRU לפי זמן גישה ו-TTL; הערכים נשמרים כ-JSON"""
+
+    def __init__(self, path, max_entries=10_000, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed_at)")
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._stats["hits"] += 1
+        return json.loads(value)
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        payload = json.dumps(value, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, payload, expires_at, now),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                self._stats["evictions"] += count - self.max_entries
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+
+    def stats(self):
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                "backend": "sqlite",
+                "path": self.path,
+                "entries": count,
+                "max_entries": self.max_entries,
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+            }
+
+
+def make_cache(backend="memory", max_entries=1000, ttl=None, path=None):
+    if backend in (None, "", "none", "off"):
+        return NullCache()
+    if backend == "memory":
+        return MemoryCache(max_entries=max_entries, ttl=ttl)
+    if backend == "sqlite":
+        return SQLiteCache(path or "cache/cache.sqlite", max_entries=max_entries, ttl=ttl)
+    raise ValueError(f"Unknown cache backend: {backend}")
+
+
+class QuestionCache:
+    """cache של שאלה -> SQL, תקף רק לגרסת הסכמה שממנה נוצר"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._schema_fp = None
+        self._lock = threading.Lock()
+
+    def _key(self, question, schema):
+        fp = fingerprint(schema)
+        with self._lock:
+            if self._schema_fp is not None and fp != self._schema_fp:
+                # הסכמה השתנתה - כל מה שנוצר מהגרסה הקודמת לא רלוונטי
+                self.backend.clear()
+            self._schema_fp = fp
+        return fingerprint(fp + "\x00" + normalize_question(question))
+
+    def lookup(self, question, schema):
+        return self.backend.get(self._key(question, schema))
+
+    def store(self, question, schema, value):
+        self.backend.set(self._key(question, schema), value)
+
+    def stats(self):
+        return {**self.backend.stats(), "schema_fingerprint": self._schema_fp}
@@ -0,0 +1,291 @@
+import json
+import os
+import select
+import threading
+import time
+from collections import Counter
+
+import psycopg2
+import psycopg2.extensions
+
+import db
+import tracing
+from cache import fingerprint
+
+log = tracing.get_logger("catalog")
+
+CATALOG_CONFIG = {
+    "schemas": [s.strip() for s in os.getenv("CATALOG_SCHEMAS", "public").split(",") if s.strip()],
+    "refresh_interval": float(os.getenv("CATALOG_REFRESH_INTERVAL", "300")),  # רענון מלא (reltuples אחרי ANALYZE)
+    "listen": os.getenv("CATALOG_LISTEN", "1") == "1",                         # LISTEN לשינויי DDL (db/init/004)
+    "debounce": float(os.getenv("CATALOG_DEBOUNCE", "0.5")),                   # איסוף כמה NOTIFY לרענון אחד
+    "max_sample_distinct": int(os.getenv("SCHEMA_SAMPLE_MAX_DISTINCT", "50")),
+    "max_sample_values": int(os.getenv("SCHEMA_SAMPLE_VALUES", "8")),
+}
+
+# הערוץ שה-event trigger ב-db/init/004_ddl_notify.sql שולח אליו
+DDL_CHANNEL = "nl2sql_ddl"
+
+# שאילתה אחת על ה-catalog: שורה לכל טבלה עם עמודות, אינדקסים, FKs, אומדן שורות וערכים לדוגמה.
+# %(names)s = NULL -> כל הטבלאות; אחרת רק הטבלאות האלה (schema.table כמו object_identity)
+CATALOG_SQL = """
+SELECT
+    n.nspname,
+    c.relname,
+    format('%%I.%%I', n.nspname, c.relname) AS identity,
+    c.relkind,
+    c.reltuples::bigint,
+    (SELECT json_agg(json_build_object(
+                'name', a.attname, 'type', format_type(a.atttypid, a.atttypmod),
+                'oid', a.atttypid, 'nullable', NOT a.attnotnull) ORDER BY a.attnum)
+       FROM pg_attribute a
+      WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),
+    (SELECT json_agg(json_build_object(
+                'name', ic.relname, 'unique', i.indisunique, 'primary', i.indisprimary,
+                'columns', (SELECT array_agg(a.attname ORDER BY k.ord)
+                              FROM unnest(i.indkey::int2[]) WITH ORDINALITY k(attnum, ord)
+                              JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum)))
+       FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid
+      WHERE i.indrelid = c.oid),
+    (SELECT json_agg(json_build_object(
+                'ref_table', rc.relname,
+                'columns', (SELECT array_agg(a.attname ORDER BY k.ord)
+                              FROM unnest(con.conkey) WITH ORDINALITY k(attnum, ord)
+                              JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum),
+                'ref_columns', (SELECT array_agg(a.attname ORDER BY k.ord)
+                                  FROM unnest(con.confkey) WITH ORDINALITY k(attnum, ord)
+                                  JOIN pg_attribute a ON a.attrelid = con.confrelid AND a.attnum = k.attnum)))
+       FROM pg_constraint con JOIN pg_class rc ON rc.oid = con.confrelid
+      WHERE con.conrelid = c.oid AND con.contype = 'f'),
+    (SELECT json_object_agg(s.attname, s.most_common_vals::text::text[])
+       FROM pg_stats s
+      WHERE s.schemaname = n.nspname AND s.tablename = c.relname AND s.most_common_vals IS NOT NULL
+        AND s.n_distinct > 0 AND s.n_distinct <= %(max_distinct)s)
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind IN ('r', 'p', 'v', 'm')
+  AND n.nspname = ANY(%(schemas)s)
+  AND (%(names)s::text[] IS NULL OR format('%%I.%%I', n.nspname, c.relname) = ANY(%(names)s::text[]))
+ORDER BY n.nspname, c.relname
+"""
+
+
+# מה שמשנה את הגרסה שה-listeners רואים; אומדן שורות וערכים לדוגמה משתנים עם הנתונים
+STRUCTURE_FIELDS = ("identity", "kind", "columns", "indexes", "fks")
+
+
+def structure(tables):
+    """החלק המבני של הטבלאות (בלי rows/samples)"""
+    return {identity: {f: t[f] for f in STRUCTURE_FIELDS} for identity, t in tables.items()}
+
+
+def _is_text(type_name):
+    return type_name == "text" or type_name.startswith(("character varying", "character", "varchar"))
+
+
+def _table_from_row(row):
+    schema, name, identity, relkind, reltuples, columns, indexes, fks, samples = row
+    columns = columns or []
+    text_columns = {c["name"] for c in columns if _is_text(c["type"])}
+    return {
+        "schema": schema,
+        "name": name,
+        "identity": identity,
+        "kind": {"r": "table", "p": "table", "v": "view", "m": "materialized_view"}[relkind],
+        # reltuples = -1: הטבלה עוד לא עברה ANALYZE (אומדן לא ידוע)
+        "rows": reltuples if reltuples is not None and reltuples >= 0 else None,
+        "columns": columns,
+        "indexes": indexes or [],
+        "fks": fks or [],
+        "samples": {
+            col: list(values)[:CATALOG_CONFIG["max_sample_values"]]
+            for col, values in (samples or {}).items() if col in text_columns
+        },
+    }
+
+
+class Catalog:
+    """תמונת ה-schema החיה מ-Postgres, בזיכרון: טבלאות, עמודות+טיפוסים, אינדקסים, FKs ואומדן שורות.
+    נטען בשאילתה אחת; מתרענן חלקית על NOTIFY של DDL ובמלואו כל refresh_interval"""
+
+    def __init__(self, schemas=None):
+        self.schemas = schemas or CATALOG_CONFIG["schemas"]
+        self.tables = {}        # identity (schema.table) -> table (תמונה שמוחלפת בשלמותה, קריאה בלי נעילה)
+        self._by_name = {}      # שם קצר -> identity, לפי סדר ה-schemas (כמו search_path)
+        self.version = None     # fingerprint של המבנה בלבד
+        self.loaded_at = None
+        self._listeners = []
+        self._channels = {DDL_CHANNEL: self._apply_notifications}  # ערוץ NOTIFY -> handler(payloads)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"full_refreshes": 0, "incremental_refreshes": 0, "notifications": 0, "errors": 0}
+
+    @property
+    def loaded(self):
+        return self.loaded_at is not None
+
+    def subscribe(self, callback):
+        """callback(catalog) אחרי כל שינוי מבני (למשל בנייה מחדש של אינדקס ה-schema); ANALYZE לבד לא קורא לו"""
+        self._listeners.append(callback)
+
+    def on_notify(self, channel, handler):
+        """handler(payloads) לערוץ NOTIFY נוסף על אותו חיבור LISTEN (לפני start)"""
+        self._channels[channel] = handler
+
+    # ---------- טעינה ----------
+
+    def _query(self, conn, names=None):
+        params = {"schemas": self.schemas, "names": names, "max_distinct": CATALOG_CONFIG["max_sample_distinct"]}
+        with conn.cursor() as cur:
+            cur.execute(CATALOG_SQL, params)
+            return [_table_from_row(row) for row in cur.fetchall()]
+
+    def refresh(self, conn=None, identities=None):
+        """רענון מלא, או רק של הטבלאות ב-identities (schema.table); טבלה שלא חזרה - נמחקה"""
+        if conn is None:
+            with db.checkout() as conn:
+                return self.refresh(conn, identities)
+        rows = self._query(conn, list(identities) if identities else None)
+        with self._lock:
+            if identities:
+                tables = {identity: t for identity, t in self.tables.items() if identity not in identities}
+                self._stats["incremental_refreshes"] += 1
+            else:
+                tables = {}
+                self._stats["full_refreshes"] += 1
+            for table in rows:
+                tables[table["identity"]] = table
+            version = fingerprint(json.dumps(structure(tables), sort_keys=True, default=str))
+            changed = version != self.version
+            self.tables = dict(sorted(tables.items()))
+            self._by_name = self._short_names(self.tables)
+            self.version = version
+            self.loaded_at = time.time()
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback(self)
+                except Exception as e:
+                    log.error("catalog listener failed: %s", e)
+        return changed
+
+    # ---------- שאילתות על ה-catalog ----------
+
+    def _short_names(self, tables):
+        order = {schema: i for i, schema in enumerate(self.schemas)}
+        names = {}
+        for t in sorted(tables.values(), key=lambda t: (order.get(t["schema"], len(order)), t["identity"])):
+            names.setdefault(t["name"], t["identity"])
+        return names
+
+    def table(self, name):
+        """לפי identity, או לפי שם קצר (ה-schema הראשון ב-CATALOG_SCHEMAS שיש בו טבלה כזו)"""
+        return self.tables.get(name) or self.tables.get(self._by_name.get(name))
+
+    def named_tables(self):
+        """{שם לפרומפט: טבלה}: השם הקצר, או schema.table כשהשם קיים ביותר מ-schema אחד"""
+        counts = Counter(t["name"] for t in self.tables.values())
+        return {t["name"] if counts[t["name"]] == 1 else t["identity"]: t for t in self.tables.values()}
+
+    def row_estimate(self, name):
+        table = self.table(name)
+        return table["rows"] if table else None
+
+    def large_tables(self, min_rows):
+        # שמות קצרים - sqlcheck משווה את שם הטבלה בלי schema
+        return {t["name"] for t in self.tables.values() if t["rows"] is not None and t["rows"] >= min_rows}
+
+    def key_columns(self):
+        """שמות עמודות שהן מפתח (PK/FK) - מספריות אבל קטגוריאליות לגרפים"""
+        keys = set()
+        for table in self.tables.values():
+            for index in table["indexes"]:
+                if index["primary"]:
+                    keys.update(index["columns"] or [])
+            for fk in table["fks"]:
+                keys.update(fk["columns"] or [])
+        return keys
+
+    def stats(self):
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "version": self.version,
+                "tables": len(self.tables),
+                "loaded_at": self.loaded_at,
+                "listening": self._thread is not None and self._thread.is_alive(),
+                **self._stats,
+            }
+
+    # ---------- רענון ברקע ----------
+
+    def _apply_notifications(self, payloads):
+        # payload: "<object_type> <object_identity>" מה-event trigger; טבלה -> רענון חלקי, כל השאר -> מלא
+        identities = set()
+        for payload in payloads:
+            object_type, _, identity = payload.partition(" ")
+            if object_type not in ("table", "view", "materialized view") or not identity:
+                return self.refresh()
+            identities.add(identity)
+        return self.refresh(identities=identities)
+
+    def _listen(self):
+        interval = CATALOG_CONFIG["refresh_interval"]
+        conn = psycopg2.connect(db.DATABASE_URL)
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                for channel in self._channels:
+                    cur.execute(f"LISTEN {channel}")
+            self.refresh()  # השלמת שינויים שפוספסו בזמן שלא האזנו
+            last_full = time.monotonic()
+            while not self._stop.is_set():
+                remaining = interval - (time.monotonic() - last_full)
+                if remaining <= 0:
+                    self.refresh()
+                    last_full = time.monotonic()
+                    continue
+                if not select.select([conn], [], [], min(remaining, 1.0))[0]:
+                    continue
+                time.sleep(CATALOG_CONFIG["debounce"])
+                conn.poll()
+                by_channel = {}
+                for n in conn.notifies:
+                    by_channel.setdefault(n.channel, []).append(n.payload)
+                conn.notifies.clear()
+                for channel, payloads in by_channel.items():
+                    self._stats["notifications"] += len(payloads)
+                    self._channels[channel](payloads)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if CATALOG_CONFIG["listen"]:
+                    self._listen()
+                else:
+                    self.refresh()
+                    self._stop.wait(CATALOG_CONFIG["refresh_interval"])
+            except Exception as e:
+                self._stats["errors"] += 1
+                log.error("catalog refresh failed: %s", e)
+                self._stop.wait(5)
+
+    def start(self):
+        """thread רקע שמאזין ל-DDL ומרענן כל refresh_interval"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="catalog-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+catalog = Catalog()
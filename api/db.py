@@ -0,0 +1,703 @@
+import asyncio
+import contextvars
+import itertools
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import psycopg
+import psycopg2
+import psycopg2.extensions
+import psycopg_pool
+from psycopg_pool import AsyncConnectionPool
+
+import tracing
+
+DATABASE_URL = os.getenv("DATABASE_URL", "postgres://app:app@db:5432/demo")
+
+POOL_CONFIG = {
+    "min_size": int(os.getenv("DB_POOL_MIN", "1")),
+    "max_size": int(os.getenv("DB_POOL_MAX", "10")),
+    "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),            # שניות המתנה מקסימליות ל-checkout
+    "max_idle": float(os.getenv("DB_POOL_MAX_IDLE", "300")),         # חיבור פנוי מעבר לזה נסגר (מעל min_size)
+    "health_check_after": float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", "30")),  # SELECT 1 לחיבור שחיכה יותר מזה
+}
+
+# read replicas: שאילתות קריאה (readonly=True) מתחלקות ביניהם, כל השאר ל-DATABASE_URL (primary)
+REPLICA_CONFIG = {
+    "urls": [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()],
+    "routing": os.getenv("DB_ROUTING", "least_loaded"),                  # least_loaded / round_robin
+    "max_lag": float(os.getenv("DB_REPLICA_MAX_LAG", "30")),              # שניות; replica שמפגר יותר לא מקבל קריאות
+    "primary_reads": os.getenv("DB_PRIMARY_READS", "0") == "1",          # ה-primary גם ברוטציה (לא רק fallback)
+    "health_interval": float(os.getenv("DB_HEALTH_INTERVAL", "5")),       # שניות בין בדיקות תקינות/lag
+    "health_timeout": int(os.getenv("DB_HEALTH_TIMEOUT", "2")),           # connect_timeout של הבדיקה
+    "failover_timeout": float(os.getenv("DB_FAILOVER_TIMEOUT", "2")),     # המתנה ל-pool לפני מעבר לשרת הבא
+}
+
+ROUTING_STRATEGIES = ("least_loaded", "round_robin")
+
+log = tracing.get_logger("db")
+
+
+class PoolTimeout(Exception):
+    """אין חיבור פנוי ב-pool בזמן שהוקצב"""
+
+
+class ConnectionPool:
+    """Pool של חיבורי psycopg2 משותף לכל התהליך"""
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=10.0, max_idle=300.0, health_check_after=30.0):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+
+        self._idle = []   # [(conn, last_used)] - LIFO כדי שחיבורים ישנים יתייבשו ויקצרו
+        self._size = 0    # חיבורים פתוחים (פנויים + בשימוש)
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "health_check_failures": 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        with self._cond:
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._stats["connections_closed"] += 1
+
+    def _healthy(self, conn, last_used):
+        """בדיקת תקינות לחיבור שחיכה ב-pool זמן רב"""
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def open(self):
+        """ממלא את ה-pool עד min_size"""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self, timeout=None):
+        start = time.monotonic()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = start + timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No free connection after {timeout:.1f}s (max_size={self.max_size})")
+                waited = True
+                self._cond.wait(remaining)
+
+            wait_time = time.monotonic() - start
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+            if waited:
+                self._stats["waits"] += 1
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+
+        try:
+            if conn is not None and not self._healthy(conn, last_used):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                    self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        """מחזיר חיבור ל-pool; חיבור שבור או בטרנזקציה תקועה נסגר"""
+        keep = not conn.closed
+        if keep and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                keep = False
+
+        with self._cond:
+            self._in_use -= 1
+            if keep and not self._closed:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._size -= 1
+                self._close(conn)
+            self._reap()
+            self._cond.notify()
+
+    def _reap(self):
+        """סוגר חיבורים פנויים שחיכו יותר מ-max_idle (נקרא תחת lock)"""
+        now = time.monotonic()
+        kept = []
+        # הישנים בתחילת הרשימה
+        for conn, last_used in self._idle:
+            if self._size > self.min_size and now - last_used > self.max_idle:
+                self._size -= 1
+                self._close(conn)
+            else:
+                kept.append((conn, last_used))
+        self._idle = kept
+
+    def reap(self):
+        with self._cond:
+            self._reap()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._size -= 1
+                self._close(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._stats["checkouts"]
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "saturation": round(self._in_use / self.max_size, 3),
+                "checkouts": checkouts,
+                "waits": self._stats["waits"],
+                "timeouts": self._stats["timeouts"],
+                "wait_time_avg_ms": round(self._stats["wait_time_total"] / checkouts * 1000, 3) if checkouts else 0.0,
+                "wait_time_max_ms": round(self._stats["wait_time_max"] * 1000, 3),
+                "connections_created": self._stats["connections_created"],
+                "connections_closed": self._stats["connections_closed"],
+                "health_check_failures": self._stats["health_check_failures"],
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# חיבור שמוצמד לבקשה הנוכחית (EXPLAIN והרצה על אותו session)
+_request_slot = contextvars.ContextVar("db_request_slot", default=None)
+
+
+class _RequestSlot:
+    __slots__ = ("conn", "aconn", "endpoint", "aendpoint")
+
+    def __init__(self):
+        self.conn = None    # psycopg2 (גרף סינכרוני)
+        self.aconn = None   # psycopg אסינכרוני (גרף async)
+        self.endpoint = None    # השרת שממנו נלקח כל אחד מהם
+        self.aendpoint = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_URL, **POOL_CONFIG)
+    return _pool
+
+
+def _end_transaction(conn):
+    """סוגר טרנזקציה פתוחה כדי שהשימוש הבא יתחיל נקי"""
+    if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+
+
+@contextmanager
+def checkout(scoped=True, readonly=False):
+    """מחזיר חיבור מה-pool, או את החיבור של הבקשה הנוכחית אם יש כזה.
+    scoped=False: תמיד חיבור נפרד (שאילתה שרצה במקביל לחיבור של הבקשה).
+    readonly=True: SELECT / EXPLAIN בלבד - יכול לרוץ על replica (router)"""
+    slot = _request_slot.get() if scoped else None
+    if slot is not None and slot.conn is not None and not readonly and slot.endpoint is not router.primary:
+        # חיבור הבקשה על replica - מה שלא readonly רץ על primary בחיבור נפרד
+        slot = None
+
+    if slot is not None:
+        if slot.conn is None or slot.conn.closed:
+            if slot.conn is not None:
+                slot.endpoint.get_pool().putconn(slot.conn)
+            slot.endpoint, slot.conn = router.getconn(readonly)
+        try:
+            with router.using(slot.endpoint, slot.conn), tracing.db_timer():
+                yield slot.conn
+        finally:
+            _end_transaction(slot.conn)
+        return
+
+    endpoint, conn = router.getconn(readonly)
+    try:
+        with router.using(endpoint, conn), tracing.db_timer():
+            yield conn
+    finally:
+        endpoint.get_pool().putconn(conn)
+
+
+@contextmanager
+def request_scope():
+    """מצמיד חיבור אחד לכל ה-nodes של בקשה; החיבור נלקח רק בשימוש הראשון"""
+    if _request_slot.get() is not None:
+        yield
+        return
+    slot = _RequestSlot()
+    token = _request_slot.set(slot)
+    try:
+        yield
+    finally:
+        _request_slot.reset(token)
+        if slot.conn is not None:
+            slot.endpoint.get_pool().putconn(slot.conn)
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+def close_pool():
+    global _pool
+    router.close()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+# ---------- Async (psycopg 3) ----------
+
+_apool = None
+_apool_lock = asyncio.Lock()
+
+
+async def get_apool():
+    """Pool אסינכרוני עם אותה קונפיגורציה; נפתח בפעם הראשונה מתוך ה-event loop"""
+    global _apool
+    if _apool is None:
+        async with _apool_lock:
+            if _apool is None:
+                _apool = await _open_apool(DATABASE_URL)
+    return _apool
+
+
+async def _open_apool(dsn):
+    pool = AsyncConnectionPool(
+        dsn,
+        min_size=POOL_CONFIG["min_size"],
+        max_size=POOL_CONFIG["max_size"],
+        timeout=POOL_CONFIG["timeout"],
+        max_idle=POOL_CONFIG["max_idle"],
+        check=AsyncConnectionPool.check_connection,
+        open=False,
+    )
+    await pool.open(wait=False)
+    return pool
+
+
+async def _aend_transaction(conn):
+    if not conn.closed and conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+        await conn.rollback()
+
+
+@asynccontextmanager
+async def acheckout(scoped=True, readonly=False):
+    """כמו checkout, לחיבור psycopg אסינכרוני"""
+    slot = _request_slot.get() if scoped else None
+    if slot is not None and slot.aconn is not None and not readonly and slot.aendpoint is not router.primary:
+        slot = None
+
+    if slot is not None:
+        if slot.aconn is None or slot.aconn.closed:
+            if slot.aconn is not None:
+                await (await slot.aendpoint.get_apool()).putconn(slot.aconn)
+            slot.aendpoint, slot.aconn = await router.agetconn(readonly)
+        try:
+            with router.using(slot.aendpoint, slot.aconn), tracing.db_timer():
+                yield slot.aconn
+        finally:
+            await _aend_transaction(slot.aconn)
+        return
+
+    endpoint, conn = await router.agetconn(readonly)
+    try:
+        with router.using(endpoint, conn), tracing.db_timer():
+            yield conn
+    finally:
+        await (await endpoint.get_apool()).putconn(conn)
+
+
+@asynccontextmanager
+async def arequest_scope():
+    """כמו request_scope, לגרף האסינכרוני"""
+    if _request_slot.get() is not None:
+        yield
+        return
+    slot = _RequestSlot()
+    token = _request_slot.set(slot)
+    try:
+        yield
+    finally:
+        _request_slot.reset(token)
+        if slot.aconn is not None:
+            await (await slot.aendpoint.get_apool()).putconn(slot.aconn)
+        if slot.conn is not None:
+            slot.endpoint.get_pool().putconn(slot.conn)
+
+
+def apool_stats():
+    if _apool is None:
+        return {}
+    stats = _apool.get_stats()
+    size = stats.get("pool_size", 0)
+    in_use = size - stats.get("pool_available", 0)
+    requests = stats.get("requests_num", 0)
+    return {
+        "size": size,
+        "idle": stats.get("pool_available", 0),
+        "in_use": in_use,
+        "min_size": _apool.min_size,
+        "max_size": _apool.max_size,
+        "saturation": round(in_use / _apool.max_size, 3),
+        "checkouts": requests,
+        "waits": stats.get("requests_queued", 0),
+        "timeouts": stats.get("requests_errors", 0),
+        "wait_time_avg_ms": round(stats.get("requests_wait_ms", 0) / requests, 3) if requests else 0.0,
+        "connections_created": stats.get("connections_num", 0),
+        "connections_lost": stats.get("connections_lost", 0),
+    }
+
+
+async def aclose_pool():
+    global _apool
+    await router.aclose()
+    if _apool is not None:
+        await _apool.close()
+        _apool = None
+
+
+# ---------- Read replicas ----------
+
+# השרת של החיבור שבשימוש כרגע (router.using) - fresh_read
+_serving = contextvars.ContextVar("db_serving_endpoint", default=None)
+
+# lag של replica: 0 כשכל מה שהתקבל כבר הוחל (אחרת primary שקט נראה כמו lag שגדל)
+_HEALTH_SQL = """
+SELECT pg_is_in_recovery(),
+       CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+
+
+def _endpoint_name(dsn):
+    """host:port/dbname בלי סיסמה - ללוגים ול-/stats"""
+    try:
+        params = psycopg2.extensions.parse_dsn(dsn)
+    except Exception:
+        return "?"
+    return f"{params.get('host', 'localhost')}:{params.get('port', '5432')}/{params.get('dbname', '')}"
+
+
+class Endpoint:
+    """שרת Postgres אחד: pools משלו (ה-primary משתמש ב-get_pool/get_apool), תקינות ו-lag מהבדיקה האחרונה"""
+
+    def __init__(self, dsn, role):
+        self.dsn = dsn
+        self.role = role            # primary / replica
+        self.name = _endpoint_name(dsn)
+        self.healthy = True         # עד שחיבור או בדיקה נכשלים
+        self.in_recovery = None
+        self.lag = None             # שניות; None = עוד לא נבדק
+        self.checked_at = None
+        self.last_error = None
+        self.active = 0             # checkouts פתוחים כרגע (sync + async)
+        self.checkouts = 0
+        self.failures = 0
+        self._pool = None
+        self._apool = None
+        self._lock = threading.Lock()
+        self._alock = asyncio.Lock()
+
+    def get_pool(self):
+        if self.role == "primary":
+            return get_pool()
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(self.dsn, **POOL_CONFIG)
+        return self._pool
+
+    async def get_apool(self):
+        if self.role == "primary":
+            return await get_apool()
+        if self._apool is None:
+            async with self._alock:
+                if self._apool is None:
+                    self._apool = await _open_apool(self.dsn)
+        return self._apool
+
+    def readable(self):
+        max_lag = REPLICA_CONFIG["max_lag"]
+        return self.healthy and (self.lag is None or self.lag <= max_lag)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "role": self.role,
+            "healthy": self.healthy,
+            "in_recovery": self.in_recovery,
+            "lag_s": None if self.lag is None else round(self.lag, 3),
+            "active": self.active,
+            "checkouts": self.checkouts,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "checked_at": self.checked_at,
+        }
+
+
+class Router:
+    """בוחר שרת לכל checkout: readonly -> replicas תקינים שלא מפגרים (least_loaded / round_robin),
+    ה-primary כ-fallback; כל השאר -> primary. שרת שלא מצליחים לקבל ממנו חיבור (או שהחיבור שלו
+    נשבר באמצע) יוצא מהרוטציה עד שבדיקת הרקע מחזירה אותו"""
+
+    def __init__(self, primary_dsn, replica_dsns=(), routing="least_loaded"):
+        if routing not in ROUTING_STRATEGIES:
+            raise ValueError(f"Unknown DB_ROUTING: {routing} (expected one of {', '.join(ROUTING_STRATEGIES)})")
+        self.primary = Endpoint(primary_dsn, "primary")
+        self.replicas = [Endpoint(dsn, "replica") for dsn in replica_dsns]
+        self.routing = routing
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"reads_replica": 0, "reads_primary": 0, "failovers": 0, "health_checks": 0}
+
+    @property
+    def endpoints(self):
+        return [self.primary, *self.replicas]
+
+    def candidates(self, readonly=False):
+        """השרתים לפי סדר הניסיון"""
+        if not readonly or not self.replicas:
+            return [self.primary]
+        ready = [e for e in self.replicas if e.readable()]
+        if REPLICA_CONFIG["primary_reads"] and self.primary.healthy:
+            ready.append(self.primary)
+        if ready:
+            # סיבוב לפי התור; least_loaded ממיין יציב, כך ששוויון נשבר לפי הסיבוב
+            turn = next(self._turn) % len(ready)
+            ready = ready[turn:] + ready[:turn]
+            if self.routing == "least_loaded":
+                ready.sort(key=lambda e: e.active)
+        if self.primary not in ready:
+            ready.append(self.primary)
+        # מוצא אחרון: replicas שמפגרים, ואחריהם אלה שסומנו (אולי חזרו לפני הבדיקה הבאה)
+        rest = sorted((e for e in self.replicas if e not in ready), key=lambda e: not e.healthy)
+        return ready + rest
+
+    def mark_down(self, endpoint, error):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.last_error = str(error).strip()[:200]
+            was_healthy, endpoint.healthy = endpoint.healthy, False
+        if was_healthy:
+            log.warning("db endpoint down: %s (%s)", endpoint.name, endpoint.last_error)
+
+    def _picked(self, endpoint, readonly, attempt):
+        with self._lock:
+            endpoint.checkouts += 1
+            if readonly:
+                self._stats["reads_primary" if endpoint is self.primary else "reads_replica"] += 1
+            if attempt:
+                self._stats["failovers"] += 1
+
+    def getconn(self, readonly=False):
+        """(endpoint, חיבור psycopg2); שרת שלא נותן חיבור מסומן ועוברים לבא"""
+        candidates = self.candidates(readonly)
+        error = None
+        for attempt, endpoint in enumerate(candidates):
+            last = attempt == len(candidates) - 1
+            try:
+                conn = endpoint.get_pool().getconn(None if last else REPLICA_CONFIG["failover_timeout"])
+            except (PoolTimeout, psycopg2.OperationalError) as e:
+                if last:
+                    raise
+                self.mark_down(endpoint, e)
+                error = e
+                continue
+            self._picked(endpoint, readonly, attempt)
+            return endpoint, conn
+        raise error
+
+    async def agetconn(self, readonly=False):
+        """כמו getconn, מה-pools האסינכרוניים (שרת מת מופיע כ-PoolTimeout)"""
+        candidates = self.candidates(readonly)
+        for attempt, endpoint in enumerate(candidates):
+            last = attempt == len(candidates) - 1
+            pool = await endpoint.get_apool()
+            try:
+                conn = await pool.getconn(None if last else REPLICA_CONFIG["failover_timeout"])
+            except (psycopg_pool.PoolTimeout, psycopg.OperationalError) as e:
+                if last:
+                    raise
+                self.mark_down(endpoint, e)
+                continue
+            self._picked(endpoint, readonly, attempt)
+            return endpoint, conn
+
+    @contextmanager
+    def using(self, endpoint, conn):
+        """סופר את החיבור כפעיל (least_loaded); חיבור שנשבר באמצע מוציא את השרת מהרוטציה"""
+        with self._lock:
+            endpoint.active += 1
+        token = _serving.set(endpoint)
+        try:
+            yield
+        except Exception as e:
+            # statement_timeout / שגיאת SQL משאירים את החיבור פתוח - רק חיבור שבור מסמן
+            if conn.closed or getattr(conn, "broken", False):
+                self.mark_down(endpoint, e)
+            raise
+        finally:
+            _serving.reset(token)
+            with self._lock:
+                endpoint.active -= 1
+
+    # ---------- בדיקות תקינות ----------
+
+    def check(self, endpoint):
+        """חיבור קצר נפרד: pg_is_in_recovery + lag; מחזיר את השרת לרוטציה אם הצליח"""
+        try:
+            conn = psycopg2.connect(endpoint.dsn, connect_timeout=REPLICA_CONFIG["health_timeout"])
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(_HEALTH_SQL)
+                    in_recovery, lag = cur.fetchone()
+            finally:
+                conn.close()
+        except Exception as e:
+            self.mark_down(endpoint, e)
+            return False
+        with self._lock:
+            recovered = not endpoint.healthy
+            endpoint.healthy, endpoint.in_recovery = True, in_recovery
+            endpoint.lag = None if lag is None else float(lag)
+            endpoint.checked_at = round(time.time(), 3)
+        if recovered:
+            log.info("db endpoint up: %s", endpoint.name)
+        if endpoint.role == "replica" and not in_recovery:
+            log.warning("replica %s is not in recovery (promoted?)", endpoint.name)
+        return True
+
+    def check_all(self):
+        for endpoint in self.endpoints:
+            self.check(endpoint)
+        with self._lock:
+            self._stats["health_checks"] += 1
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check_all()
+            self._stop.wait(REPLICA_CONFIG["health_interval"])
+
+    def start(self):
+        """thread רקע שבודק את כל השרתים כל health_interval; בלי replicas אין מה לבדוק"""
+        if not self.replicas or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="db-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        for endpoint in self.replicas:
+            if endpoint._pool is not None:
+                endpoint._pool.close()
+                endpoint._pool = None
+
+    async def aclose(self):
+        for endpoint in self.replicas:
+            if endpoint._apool is not None:
+                await endpoint._apool.close()
+                endpoint._apool = None
+
+    def stats(self):
+        with self._lock:
+            return {"routing": self.routing, "replicas": len(self.replicas), **self._stats,
+                    "endpoints": [e.stats() for e in self.endpoints]}
+
+
+router = Router(DATABASE_URL, REPLICA_CONFIG["urls"], REPLICA_CONFIG["routing"])
+
+
+def router_stats():
+    return router.stats()
+
+
+def fresh_read():
+    """החיבור הנוכחי (בתוך checkout) רואה כל מה שנכתב ל-primary: primary, או replica שלא פיגר בבדיקה האחרונה"""
+    endpoint = _serving.get()
+    return endpoint is None or endpoint is router.primary or endpoint.lag == 0
@@ -0,0 +1,89 @@
+import os
+import time
+
+import tracing
+
+log = tracing.get_logger("deadline")
+
+DEADLINE_CONFIG = {
+    "seconds": float(os.getenv("REQUEST_DEADLINE_SECONDS", "30")),           # תקציב לכל בקשה; 0 = בלי deadline
+    "min_llm": float(os.getenv("DEADLINE_MIN_LLM_SECONDS", "0.3")),          # פחות מזה - לא מתחילים קריאת LLM
+    "min_explain": float(os.getenv("DEADLINE_MIN_EXPLAIN_SECONDS", "0.5")),  # פחות מזה - בלי EXPLAIN / repair
+}
+
+# שגיאת Postgres על statement_timeout (query_canceled)
+QUERY_CANCELED = "57014"
+
+
+def start(state, seconds=None):
+    """מתחיל את ספירת ה-deadline של הבקשה (פעם אחת; ה-endpoint יכול לקבוע תקציב משלו לפני הגרף).
+    seconds: תקציב שהלקוח ביקש - לא יותר מ-REQUEST_DEADLINE_SECONDS (0 / שלילי = התקציב הרגיל)"""
+    if "deadline_at" in state:
+        return state
+    if seconds is None or seconds <= 0:
+        seconds = DEADLINE_CONFIG["seconds"]
+    elif DEADLINE_CONFIG["seconds"] > 0:
+        seconds = min(seconds, DEADLINE_CONFIG["seconds"])
+    if seconds and seconds > 0:
+        state["deadline_s"] = seconds
+        state["deadline_at"] = time.monotonic() + seconds
+    return state
+
+
+def remaining(state):
+    """שניות שנשארו; None אם אין deadline"""
+    deadline_at = state.get("deadline_at")
+    return None if deadline_at is None else deadline_at - time.monotonic()
+
+
+def has_time(state, reserve=0.0):
+    left = remaining(state)
+    return left is None or left > reserve
+
+
+def expired(state):
+    return state.get("deadline_expired") is not None
+
+
+def llm_timeout(state):
+    """timeout לקריאת OpenAI; None = ברירת המחדל של ה-client"""
+    left = remaining(state)
+    return None if left is None else max(left, 0.001)
+
+
+def statement_timeout_ms(state):
+    left = remaining(state)
+    return None if left is None else max(int(left * 1000), 1)
+
+
+def is_timeout(error):
+    # psycopg2: pgcode, psycopg 3: sqlstate
+    return QUERY_CANCELED in (getattr(error, "pgcode", None), getattr(error, "sqlstate", None))
+
+
+def expire(state, stage):
+    """הבקשה חרגה מה-deadline ב-stage: בלי תוצאה עדיין - נחסמת; עם תוצאה - חוזרת חלקית"""
+    state["deadline_expired"] = stage
+    message = f"Request deadline of {state.get('deadline_s', 0):g}s exceeded at {stage}."
+    log.warning("deadline exceeded", extra={"fields": {"stage": stage, "deadline_s": state.get("deadline_s")}})
+    if state.get("rows") or state.get("columnar"):
+        state["notices"] = state.get("notices", []) + [message + " Returning a partial response."]
+        return state
+    state["rows"] = []
+    state["guardrail_ok"] = False
+    state["blocked"] = True
+    state["reasons"] = state.get("reasons", []) + [message]
+    return state
+
+
+def timing(state):
+    """פרטי הזמן לתגובה: תקציב, כמה עבר, כמה נשאר והיכן נחתך"""
+    if state.get("deadline_at") is None:
+        return None
+    left = remaining(state)
+    return {
+        "budget_ms": round(state["deadline_s"] * 1000, 3),
+        "elapsed_ms": round((state["deadline_s"] - left) * 1000, 3),
+        "remaining_ms": round(max(left, 0.0) * 1000, 3),
+        "expired": state.get("deadline_expired"),
+    }
@@ -0,0 +1,125 @@
+import json
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow IPC זמין רק אם pyarrow מותקן
+    pa = None
+
+# OIDs של טיפוסי PostgreSQL (pg_type) שצריכים המרה ל-JSON
+INT_OIDS = {20, 21, 23, 26}                   # int8, int2, int4, oid
+FLOAT_OIDS = {700, 701}                       # float4, float8
+NUMERIC_OID = 1700
+BOOL_OID = 16
+DATE_OID = 1082
+TIME_OIDS = {1083, 1266}                      # time, timetz
+TIMESTAMP_OIDS = {1114, 1184}                 # timestamp, timestamptz
+INTERVAL_OID = 1186
+BYTEA_OID = 17
+UUID_OID = 2950
+
+RESULT_FORMATS = ("rows", "columnar", "arrow")
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def _isoformat(value):
+    return value.isoformat()
+
+
+def _decode(value):
+    return bytes(value).decode("utf-8")
+
+
+def column_converter(type_oid):
+    """פונקציית המרה ל-JSON לעמודה, לפי ה-OID שלה; None = הערך כבר JSON-serializable"""
+    if type_oid == NUMERIC_OID:
+        return float
+    if type_oid == DATE_OID or type_oid in TIME_OIDS or type_oid in TIMESTAMP_OIDS:
+        return _isoformat
+    if type_oid == BYTEA_OID:
+        return _decode
+    if type_oid in (INTERVAL_OID, UUID_OID):
+        return str
+    return None
+
+
+def column_type(type_oid):
+    """סוג לוגי של עמודה (משמש גם את ה-viz): number / boolean / date / datetime / time / string"""
+    if type_oid in INT_OIDS or type_oid in FLOAT_OIDS or type_oid == NUMERIC_OID:
+        return "number"
+    if type_oid == BOOL_OID:
+        return "boolean"
+    if type_oid == DATE_OID:
+        return "date"
+    if type_oid in TIMESTAMP_OIDS:
+        return "datetime"
+    if type_oid in TIME_OIDS:
+        return "time"
+    return "string"
+
+
+def describe_columns(description):
+    """cur.description (psycopg2 / psycopg) -> [{"name", "type", "oid"}]"""
+    return [{"name": desc[0], "type": column_type(desc[1]), "oid": desc[1]} for desc in description]
+
+
+def column_converters(description):
+    return [column_converter(desc[1]) for desc in description]
+
+
+def convert_column(values, converter):
+    if converter is None:
+        return values
+    return [None if v is None else converter(v) for v in values]
+
+
+def convert_row(converters, row):
+    return [v if conv is None or v is None else conv(v) for conv, v in zip(converters, row)]
+
+
+def to_columns(description, rows, columns=None):
+    """שורות גולמיות -> {"columns": [...], "data": [עמודה, ...]}; ההמרה פעם אחת לכל עמודה.
+    columns: רשימות קיימות להמשיך למלא (fetch ב-batches)"""
+    converters = column_converters(description)
+    if columns is None:
+        columns = [[] for _ in description]
+    if rows:
+        for i, values in enumerate(zip(*rows)):
+            columns[i].extend(convert_column(values, converters[i]))
+    return {"columns": describe_columns(description), "data": columns}
+
+
+def columns_to_rows(columnar):
+    """{"columns", "data"} -> רשימת dict לכל שורה (הפורמט הישן של rows)"""
+    names = [c["name"] for c in columnar["columns"]]
+    return [dict(zip(names, values)) for values in zip(*columnar["data"])]
+
+
+def arrow_type(type_oid):
+    """טיפוס Arrow לעמודה, אחרי column_converter (numeric -> float, תאריכים/זמנים -> מחרוזת ISO)"""
+    if type_oid in INT_OIDS:
+        return pa.int64()
+    if type_oid in FLOAT_OIDS or type_oid == NUMERIC_OID:
+        return pa.float64()
+    if type_oid == BOOL_OID:
+        return pa.bool_()
+    return pa.string()
+
+
+def arrow_schema(description):
+    """schema מ-cur.description - לתוצאה בלי שורות, שאין ממנה מה להסיק"""
+    return pa.schema([(desc[0], arrow_type(desc[1])) for desc in description])
+
+
+def to_arrow_ipc(columnar, metadata=None):
+    """Arrow IPC stream מתוצאה עמודתית; metadata (sql, notices...) נשמר ב-schema"""
+    if pa is None:
+        raise ValueError("Arrow result format requires pyarrow")
+    names = [c["name"] for c in columnar["columns"]]
+    # from_arrays ולא dict: שמות עמודות כפולים (a.id, b.id -> id, id) נשמרים
+    table = pa.Table.from_arrays(columnar["data"], names=names)
+    if metadata:
+        table = table.replace_schema_metadata({"nl2sql": json.dumps(metadata, default=str, ensure_ascii=False)})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
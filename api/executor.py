@@ -0,0 +1,187 @@
+import json
+import os
+import uuid
+
+import db
+import sqlcheck
+import tracing
+from encoding import column_converters, convert_row, to_columns
+
+log = tracing.get_logger("executor")
+
+EXECUTION_LIMITS = {
+    "batch_size": int(os.getenv("SQL_FETCH_BATCH", "1000")),       # שורות לכל fetchmany
+    "max_rows": int(os.getenv("SQL_MAX_ROWS", "10000")),           # עצירה מוקדמת אחרי N שורות
+    "max_bytes": int(os.getenv("SQL_MAX_BYTES", "20000000")),      # ~20MB אומדן של התוצאה
+}
+
+
+class RowBudget:
+    """תקציב שורות/בתים לתוצאה; exceeded מחזיק את סיבת העצירה"""
+
+    def __init__(self, max_rows=None, max_bytes=None):
+        self.max_rows = EXECUTION_LIMITS["max_rows"] if max_rows is None else max_rows
+        self.max_bytes = EXECUTION_LIMITS["max_bytes"] if max_bytes is None else max_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.exceeded = None
+
+    def take(self, batch):
+        """החלק של ה-batch שנכנס בתקציב"""
+        for i, row in enumerate(batch):
+            if not self.consume(row):
+                return batch[:i]
+        return batch
+
+    def consume(self, row):
+        """סופר שורה גולמית (tuple); False אם היא חורגת מהתקציב ואין להחזיר אותה"""
+        if self.rows >= self.max_rows:
+            self.exceeded = f"Result truncated at {self.rows} rows (row budget {self.max_rows})."
+            return False
+        # אומדן זול: אורך הטקסט של כל ערך + תקורה קבועה לשדה
+        size = sum(len(str(v)) + 8 for v in row)
+        if self.bytes + size > self.max_bytes:
+            self.exceeded = f"Result truncated at {self.rows} rows (byte budget {self.max_bytes})."
+            return False
+        self.rows += 1
+        self.bytes += size
+        return True
+
+
+def _cursor_name():
+    return f"nl2sql_{uuid.uuid4().hex[:12]}"
+
+
+def declarable(sql):
+    # DECLARE ... CURSOR FOR <sql> לא מקבל ; בסוף
+    return sql.strip().rstrip(";").strip()
+
+
+def set_statement_timeout(conn, timeout_ms):
+    """statement_timeout לטרנזקציה הנוכחית בלבד (כמו SET LOCAL); None = בלי שינוי"""
+    if timeout_ms is None:
+        return
+    with conn.cursor() as cur:
+        # SET לא מקבל פרמטרים - set_config(..., true) הוא ה-SET LOCAL עם bind
+        cur.execute("SELECT set_config('statement_timeout', %s, true)", (str(timeout_ms),))
+
+
+async def aset_statement_timeout(conn, timeout_ms):
+    if timeout_ms is None:
+        return
+    async with conn.cursor() as cur:
+        await cur.execute("SELECT set_config('statement_timeout', %s, true)", (str(timeout_ms),))
+
+
+def stream_rows(conn, sql, budget=None, batch_size=None, description=None):
+    """מריץ את השאילתה ב-server-side cursor ומחזיר dict לכל שורה, ב-batches של fetchmany.
+    עוצר ברגע שהתקציב נגמר (budget.exceeded מחזיק את הסיבה).
+    description: רשימה שמקבלת את cur.description - גם כשאין שורות (כותרת/schema לייצוא)"""
+    budget = budget or RowBudget()
+    batch_size = batch_size or EXECUTION_LIMITS["batch_size"]
+    with conn.cursor(name=_cursor_name()) as cur:
+        cur.itersize = batch_size
+        cur.execute(declarable(sql))
+        colnames = converters = None
+        while True:
+            batch = cur.fetchmany(batch_size)
+            if colnames is None and cur.description is not None:
+                # ב-cursor עם שם description מתמלא רק אחרי ה-fetch הראשון
+                colnames = [desc[0] for desc in cur.description]
+                converters = column_converters(cur.description)
+                if description is not None:
+                    description.extend(cur.description)
+            if not batch:
+                return
+            allowed = budget.take(batch)
+            for row in allowed:
+                yield dict(zip(colnames, convert_row(converters, row)))
+            if len(allowed) < len(batch):
+                return
+
+
+async def astream_rows(conn, sql, budget=None, batch_size=None):
+    """כמו stream_rows, על חיבור psycopg אסינכרוני"""
+    budget = budget or RowBudget()
+    batch_size = batch_size or EXECUTION_LIMITS["batch_size"]
+    async with conn.cursor(name=_cursor_name()) as cur:
+        await cur.execute(declarable(sql))
+        colnames = [desc[0] for desc in cur.description]
+        converters = column_converters(cur.description)
+        while True:
+            batch = await cur.fetchmany(batch_size)
+            if not batch:
+                return
+            allowed = budget.take(batch)
+            for row in allowed:
+                yield dict(zip(colnames, convert_row(converters, row)))
+            if len(allowed) < len(batch):
+                return
+
+
+def fetch_columnar(conn, sql, budget=None, batch_size=None):
+    """כמו stream_rows, אבל בונה תוצאה עמודתית ({"columns", "data"}) עם המרה לכל עמודה"""
+    budget = budget or RowBudget()
+    batch_size = batch_size or EXECUTION_LIMITS["batch_size"]
+    data = None
+    with conn.cursor(name=_cursor_name()) as cur:
+        cur.itersize = batch_size
+        cur.execute(declarable(sql))
+        while True:
+            batch = cur.fetchmany(batch_size)
+            allowed = budget.take(batch) if batch else batch
+            result = to_columns(cur.description, allowed, data)
+            data = result["data"]
+            if len(allowed) < batch_size:
+                return result
+
+
+async def afetch_columnar(conn, sql, budget=None, batch_size=None):
+    """כמו fetch_columnar, על חיבור psycopg אסינכרוני"""
+    budget = budget or RowBudget()
+    batch_size = batch_size or EXECUTION_LIMITS["batch_size"]
+    data = None
+    async with conn.cursor(name=_cursor_name()) as cur:
+        await cur.execute(declarable(sql))
+        while True:
+            batch = await cur.fetchmany(batch_size)
+            allowed = budget.take(batch) if batch else batch
+            result = to_columns(cur.description, allowed, data)
+            data = result["data"]
+            if len(allowed) < batch_size:
+                return result
+
+
+def describe_sql(sql):
+    """השאילתה עם LIMIT 0: רק מבנה העמודות (Postgres מתכנן אותה ולא קורא שורות)"""
+    return sqlcheck.with_limit(sql, sqlcheck.parse(sql), 0)
+
+
+def describe(conn, sql):
+    """[{"name", "type", "oid"}] של התוצאה, בלי להריץ את השאילתה"""
+    return fetch_columnar(conn, describe_sql(sql))["columns"]
+
+
+async def adescribe(conn, sql):
+    return (await afetch_columnar(conn, describe_sql(sql)))["columns"]
+
+
+async def astream_ndjson(sql, header, chunk_rows=500, statement_timeout_ms=None):
+    """NDJSON לתגובת /ask בזרימה: שורת header, שורה לכל רשומה ושורת סיכום"""
+    yield json.dumps(header, default=str, ensure_ascii=False) + "\n"
+    budget = RowBudget()
+    lines = []
+    try:
+        async with db.acheckout(readonly=True) as conn:
+            await aset_statement_timeout(conn, statement_timeout_ms)
+            async for row in astream_rows(conn, sql, budget):
+                lines.append(json.dumps({"row": row}, default=str, ensure_ascii=False))
+                if len(lines) >= chunk_rows:
+                    yield "\n".join(lines) + "\n"
+                    lines = []
+    except Exception as e:
+        log.error("astream_ndjson failed: %s", e)
+        lines.append(json.dumps({"error": f"SQL execution failed: {e}"}))
+    if lines:
+        yield "\n".join(lines) + "\n"
+    yield json.dumps({"done": True, "rows": budget.rows, "truncated": budget.exceeded}) + "\n"
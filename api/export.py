@@ -0,0 +1,236 @@
+import csv
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import zlib
+
+import db
+from encoding import arrow_schema
+from executor import EXECUTION_LIMITS, RowBudget, stream_rows, declarable
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # parquet/arrow זמינים רק אם pyarrow מותקן
+    pa = pq = None
+
+EXPORT_CONFIG = {
+    "max_rows": int(os.getenv("EXPORT_MAX_ROWS", "5000000")),
+    "chunk_bytes": int(os.getenv("EXPORT_CHUNK_BYTES", str(256 * 1024))),
+    "use_copy": os.getenv("EXPORT_USE_COPY", "1") == "1",  # csv דרך COPY ... TO STDOUT
+}
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+}
+
+
+class ExportError(ValueError):
+    """פורמט ייצוא לא נתמך בסביבה הנוכחית"""
+
+
+def check_format(fmt):
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown export format: {fmt} (expected one of {', '.join(EXPORT_FORMATS)})")
+    if fmt in ("parquet", "arrow") and pa is None:
+        raise ExportError(f"Export format {fmt} requires pyarrow")
+
+
+def media_type(fmt, compress=False):
+    return "application/gzip" if compress else EXPORT_FORMATS[fmt][0]
+
+
+def filename(fmt, compress=False):
+    return f"result.{EXPORT_FORMATS[fmt][1]}" + (".gz" if compress else "")
+
+
+def _budget():
+    return RowBudget(max_rows=EXPORT_CONFIG["max_rows"], max_bytes=sys.maxsize)
+
+
+# ---------- CSV דרך COPY ----------
+
+_DONE = object()
+
+
+class _QueueWriter:
+    """file-like ל-copy_expert: צובר ~chunk_bytes ומעביר לתור חסום (backpressure)"""
+
+    def __init__(self, q, cancelled, chunk_bytes):
+        self.q = q
+        self.cancelled = cancelled
+        self.chunk_bytes = chunk_bytes
+        self.buf = bytearray()
+
+    def write(self, data):
+        self.buf += data.encode("utf-8") if isinstance(data, str) else data
+        if len(self.buf) >= self.chunk_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.put(bytes(self.buf))
+            self.buf = bytearray()
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                # הלקוח התנתק - COPY נקטע והחיבור חוזר ל-pool
+                raise IOError("export cancelled")
+            try:
+                self.q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+
+def _copy_csv_chunks(sql):
+    q = queue.Queue(maxsize=8)
+    cancelled = threading.Event()
+    writer = _QueueWriter(q, cancelled, EXPORT_CONFIG["chunk_bytes"])
+    # אותה תקרת שורות כמו ב-RowBudget של ה-cursor (COPY לא עובר דרך התקציב)
+    capped = f"SELECT * FROM ({declarable(sql)}) AS export_rows LIMIT {EXPORT_CONFIG['max_rows']}"
+    copy_sql = f"COPY ({capped}) TO STDOUT WITH (FORMAT csv, HEADER true)"
+
+    def produce():
+        try:
+            with db.checkout(readonly=True) as conn:
+                with conn.cursor() as cur:
+                    cur.copy_expert(copy_sql, writer)
+            writer.flush()
+        except Exception as e:
+            if not cancelled.is_set():
+                q.put(e)
+        finally:
+            if not cancelled.is_set():
+                q.put(_DONE)
+
+    thread = threading.Thread(target=produce, name="export-copy", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+
+# ---------- פורמטים מבוססי server-side cursor ----------
+
+def _row_batches(sql, batch_size=None, description=None):
+    """רשימות של dict rows בגודל batch, מתוך server-side cursor (description: ראה stream_rows)"""
+    batch_size = batch_size or EXECUTION_LIMITS["batch_size"]
+    with db.checkout(readonly=True) as conn:
+        batch = []
+        for row in stream_rows(conn, sql, _budget(), batch_size, description):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def _csv_chunks(sql):
+    out = io.StringIO()
+    writer = None
+    description = []
+    for batch in _row_batches(sql, description=description):
+        if writer is None:
+            writer = csv.DictWriter(out, fieldnames=list(batch[0].keys()))
+            writer.writeheader()
+        writer.writerows(batch)
+        yield out.getvalue().encode("utf-8")
+        out.seek(0)
+        out.truncate(0)
+    if writer is None and description:
+        # בלי שורות - רק הכותרת (כמו COPY ... HEADER)
+        csv.writer(out).writerow([desc[0] for desc in description])
+        yield out.getvalue().encode("utf-8")
+
+
+def _ndjson_chunks(sql):
+    for batch in _row_batches(sql):
+        yield ("\n".join(json.dumps(row, default=str, ensure_ascii=False) for row in batch) + "\n").encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """sink ל-pyarrow שנשאב אחרי כל batch; tell() ממשיך לספור כדי שה-offsets ב-footer יהיו נכונים"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _arrow_writer(sink, schema, fmt):
+    return pq.ParquetWriter(sink, schema) if fmt == "parquet" else pa.ipc.new_stream(sink, schema)
+
+
+def _arrow_chunks(sql, fmt):
+    sink = _ChunkSink()
+    writer = None
+    schema = None
+    description = []
+    for batch in _row_batches(sql, description=description):
+        table = pa.Table.from_pylist(batch, schema=schema)
+        if writer is None:
+            schema = table.schema
+            writer = _arrow_writer(sink, schema, fmt)
+        writer.write_table(table)
+        data = sink.drain()
+        if data:
+            yield data
+    if writer is None and description:
+        # בלי שורות - קובץ תקין עם ה-schema מ-cur.description
+        writer = _arrow_writer(sink, arrow_schema(description), fmt)
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> מעטפת gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(sql, fmt="csv", compress=False):
+    """מחזיר generator של bytes שמזרים את תוצאת השאילתה מה-DB בזיכרון קבוע, בלי קובץ זמני"""
+    check_format(fmt)
+    if fmt == "csv":
+        chunks = _copy_csv_chunks(sql) if EXPORT_CONFIG["use_copy"] else _csv_chunks(sql)
+    elif fmt == "ndjson":
+        chunks = _ndjson_chunks(sql)
+    else:
+        chunks = _arrow_chunks(sql, fmt)
+    return _gzip(chunks) if compress else chunks
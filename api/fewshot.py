@@ -0,0 +1,261 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+import tracing
+from cache import normalize_question
+
+log = tracing.get_logger("fewshot")
+
+GOLD_PATH = "docs/gold.md"
+
+FEWSHOT_CONFIG = {
+    "enabled": os.getenv("FEWSHOT", "1") == "1",
+    "top_k": int(os.getenv("FEWSHOT_TOP_K", "3")),                       # דוגמאות לפרומפט
+    "char_ngrams": int(os.getenv("FEWSHOT_CHAR_NGRAMS", "3")),           # 0 = מילים בלבד
+    "exact_similarity": float(os.getenv("FEWSHOT_EXACT_SIMILARITY", "0.9")),  # מעל זה - ה-SQL בלי LLM
+    "path": os.getenv("FEWSHOT_PATH", "cache/fewshot.jsonl"),            # דוגמאות שנוספו (POST /examples / למידה)
+    "learn": os.getenv("FEWSHOT_LEARN", "0") == "1",                     # שאילתות שרצו בהצלחה -> דוגמאות לפרומפט
+}
+
+# הדוגמאות שהיו קבועות בפרומפט של generate_sql - תמיד באינדקס
+SEED_EXAMPLES = [
+    {"question": "תראה לי לקוחות", "sql": "SELECT * FROM customers LIMIT 10;", "source": "seed"},
+    {"question": "הזמנות של לקוח 1", "sql": "SELECT * FROM orders WHERE customer_id = 1 LIMIT 10;", "source": "seed"},
+    {"question": "תן לי את כל הלקוחות לא מישראל", "sql": "SELECT * FROM customers WHERE country != 'Israel' LIMIT 10;",
+     "source": "seed"},
+]
+
+# מקורות שמותר לקחת מהם SQL בלי LLM; "learned" (FEWSHOT_LEARN) רק לפרומפט
+TRUSTED_SOURCES = ("seed", "gold", "accepted")
+
+_QUOTED = re.compile(r'"((?:[^"]|"")*)"', re.DOTALL)
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+# מילים שהופכות את המשמעות - שלילה (גם עם תחילית: שלא, ללא, מבלי) ואופרטורי השוואה
+_POLARITY = re.compile(
+    r"(?<!\w)[ושהכלמב]{0,2}(לא|בלי|ללא|אין|חוץ|למעט|מלבד)(?!\w)"
+    r"|(?<!\w)(not|no|without|except|excluding|never|dont|doesnt|isnt|arent)(?!\w)"
+    r"|(<=|>=|<>|!=|=|<|>)"
+)
+
+# BM25
+_K1 = 1.5
+_B = 0.75
+
+
+def parse_gold(text):
+    """gold.md: שורת כותרת question,sql,notes ואז רשומות של שלושה שדות במרכאות (גם על כמה שורות)"""
+    fields = [f.replace('""', '"').strip() for f in _QUOTED.findall(text.split("\n", 1)[1] if "\n" in text else "")]
+    return [{"question": q, "sql": s, "notes": n} for q, s, n in zip(fields[0::3], fields[1::3], fields[2::3])]
+
+
+def _grams(text, n):
+    padded = f" {text} "
+    return [padded[i:i + n] for i in range(len(padded) - n + 1)]
+
+
+def tokens(question, char_ngrams=None):
+    """מילים מנורמלות + char n-grams של כל מילה (תחיליות עבריות, רבים ושגיאות כתיב קטנות)"""
+    n = FEWSHOT_CONFIG["char_ngrams"] if char_ngrams is None else char_ngrams
+    words = normalize_question(question).split()
+    result = list(words)
+    if n:
+        result.extend("#" + g for word in words for g in _grams(word, n))
+    return result
+
+
+def _polarity(question):
+    return ["".join(groups) for groups in _POLARITY.findall(question)]
+
+
+def similarity(a, b, n=3):
+    """Dice על ה-n-grams של השאלות המנורמלות; מספרים, שלילה או אופרטור שונים
+    ("top 3" / "top 5", "לקוחות מישראל" / "לקוחות לא מישראל", "> 100" / "< 100") -> 0"""
+    a, b = normalize_question(a), normalize_question(b)
+    if a == b:
+        return 1.0
+    if _NUMBER.findall(a) != _NUMBER.findall(b) or _polarity(a) != _polarity(b):
+        return 0.0
+    ga, gb = Counter(_grams(a, n)), Counter(_grams(b, n))
+    total = sum(ga.values()) + sum(gb.values())
+    return 2 * sum((ga & gb).values()) / total if total else 0.0
+
+
+def format_examples(examples):
+    """שורות "- "שאלה" → SQL" לפרומפט (ה-SQL בשורה אחת)"""
+    return "\n".join(f'- "{e["question"]}" → {" ".join(e["sql"].split())}' for e in examples)
+
+
+class ExampleIndex:
+    """אינדקס BM25 על זוגות שאלה/SQL: seed + docs/gold.md + דוגמאות שנוספו (FEWSHOT_PATH).
+    נטען פעם אחת (ensure_loaded), ודוגמאות חדשות נוספות לאינדקס בלי לבנות אותו מחדש"""
+
+    def __init__(self, gold_path=GOLD_PATH, path=None, enabled=True):
+        self.gold_path = gold_path
+        self.path = path
+        self.enabled = enabled
+        self.examples = []        # [{"question", "sql", "source"}]; None במקום דוגמה שהוחלפה
+        self._by_question = {}    # שאלה מנורמלת -> id
+        self._postings = {}       # term -> {id: tf}
+        self._lengths = {}        # id -> מספר ה-tokens
+        self._total_length = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stats = {"searches": 0, "shortcuts": 0, "added": 0}
+
+    # ---------- בנייה ----------
+
+    def _read_gold(self):
+        try:
+            with open(self.gold_path, encoding="utf-8") as f:
+                return parse_gold(f.read())
+        except FileNotFoundError:
+            log.warning("gold file not found: %s", self.gold_path)
+            return []
+
+    def _read_added(self):
+        if not self.path:
+            return []
+        examples = []
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        examples.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return examples
+
+    def _remove(self, doc_id):
+        # תחת lock
+        for term in set(tokens(self.examples[doc_id]["question"])):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._lengths.pop(doc_id)
+        self.examples[doc_id] = None
+
+    def _add(self, question, sql, source):
+        # תחת lock; שאלה שכבר קיימת (אחרי נרמול) - הדוגמה החדשה מחליפה אותה
+        key = normalize_question(question)
+        if not key or not sql:
+            return None
+        if key in self._by_question:
+            self._remove(self._by_question[key])
+        doc_id = len(self.examples)
+        example = {"question": question, "sql": sql, "source": source}
+        self.examples.append(example)
+        self._by_question[key] = doc_id
+        terms = tokens(question)
+        for term, tf in Counter(terms).items():
+            self._postings.setdefault(term, {})[doc_id] = tf
+        self._lengths[doc_id] = len(terms)
+        self._total_length += len(terms)
+        return example
+
+    def load(self):
+        with self._lock:
+            self.examples, self._by_question, self._postings, self._lengths = [], {}, {}, {}
+            self._total_length = 0
+            for e in SEED_EXAMPLES:
+                self._add(e["question"], e["sql"], "seed")
+            for e in self._read_gold():
+                self._add(e["question"], e["sql"], "gold")
+            for e in self._read_added():
+                self._add(e.get("question"), e.get("sql"), e.get("source", "accepted"))
+            self._loaded = True
+            log.info("few-shot index loaded", extra={"fields": {"examples": len(self._lengths)}})
+        return self
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+        return self
+
+    # ---------- חיפוש ----------
+
+    def _scores(self, question):
+        # תחת lock
+        count = len(self._lengths)
+        if not count:
+            return {}
+        avg_length = self._total_length / count
+        scores = {}
+        for term in set(tokens(question)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings.items():
+                norm = tf + _K1 * (1 - _B + _B * self._lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (_K1 + 1) / norm
+        return scores
+
+    def search(self, question, k=None):
+        """k הדוגמאות הדומות ביותר לשאלה: [{"question", "sql", "source", "score"}]"""
+        k = FEWSHOT_CONFIG["top_k"] if k is None else k
+        if not self.enabled or k <= 0:
+            return []
+        self.ensure_loaded()
+        with self._lock:
+            self._stats["searches"] += 1
+            scores = self._scores(question)
+            ranked = sorted(scores.items(), key=lambda item: -item[1])[:k]
+            return [{**self.examples[doc_id], "score": round(score, 3)} for doc_id, score in ranked]
+
+    def exact(self, question, examples=None):
+        """דוגמה מהימנה שזהה (כמעט) לשאלה - ה-SQL שלה בלי LLM; None אם אין"""
+        if not self.enabled:
+            return None
+        candidates = self.search(question) if examples is None else examples
+        threshold = FEWSHOT_CONFIG["exact_similarity"]
+        best = None
+        for example in candidates:
+            if example["source"] not in TRUSTED_SOURCES:
+                continue
+            score = similarity(question, example["question"])
+            if score >= threshold and (best is None or score > best["similarity"]):
+                best = {**example, "similarity": round(score, 3)}
+        if best is not None:
+            with self._lock:
+                self._stats["shortcuts"] += 1
+        return best
+
+    def prompt_examples(self, question):
+        """הדוגמאות לפרומפט; אינדקס כבוי / בלי התאמה -> דוגמאות ה-seed"""
+        return self.search(question) or SEED_EXAMPLES
+
+    # ---------- הוספה ----------
+
+    def add(self, question, sql, source="accepted"):
+        """מוסיף דוגמה לאינדקס ולקובץ (כשיש FEWSHOT_PATH); מחזיר את הדוגמה או None"""
+        self.ensure_loaded()
+        with self._lock:
+            example = self._add(question, sql, source)
+            if example is None:
+                return None
+            self._stats["added"] += 1
+            if self.path:
+                try:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(example, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    log.warning("failed to persist example: %s", e)
+        return example
+
+    def stats(self):
+        with self._lock:
+            sources = Counter(e["source"] for e in self.examples if e is not None)
+            return {"enabled": self.enabled, "loaded": self._loaded, "examples": len(self._lengths),
+                    "by_source": dict(sources), "learn": FEWSHOT_CONFIG["learn"], **self._stats}
+
+
+fewshot_index = ExampleIndex(path=FEWSHOT_CONFIG["path"], enabled=FEWSHOT_CONFIG["enabled"])
@@ -1,12 +1,29 @@
 from langgraph.graph import StateGraph, END
-from utils import save_to_csv
-from openai import OpenAI
-from guardrails import apply_guardrails
-import psycopg2
+from openai import OpenAI, AsyncOpenAI
+from guardrails import apply_guardrails, aapply_guardrails, static_result, guardrail_result, add_limit_to_sql, THRESHOLDS
+from cache import QuestionCache, make_cache
+from intent import classify_intent, fast_path_intent
+from executor import RowBudget, fetch_columnar, afetch_columnar, set_statement_timeout, aset_statement_timeout, \
+    describe, adescribe
+from encoding import columns_to_rows
+from schema_index import schema_index
+from result_cache import result_cache
+from rollups import rollup_rewriter
+from fewshot import FEWSHOT_CONFIG, fewshot_index, format_examples
+import viz
+import viz_reduce
+import repair
+import deadline
+import tracing
+import db
+import copy
+import functools
+import inspect
 import os
 import json
-from datetime import date, datetime
-from decimal import Decimal
+from typing import Annotated
+
+log = tracing.get_logger("graph")
 
 # מצב משותף (State)
 class GraphState(dict):
@@ -16,32 +33,110 @@ class GraphState(dict):
     rows: list
     viz_spec: dict
     action: str   # "display" | "download"
-    file_path: str
     notices: list  # הודעות על שינויים שנעשו
     reasons: list  # סיבות על חסימה
     guardrail_ok: bool  # האם השאילתה עברה את ה-guardrails
+    sql_cache_hit: bool  # ה-SQL הגיע מה-cache ולא מה-LLM
+    sql_cache_entry: dict  # רשומת ה-sql_cache שנמצאה ({} = אין); חיפוש אחד לבקשה
+    llm_action: str  # action שה-LLM החזיר במצב combined
+    plan_ok: bool  # קריאת ה-combined הצליחה (אחרת fallback ל-two_step)
+    intent_source: str  # "local" | "llm" | "fallback"
+    stream: bool  # הבקשה מבקשת תוצאה בזרימה (NDJSON)
+    streamed: bool  # execute_sql דילג על ההרצה - השורות יוזרמו מה-endpoint (stream / download)
+    truncated: bool  # התוצאה נחתכה בגלל תקציב שורות/בתים
+    result_format: str  # "rows" | "columnar" | "arrow"
+    columns: list  # [{"name", "type", "oid"}] מתוך cur.description
+    columnar: dict  # {"columns", "data"} כשה-result_format עמודתי
+    viz_source: str  # "rules" | "llm" | "fallback"
+    result_cache_hit: bool  # התוצאה הגיעה מה-result cache בלי להריץ את השאילתה
+    viz_reduction: dict  # {"strategy", "source", "rows_before", "rows_after"} כשהנתונים לגרף הוקטנו
+    rollup: str  # שם ה-rollup שהשאילתה שוכתבה אליו (db/init/006_rollups.sql)
+    repair: dict  # דוח ה-auto-repair כשהשאילתה נחסמה: {"ok", "strategy", "original_cost", "cost", "cost_saved", "variants"}
+    deadline_at: float  # time.monotonic() שבו נגמר התקציב של הבקשה (deadline.py)
+    deadline_s: float  # התקציב בשניות
+    deadline_expired: str  # ה-node שבו נגמר הזמן (תגובה חלקית / חסומה)
+    example_match: dict  # דוגמת gold שה-SQL נלקח ממנה בלי LLM: {"question", "source", "similarity"}
+    viz_columns: list  # מבנה העמודות מ-LIMIT 0 (הגרף המקבילי, בזמן שהשאילתה רצה)
+    speculative_viz: dict  # spec של ה-stylist מתוך viz_columns, לפני שהשורות הגיעו
+    viz_speculation: str  # "used" | "discarded"
+
+def merge_notices(current, update):
+    """reducer של notices בגרף המקבילי: ענפים שרצים יחד מחזירים שינוי ({"added", "removed"}) ולא רשימה מלאה"""
+    if isinstance(update, dict):
+        removed = update.get("removed", [])
+        return [n for n in current or [] if n not in removed] + update.get("added", [])
+    return update
+
+class ParallelGraphState(GraphState):
+    notices: Annotated[list, merge_notices]
 
-# יצירת OpenAI client
+# יצירת OpenAI client (סינכרוני + אסינכרוני לגרף ה-async)
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+aclient = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-def convert_to_json_serializable(obj):
-    """ממיר אובייקטים לא JSON-serializable לפורמט JSON"""
-    if isinstance(obj, date):
-        return obj.isoformat()
-    elif isinstance(obj, datetime):
-        return obj.isoformat()
-    elif isinstance(obj, Decimal):
-        return float(obj)
-    elif isinstance(obj, bytes):
-        return obj.decode('utf-8')
-    else:
-        return obj
+# "two_step": detect_intent + generate_sql (שתי קריאות LLM)
+# "combined": קריאה אחת שמחזירה {intent, sql, action}, עם fallback ל-two_step
+# "parallel": two_step, כשה-intent וה-action רצים במקביל ל-generate_sql ו-spec הגרף מתחיל בזמן ההרצה
+PIPELINE_MODE = os.getenv("NL2SQL_PIPELINE_MODE", "two_step")
 
-# ---------- Nodes ----------
+# במצב parallel: ה-stylist מתחיל ממבנה העמודות (LIMIT 0) בזמן שהשאילתה רצה; 0 = רק אחרי ההרצה
+SPECULATIVE_VIZ = os.getenv("NL2SQL_SPECULATIVE_VIZ", "1") == "1"
 
-def detect_intent(state: GraphState):
-    query = state["query"]
-    
+# cache של שאלה -> SQL (memory / sqlite / none)
+sql_cache = QuestionCache(make_cache(
+    backend=os.getenv("NL2SQL_CACHE_BACKEND", "memory"),
+    max_entries=int(os.getenv("NL2SQL_CACHE_MAX_ENTRIES", "1000")),
+    ttl=float(os.getenv("NL2SQL_CACHE_TTL", "86400")) or None,
+    path=os.getenv("NL2SQL_CACHE_PATH", "cache/nl2sql.sqlite"),
+))
+
+def llm(c, state):
+    """ה-client עם timeout של מה שנשאר מה-deadline ובלי retries (retry אחרי timeout כבר לא ייכנס בזמן)"""
+    timeout = deadline.llm_timeout(state)
+    if timeout is None:
+        return c
+    return c.with_options(timeout=timeout, max_retries=0)
+
+def llm_in_time(state):
+    return deadline.has_time(state, deadline.DEADLINE_CONFIG["min_llm"])
+
+def db_in_time(state):
+    # זמן ל-EXPLAIN או לשאילתה נוספת שאינה ההרצה עצמה
+    return deadline.has_time(state, deadline.DEADLINE_CONFIG["min_explain"])
+
+def out_of_time(state, stage, reserve=0.0):
+    """נגמר הזמן לפני/בתוך stage: הבקשה מסומנת (deadline.expire) ומחזיר True"""
+    if deadline.has_time(state, reserve):
+        return False
+    deadline.expire(state, stage)
+    return True
+
+def strip_code_fence(text, lang):
+    """מסיר ```lang ... ``` שה-LLM עוטף בו את התשובה"""
+    if text.startswith(f"```{lang}"):
+        text = text[3 + len(lang):]
+    if text.startswith("```"):
+        text = text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+# ---------- Prompts & parsing (משותפים לגרסה הסינכרונית והאסינכרונית) ----------
+
+def keyword_intent(query):
+    """הניחוש הטוב ביותר של המסווג המקומי, כשה-LLM לא זמין או לא ברור"""
+    return classify_intent(query)[0]
+
+def local_intent(state):
+    """fast path: מסווג מקומי בטוח מספיק - בלי קריאה ל-LLM"""
+    intent = fast_path_intent(state["query"])
+    if intent is None:
+        return False
+    state["intent"] = intent
+    state["intent_source"] = "local"
+    return True
+
+def intent_request(query):
     prompt = f"""
 אתה עוזר AI שמזהה את הכוונה של שאילתות משתמשים במערכת ניהול נתונים.
 
@@ -51,7 +146,7 @@ def detect_intent(state: GraphState):
 
 דוגמאות:
 - "תראה לי את כל הלקוחות" → sql
-- "כמה הזמנות יש לנו השבוע?" → sql  
+- "כמה הזמנות יש לנו השבוע?" → sql
 - "תעשה לי גרף של המכירות לפי חודש" → viz
 - "תרשים של התפלגות הגילאים" → viz
 - "איזה מוצרים הכי נמכרים?" → sql
@@ -60,53 +155,54 @@ def detect_intent(state: GraphState):
 שאילתת המשתמש: {query}
 
 הכוונה:"""
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": 10,
+    }
 
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            max_tokens=10
-        )
-        
-        intent = response.choices[0].message.content.strip().lower()
-        
-        # וידוא שהתשובה תקינה
-        if intent in ["sql", "viz"]:
-            state["intent"] = intent
-        else:
-            # fallback ללוגיקה פשוטה אם התשובה לא מוכרת
-            q = query.lower()
-            if "chart" in q or "plot" in q or "graph" in q or "תרשים" in q or "גרף" in q:
-                state["intent"] = "viz"
-            else:
-                state["intent"] = "sql"
-                
-    except Exception as e:
-        print(f"Error in detect_intent: {e}")
-        # fallback ללוגיקה פשוטה במקרה של שגיאה
-        q = query.lower()
-        if "chart" in q or "plot" in q or "graph" in q or "תרשים" in q or "גרף" in q:
-            state["intent"] = "viz"
-        else:
-            state["intent"] = "sql"
-    
-    return state
+def apply_intent(state, response):
+    intent = response.choices[0].message.content.strip().lower()
 
-def generate_sql(state: GraphState):
-    query = state["query"]
-    notices = state.get("notices", [])
-    
-    # קריאת ה-schema
-    try:
-        schema = open("docs/schema_summaries.md").read()
-    except FileNotFoundError:
-        schema = """
-        customers(id, name, country)
-        orders(id, customer_id, order_date, total_amount)
-        items(id, order_id, sku, product_name, qty, unit_price)
-        """
-    
+    # וידוא שהתשובה תקינה
+    if intent in ["sql", "viz"]:
+        state["intent"] = intent
+        state["intent_source"] = "llm"
+    else:
+        # fallback ללוגיקה פשוטה אם התשובה לא מוכרת
+        state["intent"] = keyword_intent(state["query"])
+        state["intent_source"] = "fallback"
+
+def lookup_sql(state, schema_fp):
+    """רשומת ה-cache לשאלה בלי להחיל אותה; plan_query ו-generate_sql (ב-fallback) משתמשים באותו חיפוש"""
+    if state.get("sql_cache_entry") is None:
+        state["sql_cache_entry"] = sql_cache.lookup(state["query"], schema_fp) or {}
+    return state["sql_cache_entry"] or None
+
+def apply_cached_sql(state, cached):
+    state["sql"] = cached["sql"]
+    state["notices"] = state.get("notices", []) + cached.get("notices", [])
+    state["sql_cache_hit"] = True
+
+def sql_from_cache(state, schema_fp):
+    """שאלה שכבר נענתה על אותה סכמה - בלי קריאה ל-LLM; מחזיר את הרשומה מה-cache"""
+    cached = lookup_sql(state, schema_fp)
+    if cached is not None:
+        apply_cached_sql(state, cached)
+    return cached
+
+def sql_from_example(state, schema_fp, examples):
+    """דוגמה מהימנה (seed / gold / accepted) שזהה כמעט לשאלה - ה-SQL שלה בלי קריאה ל-LLM"""
+    match = fewshot_index.exact(state["query"], examples)
+    if match is None:
+        return False
+    apply_generated_sql(state, schema_fp, match["sql"])
+    state["example_match"] = {"question": match["question"], "source": match["source"],
+                              "similarity": match["similarity"]}
+    return True
+
+def sql_request(query, schema, examples):
     prompt = f"""
 אתה עוזר AI שיוצר שאילתות PostgreSQL SELECT בלבד.
 
@@ -121,177 +217,328 @@ def generate_sql(state: GraphState):
 5. השתמש ב-ORDER BY ו-GROUP BY כשמתאים
 6. חזור רק עם השאילתה SQL, ללא הסברים, ללא JSON, ללא backticks
 7. תיצור SQL תקין
-8.  כשאתה בודק ערכים של מחרוזות (כמו שמות מדינות, מוצרים, שמות לקוחות) – 
+8.  כשאתה בודק ערכים של מחרוזות (כמו שמות מדינות, מוצרים, שמות לקוחות) –
    עטוף אותם תמיד במרכאות יחידות ('...').
 
 דוגמאות:
-- "תראה לי לקוחות" → SELECT * FROM customers LIMIT 10;
-- "הזמנות של לקוח 1" → SELECT * FROM orders WHERE customer_id = 1 LIMIT 10;
-- "תן לי את כל הלקוחות לא מישראל" → SELECT * FROM customers WHERE country != 'Israel' LIMIT 10;
+{format_examples(examples)}
 
 
 שאילתת המשתמש: {query}
 
 החזר רק את השאילתה SQL:"""
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": 200,
+    }
+
+def apply_generated_sql(state, schema_fp, text, **cache_extra):
+    """ניקוי ה-SQL שחזר מה-LLM, הוספת LIMIT ושמירה ב-cache"""
+    notices = state.get("notices", [])
+
+    # ניקוי השאילתה - הסרת backticks אם יש
+    sql = strip_code_fence(text.strip(), "sql")
 
+    # הסרת JSON אם ה-LLM החזיר JSON במקום SQL
+    if sql.startswith("{") and sql.endswith("}"):
+        try:
+            json_data = json.loads(sql)
+            sql = json_data.get("sql", sql)
+        except:
+            pass
+
+    # וידוא שהשאילתה מסתיימת ב-;
+    if not sql.endswith(";"):
+        sql += ";"
+
+    # בדיקה אם יש LIMIT בשאילתה החיצונית, אם לא - הוספה
+    added_notices = []
+    sql, limit_added = add_limit_to_sql(sql)
+    if limit_added:
+        added_notices.append(f"Added LIMIT {THRESHOLDS['default_limit']} for safety.")
+
+    state["sql"] = sql
+    state["notices"] = notices + added_notices
+    state["sql_cache_hit"] = False
+    sql_cache.store(state["query"], schema_fp, {"sql": sql, "notices": added_notices, **cache_extra})
+
+def combined_request(query, schema):
+    prompt = f"""
+אתה עוזר AI למערכת ניהול נתונים. עבור שאילתת המשתמש החזר אובייקט JSON יחיד עם המפתחות:
+- "intent": "sql" אם המשתמש רוצה נתונים טבלאיים, "viz" אם הוא רוצה גרף/תרשים/ויזואליזציה
+- "sql": שאילתת PostgreSQL SELECT אחת שעונה על השאלה
+- "action": "download" אם המשתמש מבקש להוריד/לייצא/לשמור את התוצאה, אחרת "display"
+
+השתמש בסכמה הבאה:
+{schema}
+
+הנחיות ל-SQL:
+1. צור רק שאילתות SELECT
+2. השתמש בשמות הטבלאות והעמודות המדויקים מהסכמה
+3. הוסף LIMIT אם לא צוין אחרת
+4. השתמש ב-JOINs, ORDER BY ו-GROUP BY כשמתאים
+5. עטוף ערכי מחרוזות במרכאות יחידות ('...')
+
+דוגמאות:
+- "תראה לי לקוחות" → {{"intent": "sql", "sql": "SELECT * FROM customers LIMIT 10;", "action": "display"}}
+- "תעשה לי גרף של המכירות לפי חודש" → {{"intent": "viz", "sql": "SELECT date_trunc('month', order_date) AS month, SUM(total_amount) AS revenue FROM orders GROUP BY 1 ORDER BY 1 LIMIT 12;", "action": "display"}}
+- "תייצא את ההזמנות של לקוח 1" → {{"intent": "sql", "sql": "SELECT * FROM orders WHERE customer_id = 1 LIMIT 1000;", "action": "download"}}
+
+שאילתת המשתמש: {query}
+
+החזר JSON בלבד:"""
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": 300,
+        "response_format": {"type": "json_object"},
+    }
+
+def apply_combined(state, schema_fp, response):
+    """מפענח את תשובת ה-combined; מחזיר False אם אי אפשר לסמוך עליה"""
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            max_tokens=200
-        )
-        
-        sql = response.choices[0].message.content.strip()
-        
-        # ניקוי השאילתה - הסרת backticks אם יש
-        if sql.startswith("```sql"):
-            sql = sql[6:]
-        if sql.startswith("```"):
-            sql = sql[3:]
-        if sql.endswith("```"):
-            sql = sql[:-3]
-        
-        sql = sql.strip()
-        
-        # הסרת JSON אם ה-LLM החזיר JSON במקום SQL
-        if sql.startswith("{") and sql.endswith("}"):
-            try:
-                import json
-                json_data = json.loads(sql)
-                sql = json_data.get("sql", sql)
-            except:
-                pass
-        
-        # וידוא שהשאילתה מסתיימת ב-;
-        if not sql.endswith(";"):
-            sql += ";"
-        
-        # בדיקה אם יש LIMIT, אם לא - הוספה
-        sql_upper = sql.upper()
-        if "LIMIT" not in sql_upper:
-            sql = sql.rstrip().rstrip(';')
-            sql += " LIMIT 10;"
-            notices.append("Added LIMIT 10 for safety.")
-            
-        state["sql"] = sql
-        state["notices"] = notices
-        
-    except Exception as e:
-        print(f"Error in generate_sql: {e}")
-        # fallback לשאילתה פשוטה במקרה של שגיאה
-        q = query.lower()
-        if "orders" in q:
-            state["sql"] = "SELECT * FROM orders LIMIT 5;"
-        else:
-            state["sql"] = "SELECT * FROM customers LIMIT 5;"
-        state["notices"] = notices
-    
-    return state
+        data = json.loads(strip_code_fence(response.choices[0].message.content.strip(), "json"))
+    except json.JSONDecodeError as e:
+        log.warning("failed to parse combined response: %s", e)
+        return False
+    if not isinstance(data, dict):
+        return False
 
-def apply_sql_guardrails(state: GraphState):
-    """מחיל guardrails על השאילתה"""
-    sql = state["sql"]
+    intent = str(data.get("intent", "")).strip().lower()
+    sql = data.get("sql")
+    action = str(data.get("action", "")).strip().lower()
+    if intent not in ("sql", "viz") or not isinstance(sql, str) or not sql.strip():
+        return False
+    if action not in ("display", "download"):
+        action = None
+
+    state["intent"] = intent
+    state["intent_source"] = "llm"
+    state["llm_action"] = action
+    apply_generated_sql(state, schema_fp, sql, intent=intent, action=action)
+    return True
+
+def plan_from_cache(state, schema_fp):
+    """cache hit עם intent (נשמר במצב combined) חוסך גם את הקריאה המשולבת"""
+    cached = lookup_sql(state, schema_fp)
+    if cached is None or not cached.get("intent"):
+        # בלי intent - ה-fallback ל-two_step; generate_sql יחיל את אותה רשומה (אם יגיע אליו)
+        return False
+    apply_cached_sql(state, cached)
+    state["intent"] = cached["intent"]
+    state["llm_action"] = cached.get("action")
+    return True
+
+def fallback_sql(state):
+    # fallback לשאילתה פשוטה במקרה של שגיאה
+    q = state["query"].lower()
+    if "orders" in q:
+        state["sql"] = "SELECT * FROM orders LIMIT 5;"
+    else:
+        state["sql"] = "SELECT * FROM customers LIMIT 5;"
+    state["notices"] = state.get("notices", [])
+
+def apply_guardrail_result(state, result):
+    state["sql"] = result["sql"]
+    state["notices"] = state.get("notices", []) + result.get("notices", [])
+    state["findings"] = result.get("findings", {})
+    state["reasons"] = result.get("reasons", [])   # <-- תמיד נשמר, גם אם ריק
+    state["guardrail_ok"] = result["ok"]
+    state["blocked"] = not result["ok"]
+
+    # אם השאילתה נחסמה
+    if not result["ok"]:
+        state["rows"] = []
+        state["findings"] = result["findings"]  # העברת findings ל-state
+        # חשיפה ישירה של הסיבות לחסימה
+        # לא מוסיפים notice על חסימה - זה יועבר דרך reason
+
+def explain_skipped(sql, static_findings):
+    """אין זמן ל-EXPLAIN: רק השלב הסטטי; ה-statement_timeout של ההרצה חוסם שאילתה יקרה"""
+    result = guardrail_result(sql, True, static_findings)
+    result["notices"].append("Cost check (EXPLAIN) skipped: the request deadline is nearly exhausted; "
+                             "execution is bounded by statement_timeout.")
+    return result
+
+def guardrail_failed(state, e):
     notices = state.get("notices", [])
-    
-    try:
-        # חיבור למסד הנתונים
-        DATABASE_URL = os.getenv("DATABASE_URL", "postgres://app:app@db:5432/demo")
-        conn = psycopg2.connect(DATABASE_URL)
-        
-        # החלת guardrails
-        result = apply_guardrails(conn, sql)
-        state["sql"] = result["sql"]
-        state["notices"] = state.get("notices", []) + result.get("notices", [])
-        state["findings"] = result.get("findings", {})
-        state["reasons"] = result.get("reasons", [])   # <-- תמיד נשמר, גם אם ריק
-        state["guardrail_ok"] = result["ok"]
-        state["blocked"] = not result["ok"]
-                
-        # אם השאילתה נחסמה
-        if not result["ok"]:
-            state["rows"] = []
-            state["findings"] = result["findings"]  # העברת findings ל-state
-            # חשיפה ישירה של הסיבות לחסימה
-            # לא מוסיפים notice על חסימה - זה יועבר דרך reason
-            conn.close()
-            return state
-        
-        conn.close()
-        
-    except Exception as e:
-        print(f"Error in apply_sql_guardrails: {e}")
-        notices.append(f"Guardrail check failed: {str(e)}")
-        notices.append("Skipping guardrails and proceeding with query execution")
-        state["notices"] = notices
-        state["guardrail_ok"] = True  # ממשיך למרות השגיאה
-    
-    return state
+    log.error("apply_sql_guardrails failed: %s", e)
+    notices.append(f"Guardrail check failed: {str(e)}")
+    notices.append("Skipping guardrails and proceeding with query execution")
+    state["notices"] = notices
+    state["guardrail_ok"] = True  # ממשיך למרות השגיאה
 
-def execute_sql(state: GraphState):
-    """מריץ את השאילתה על מסד הנתונים"""
+def repair_request(query, sql, reasons, schema):
+    reasons = "\n".join(f"- {r}" for r in reasons) or "- Estimated cost too high."
+    prompt = f"""
+אתה עוזר AI שמתקן שאילתות PostgreSQL SELECT כבדות.
+
+השתמש בסכמה הבאה:
+{schema}
+
+השאילתה הבאה נחסמה בבדיקת העלות (EXPLAIN):
+{sql}
+
+הסיבות:
+{reasons}
+
+כתוב שאילתה זולה יותר שעונה על אותה שאלה: תנאי סינון סלקטיבי (למשל טווח תאריכים),
+אגרגציה במקום שורות בודדות, או LIMIT קטן.
+חזור רק עם השאילתה SQL, ללא הסברים, ללא JSON, ללא backticks.
+
+שאילתת המשתמש: {query}
+
+החזר רק את השאילתה SQL:"""
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": 200,
+    }
+
+def repair_needed(state):
+    if deadline.expired(state) or not db_in_time(state):
+        return False
+    return state.get("guardrail_ok") is False and repair.repairable(state.get("sql", ""), state.get("findings"))
+
+def repair_search(state):
+    return repair.RepairSearch(state["sql"], state.get("findings"), has_time=lambda: db_in_time(state))
+
+def llm_repair(search, response):
+    tracing.record_llm(response)
+    sql = strip_code_fence(response.choices[0].message.content.strip(), "sql")
+    search.add(sql if sql.endswith(";") else sql + ";", "llm_feedback", "Rewritten by the LLM using the guardrail findings.")
+
+def apply_repair(state, search):
+    """הווריאנט הזול ביותר שעבר מחליף את השאילתה החסומה; הדוח נשמר ב-state["repair"] בכל מקרה"""
+    report = search.report()
+    tracing.record_repair(report["ok"], report.get("strategy"))
+    state["repair"] = report
+    best = search.best()
+    if best is None:
+        return
+    summary = f"Query was blocked by the guardrails and rewritten ({report['strategy']})"
+    if "cost_saved" in report:
+        summary += f"; estimated cost {report['original_cost']:.0f} -> {report['cost']:.0f}"
+    result = guardrail_result(best["sql"], True, best["findings"])
+    result["notices"] = best["notices"] + [summary + "."] + result["notices"]
+    apply_guardrail_result(state, result)
+
+def defer_to_stream(state):
+    """בקשת stream או ייצוא של טבלה: לא מחזיקים את השורות ב-state, ה-endpoint יזרים אותן"""
+    if state["intent"] == "sql" and (state.get("stream") or wants_download(state)):
+        state["streamed"] = True
+        state["rows"] = []
+        return True
+    return False
+
+def apply_result(state, result):
+    """שומר את התוצאה העמודתית; rows נבנים רק כשצריך אותם (פורמט rows או viz)"""
+    state["columns"] = result["columns"]
+    tracing.record_rows(len(result["data"][0]) if result["data"] else 0)
+    if state.get("result_format", "rows") != "rows" and state["intent"] == "sql":
+        state["columnar"] = result
+        state["rows"] = []
+    else:
+        state["rows"] = columns_to_rows(result)
+
+def result_params(budget):
+    # תוצאה שנחתכה בתקציב אחר היא תוצאה אחרת
+    return {"max_rows": budget.max_rows, "max_bytes": budget.max_bytes}
+
+def cached_result(state, budget):
+    """תוצאה מה-result cache (אותו SQL קנוני, הטבלאות שלו לא השתנו); False אם אין"""
+    cached = result_cache.get(state["sql"], result_params(budget))
+    if cached is None:
+        return False
+    apply_result(state, cached["result"])
+    if cached["truncated"]:
+        state["notices"] = state.get("notices", []) + [cached["truncated"]]
+        state["truncated"] = True
+    state["result_cache_hit"] = True
+    return True
+
+def store_result(state, result, budget, fresh):
+    """שומר ב-result cache רק תוצאה שנקראה מה-primary / replica בלי lag - אחרת תוצאה ישנה
+    הייתה נשמרת תחת הגרסאות החדשות מה-primary"""
+    if fresh:
+        result_cache.set(state["sql"], result, budget.exceeded, result_params(budget))
+
+def learn_example(state):
+    """FEWSHOT_LEARN: SQL שה-LLM כתב, רץ והחזיר שורות נוסף לדוגמאות הפרומפט (לא לקיצור בלי LLM)"""
+    if not FEWSHOT_CONFIG["learn"] or state.get("sql_cache_hit") is not False or state.get("example_match"):
+        return
+    if state.get("repair") or not (state.get("rows") or state.get("columnar")):
+        return
+    fewshot_index.add(state["query"], state["sql"], "learned")
+
+def apply_budget(state, budget):
+    if budget.exceeded:
+        state["notices"] = state.get("notices", []) + [budget.exceeded]
+        state["truncated"] = True
+
+def execution_failed(state, e):
+    if deadline.is_timeout(e):
+        # statement_timeout של ה-deadline - לא שגיאה, אין mock data
+        deadline.expire(state, "execute_sql")
+        return
     sql = state["sql"]
     notices = state.get("notices", [])
-    
-    try:
-        # חיבור למסד הנתונים
-        DATABASE_URL = os.getenv("DATABASE_URL", "postgres://app:app@db:5432/demo")
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        # הרצת השאילתה
-        cur.execute(sql)
-        rows = cur.fetchall()
-        colnames = [desc[0] for desc in cur.description]
-        
-        # המרה לרשימת dictionaries עם המרת JSON
+    log.error("execute_sql failed: %s", e)
+    notices.append(f"SQL execution failed: {str(e)}")
+    notices.append("Using mock data instead")
+    state["notices"] = notices
+
+    # Fallback לנתונים mock
+    if "customers" in sql.lower():
+        state["rows"] = [
+            {"id": 1, "name": "Alice", "country": "United States"},
+            {"id": 2, "name": "Bob", "country": "United Kingdom"},
+            {"id": 3, "name": "Charlie", "country": "Germany"},
+        ]
+    elif "orders" in sql.lower():
+        state["rows"] = [
+            {"id": 1, "customer_id": 1, "order_date": "2024-01-15", "total_amount": 120.50},
+            {"id": 2, "customer_id": 2, "order_date": "2024-01-16", "total_amount": 89.99},
+        ]
+    else:
         state["rows"] = []
-        for row in rows:
-            row_dict = {}
-            for i, value in enumerate(row):
-                colname = colnames[i]
-                row_dict[colname] = convert_to_json_serializable(value)
-            state["rows"].append(row_dict)
-        
-        cur.close()
-        conn.close()
-        
-        
-        
-    except Exception as e:
-        print(f"Error in execute_sql: {e}")
-        notices.append(f"SQL execution failed: {str(e)}")
-        notices.append("Using mock data instead")
-        state["notices"] = notices
-        
-        # Fallback לנתונים mock
-        if "customers" in sql.lower():
-            state["rows"] = [
-                {"id": 1, "name": "Alice", "country": "United States"},
-                {"id": 2, "name": "Bob", "country": "United Kingdom"},
-                {"id": 3, "name": "Charlie", "country": "Germany"},
-            ]
-        elif "orders" in sql.lower():
-            state["rows"] = [
-                {"id": 1, "customer_id": 1, "order_date": "2024-01-15", "total_amount": 120.50},
-                {"id": 2, "customer_id": 2, "order_date": "2024-01-16", "total_amount": 89.99},
-            ]
-        else:
-            state["rows"] = []
-    
-    return state
 
-def generate_viz_spec(state: GraphState):
-    rows = state["rows"]
-    query = state["query"]
-    
-    if not rows:
-        state["viz_spec"] = {"mark": "text", "text": "No data available"}
-        return state
-    
+def reduction_plan(state):
+    """תוכנית הקטנה לנתוני הגרף (None אם יש מעט שורות או שההרצה נכשלה)"""
+    if state.get("guardrail_ok") is False or not state.get("rows"):
+        return None
+    return viz_reduce.plan_reduction(state["sql"], state["rows"], state.get("columns"))
+
+def apply_reduction(state, plan, result=None):
+    """מחליף את השורות בתוצאה המוקטנת (מ-Postgres, או LTTB/דגימה מקומית אם אין result)"""
+    before = len(state["rows"])
+    if result is not None:
+        state["rows"] = columns_to_rows(result)
+        state["columns"] = result["columns"]
+        source, how = "sql", plan["description"]
+        # השאילתה המוקטנת רצה על כל התוצאה, לא רק על מה שנכנס לתקציב
+        if state.get("truncated"):
+            state["notices"] = [n for n in state.get("notices", []) if not n.startswith("Result truncated")]
+            state["truncated"] = False
+    else:
+        state["rows"], how = viz_reduce.reduce_locally(plan, state["rows"])
+        source = "local"
+    state["viz_reduction"] = {"strategy": plan["strategy"], "source": source,
+                              "rows_before": before, "rows_after": len(state["rows"])}
+    if plan["strategy"] == "bin" and source == "sql":
+        state["viz_reduction"]["fields"] = [plan["fields"]["measure"]["name"], plan["fields"]["end"]]
+    state["notices"] = state.get("notices", []) + [
+        f"Reduced {before} rows to {len(state['rows'])} chart points ({how})."
+    ]
+
+def viz_request(query, rows, field_types=None):
     # יצירת prompt ל-Vega-Lite
     sample_data = rows[:5] if len(rows) > 5 else rows  # דוגמה של הנתונים
-    
+
     prompt = f"""
 You are a Vega-Lite stylist. Given data and user query, return a beautified Vega-Lite v5 JSON applying:
 
@@ -317,148 +564,668 @@ Style contract (must apply):
 - do not include data URLs; use {{"data": {{"values": ...}}}} only
 
 User query: {query}
+Field types: {field_types or "infer from the data"}
 Sample data: {sample_data}
 
 Return a valid Vega-Lite v5 JSON only (no prose)."""
+    return {
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": 500,
+    }
+
+def parse_viz_spec(response, rows):
+    # ניקוי התוצאה
+    viz_spec_text = strip_code_fence(response.choices[0].message.content.strip(), "json")
 
+    # המרה ל-JSON
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0,
-            max_tokens=500
-        )
-        
-        viz_spec_text = response.choices[0].message.content.strip()
-        
-        # ניקוי התוצאה
-        if viz_spec_text.startswith("```json"):
-            viz_spec_text = viz_spec_text[7:]
-        if viz_spec_text.startswith("```"):
-            viz_spec_text = viz_spec_text[3:]
-        if viz_spec_text.endswith("```"):
-            viz_spec_text = viz_spec_text[:-3]
-        
-        viz_spec_text = viz_spec_text.strip()
-        
-        # המרה ל-JSON
+        return json.loads(viz_spec_text)
+    except json.JSONDecodeError as e:
+        log.warning("failed to parse Vega-Lite spec: %s", e)
+        # fallback ל-spec פשוט
+        return viz.text_spec(rows)
+
+def speculation_needed(state):
+    """spec ספקולטיבי רק כשהכללים לא מכסים את מבנה העמודות (אחרת אין LLM לחסוך)"""
+    columns = state.get("viz_columns")
+    if not columns or not llm_in_time(state):
+        return False
+    return viz.recommend(state["query"], [], columns) is None
+
+def apply_speculation(state, response):
+    tracing.record_llm(response)
+    try:
+        state["speculative_viz"] = json.loads(strip_code_fence(response.choices[0].message.content.strip(), "json"))
+    except json.JSONDecodeError as e:
+        log.warning("failed to parse speculative Vega-Lite spec: %s", e)
+
+def use_speculation(state):
+    """אחרי ההרצה: ה-spec הספקולטיבי אם הוא עדיין מתאים (אותן עמודות כמו התוצאה בפועל); False אחרת"""
+    spec = state.get("speculative_viz")
+    if spec is None:
+        return False
+    actual = [c["name"] for c in state.get("columns") or []]
+    used = bool(state.get("rows")) and actual == [c["name"] for c in state.get("viz_columns") or []]
+    state["viz_speculation"] = "used" if used else "discarded"
+    tracing.record_speculation(used)
+    if used:
+        state["viz_spec"] = spec
+        state["viz_source"] = "llm"
+    return used
+
+def discard_speculation(state):
+    if state.get("speculative_viz") is not None:
+        state["viz_speculation"] = "discarded"
+        tracing.record_speculation(False)
+
+# ---------- Nodes ----------
+
+def detect_intent(state: GraphState):
+    deadline.start(state)
+    query = state["query"]
+    if local_intent(state):
+        return state
+    if not llm_in_time(state):
+        # אין זמן לקריאת LLM - הניחוש של המסווג המקומי
+        state["intent"] = keyword_intent(query)
+        state["intent_source"] = "fallback"
+        return state
+
+    try:
+        response = llm(client, state).chat.completions.create(**intent_request(query))
+        tracing.record_llm(response)
+        apply_intent(state, response)
+    except Exception as e:
+        log.error("detect_intent failed: %s", e)
+        # fallback ללוגיקה פשוטה במקרה של שגיאה
+        state["intent"] = keyword_intent(query)
+        state["intent_source"] = "fallback"
+
+    return state
+
+def generate_sql(state: GraphState):
+    # מפתח ה-cache לפי גרסת ה-schema המלא; לפרומפט רק הטבלאות הרלוונטיות
+    schema_fp = schema_index.fingerprint()
+    if sql_from_cache(state, schema_fp):
+        return state
+    # הדוגמאות הדומות ביותר מ-gold לפרומפט; דוגמה כמעט זהה - בלי LLM
+    examples = fewshot_index.prompt_examples(state["query"])
+    if sql_from_example(state, schema_fp, examples):
+        return state
+    if out_of_time(state, "generate_sql", deadline.DEADLINE_CONFIG["min_llm"]):
+        return state
+
+    try:
+        response = llm(client, state).chat.completions.create(
+            **sql_request(state["query"], schema_index.prompt_schema(state["query"]), examples))
+        tracing.record_llm(response)
+        apply_generated_sql(state, schema_fp, response.choices[0].message.content)
+    except Exception as e:
+        log.error("generate_sql failed: %s", e)
+        if not out_of_time(state, "generate_sql"):
+            fallback_sql(state)
+
+    return state
+
+def plan_query(state: GraphState):
+    """מצב combined: intent + sql + action בקריאת LLM אחת"""
+    deadline.start(state)
+    schema_fp = schema_index.fingerprint()
+    if plan_from_cache(state, schema_fp):
+        state["plan_ok"] = True
+        return state
+    if not llm_in_time(state):
+        # detect_intent (מקומי) ו-generate_sql יחליטו מה אפשר עוד לעשות
+        state["plan_ok"] = False
+        return state
+
+    try:
+        response = llm(client, state).chat.completions.create(**combined_request(state["query"], schema_index.prompt_schema(state["query"])))
+        tracing.record_llm(response)
+        state["plan_ok"] = apply_combined(state, schema_fp, response)
+    except Exception as e:
+        log.error("plan_query failed: %s", e)
+        state["plan_ok"] = False
+
+    return state
+
+def apply_rollups(state: GraphState):
+    """אגרגציה שאפשר לחשב מ-rollup ממומש משוכתבת אליו לפני ה-guardrails (בלי DB)"""
+    try:
+        rewritten = rollup_rewriter.rewrite(state.get("sql"))
+    except Exception as e:
+        log.error("apply_rollups failed: %s", e)
+        rewritten = None
+    if rewritten is not None:
+        state["sql"], state["rollup"] = rewritten
+        state["notices"] = state.get("notices", []) + [f"Query rewritten to use the precomputed rollup {state['rollup']}."]
+    return state
+
+def apply_sql_guardrails(state: GraphState):
+    """מחיל guardrails על השאילתה"""
+    if deadline.expired(state):
+        return state
+    try:
+        # שלב סטטי בלי DB; רק שאילתות גבוליות ממשיכות ל-EXPLAIN
+        result, sql, static_findings = static_result(state["sql"])
+        if result is None and not db_in_time(state):
+            result = explain_skipped(sql, static_findings)
+        elif result is None:
+            # EXPLAIN על חיבור מה-pool (אותו session ישמש גם להרצה)
+            with db.checkout(readonly=True) as conn:
+                set_statement_timeout(conn, deadline.statement_timeout_ms(state))
+                result = apply_guardrails(conn, sql, static_findings=static_findings)
+        apply_guardrail_result(state, result)
+        if not result["ok"]:
+            out_of_time(state, "apply_sql_guardrails")
+    except Exception as e:
+        guardrail_failed(state, e)
+
+    return state
+
+def repair_sql(state: GraphState):
+    """שאילתה שנחסמה על עלות: וריאנטים זולים יותר (repair.py), כל אחד עובר EXPLAIN מחדש;
+    אם אף אחד לא עבר - ה-LLM פעם אחת עם ה-findings כ-feedback"""
+    if not repair_needed(state):
+        return state
+    search = repair_search(state)
+    try:
+        with db.checkout(readonly=True) as conn:
+            set_statement_timeout(conn, deadline.statement_timeout_ms(state))
+            best = repair.run(conn, search)
+        if best is None and repair.REPAIR_CONFIG["llm"] and llm_in_time(state):
+            schema = schema_index.prompt_schema(state["query"])
+            llm_repair(search, llm(client, state).chat.completions.create(
+                **repair_request(state["query"], state["sql"], state.get("reasons", []), schema)))
+            with db.checkout(readonly=True) as conn:
+                set_statement_timeout(conn, deadline.statement_timeout_ms(state))
+                repair.run(conn, search)
+        apply_repair(state, search)
+    except Exception as e:
+        log.error("repair_sql failed: %s", e)
+
+    return state
+
+def execute_sql(state: GraphState):
+    """מריץ את השאילתה על מסד הנתונים"""
+    if defer_to_stream(state) or out_of_time(state, "execute_sql"):
+        return state
+
+    budget = RowBudget()
+    try:
+        # גרסאות הטבלאות מה-primary, ו-hit לא תופס חיבור מה-pool
+        result_cache.check_versions()
+        if cached_result(state, budget):
+            learn_example(state)
+            return state
+        # חיבור מה-pool (או החיבור של הבקשה); server-side cursor עם תקציב שורות,
+        # ו-statement_timeout של מה שנשאר מה-deadline
+        with db.checkout(readonly=True) as conn:
+            set_statement_timeout(conn, deadline.statement_timeout_ms(state))
+            result = fetch_columnar(conn, state["sql"], budget)
+            fresh = db.fresh_read()
+        apply_result(state, result)
+        apply_budget(state, budget)
+        store_result(state, result, budget, fresh)
+        learn_example(state)
+    except Exception as e:
+        execution_failed(state, e)
+
+    return state
+
+def reduce_viz_data(state: GraphState):
+    """מקטין את נתוני הגרף ל-VIZ_MAX_POINTS: GROUP BY / date_trunc / width_bucket ב-Postgres"""
+    plan = reduction_plan(state)
+    if plan is None:
+        return state
+
+    result = None
+    # בלי זמן לשאילתה נוספת - הקטנה מקומית על מה שכבר יש
+    if plan["sql"] and db_in_time(state):
         try:
-            viz_spec = json.loads(viz_spec_text)
-            state["viz_spec"] = viz_spec
-        except json.JSONDecodeError as e:
-            print(f"Error parsing Vega-Lite spec: {e}")
-            # fallback ל-spec פשוט
-            state["viz_spec"] = create_fallback_viz_spec(rows)
-        
+            with db.checkout(readonly=True) as conn:
+                set_statement_timeout(conn, deadline.statement_timeout_ms(state))
+                result = fetch_columnar(conn, plan["sql"], RowBudget())
+        except Exception as e:
+            log.warning("reduce_viz_data failed, reducing locally: %s", e)
+    apply_reduction(state, plan, result)
+    return state
+
+def local_viz_spec(state):
+    """spec מהכללים (בלי LLM); False אם צריך את ה-stylist"""
+    rows = state["rows"]
+    if not rows:
+        state["viz_spec"] = viz.text_spec(rows)
+        state["viz_source"] = "rules"
+        return True
+    spec = viz.recommend(state["query"], rows, state.get("columns"), state.get("viz_reduction"))
+    if spec is None and viz.VIZ_CONFIG["llm_stylist"]:
+        return False
+    state["viz_spec"] = spec or viz.text_spec(rows)
+    state["viz_source"] = "rules" if spec else "fallback"
+    return True
+
+def generate_viz_spec(state: GraphState):
+    if local_viz_spec(state):
+        return state
+
+    rows = state["rows"]
+    if out_of_time(state, "generate_viz_spec", deadline.DEADLINE_CONFIG["min_llm"]):
+        state["viz_spec"] = viz.text_spec(rows)
+        state["viz_source"] = "fallback"
+        return state
+    try:
+        response = llm(client, state).chat.completions.create(**viz_request(state["query"], rows, viz.field_types(rows, state.get("columns"))))
+        tracing.record_llm(response)
+        state["viz_spec"] = parse_viz_spec(response, rows)
+        state["viz_source"] = "llm"
     except Exception as e:
-        print(f"Error in generate_viz_spec: {e}")
+        log.error("generate_viz_spec failed: %s", e)
+        out_of_time(state, "generate_viz_spec")
         # fallback ל-spec פשוט
-        state["viz_spec"] = create_fallback_viz_spec(rows)
-    
+        state["viz_spec"] = viz.text_spec(rows)
+        state["viz_source"] = "fallback"
+
     return state
 
-def create_fallback_viz_spec(rows):
-    """יוצר Vega-Lite spec פשוט כגיבוי"""
-    if not rows:
-        return {"mark": "text", "text": "No data available"}
-    
-    available_fields = list(rows[0].keys())
-    
-    # בחירת שדות מתאימים
-    x_field = None
-    y_field = None
-    
-    # חיפוש שדה טקסטואלי עבור X
-    for field in ["name", "customer_name", "product_name", "category"]:
-        if field in available_fields:
-            x_field = field
-            break
-    
-    # חיפוש שדה מספרי עבור Y
-    for field in ["total_amount", "orders_count", "count", "amount", "price", "quantity"]:
-        if field in available_fields:
-            y_field = field
-            break
-    
-    # אם לא נמצאו שדות מתאימים, נשתמש בשדות הראשונים
-    if not x_field:
-        x_field = available_fields[0]
-    if not y_field and len(available_fields) > 1:
-        y_field = available_fields[1]
-    
-    # יצירת spec עם styling
-    if y_field:
-        return {
-            "width": 720,
-            "height": 420,
-            "background": "white",
-            "padding": {"left": 10, "right": 10, "top": 10, "bottom": 10},
-            "config": {
-                "view": {"stroke": None},
-                "font": "Inter, Arial, sans-serif",
-                "axis": {
-                    "labelFontSize": 12,
-                    "titleFontSize": 13,
-                    "grid": True,
-                    "gridOpacity": 0.25,
-                    "labelColor": "#334155",
-                    "titleColor": "#334155",
-                    "tickColor": "#CBD5E1"
-                },
-                "legend": {"labelFontSize": 12, "titleFontSize": 13, "orient": "bottom"}
-            },
-            "mark": {"type": "bar", "cornerRadius": 4, "binSpacing": 2},
-            "encoding": {
-                "x": {"field": x_field, "type": "ordinal", "labelAngle": -30, "labelLimit": 140},
-                "y": {"field": y_field, "type": "quantitative", "nice": True, "axis": {"format": "~s"}},
-                "color": {"scheme": "tableau10"}
-            },
-            "title": "Data Visualization"
-        }
-    else:
-        return {
-            "width": 720,
-            "height": 420,
-            "background": "white",
-            "padding": {"left": 10, "right": 10, "top": 10, "bottom": 10},
-            "mark": "text",
-            "encoding": {
-                "text": {"field": x_field, "type": "nominal"}
-            },
-            "title": "Data List"
-        }
+def start_request(state: GraphState):
+    """הגרף המקבילי: ה-deadline מתחיל לפני שהענפים מתפצלים (כולם רואים את אותו state)"""
+    deadline.start(state)
+    return state
 
-def decide_action(state: GraphState):
+def speculate_viz(state: GraphState):
+    """הגרף המקבילי, במקביל ל-execute_sql: מבנה העמודות (LIMIT 0, על חיבור נפרד) ואז ה-stylist עליו.
+    node אחד ולא שניים - LangGraph מריץ בשלבים, ו-node שני היה מחכה לסוף ההרצה"""
+    if not SPECULATIVE_VIZ or not viz.VIZ_CONFIG["llm_stylist"] or not db_in_time(state):
+        return state
+    try:
+        with db.checkout(scoped=False, readonly=True) as conn:
+            set_statement_timeout(conn, deadline.statement_timeout_ms(state))
+            state["viz_columns"] = describe(conn, state["sql"])
+    except Exception as e:
+        log.warning("describe_sql failed: %s", e)
+    if not speculation_needed(state):
+        return state
+    try:
+        apply_speculation(state, llm(client, state).chat.completions.create(
+            **viz_request(state["query"], [], viz.field_types([], state["viz_columns"]))))
+    except Exception as e:
+        log.warning("speculate_viz failed: %s", e)
+    return state
+
+def finish_viz(state: GraphState):
+    """אחרי ההרצה וההקטנה: הכללים על השורות האמיתיות, אחרת ה-spec הספקולטיבי, אחרת generate_viz_spec"""
+    if local_viz_spec(state):
+        discard_speculation(state)
+        return state
+    if use_speculation(state):
+        return state
+    return generate_viz_spec(state)
+
+# ---------- Async nodes (ל-graph.ainvoke) ----------
+
+async def adetect_intent(state: GraphState):
+    deadline.start(state)
+    query = state["query"]
+    if local_intent(state):
+        return state
+    if not llm_in_time(state):
+        # אין זמן לקריאת LLM - הניחוש של המסווג המקומי
+        state["intent"] = keyword_intent(query)
+        state["intent_source"] = "fallback"
+        return state
+
+    try:
+        response = await llm(aclient, state).chat.completions.create(**intent_request(query))
+        tracing.record_llm(response)
+        apply_intent(state, response)
+    except Exception as e:
+        log.error("detect_intent failed: %s", e)
+        state["intent"] = keyword_intent(query)
+        state["intent_source"] = "fallback"
+
+    return state
+
+async def agenerate_sql(state: GraphState):
+    # מפתח ה-cache לפי גרסת ה-schema המלא; לפרומפט רק הטבלאות הרלוונטיות
+    schema_fp = schema_index.fingerprint()
+    if sql_from_cache(state, schema_fp):
+        return state
+    # הדוגמאות הדומות ביותר מ-gold לפרומפט; דוגמה כמעט זהה - בלי LLM
+    examples = fewshot_index.prompt_examples(state["query"])
+    if sql_from_example(state, schema_fp, examples):
+        return state
+    if out_of_time(state, "generate_sql", deadline.DEADLINE_CONFIG["min_llm"]):
+        return state
+
+    try:
+        response = await llm(aclient, state).chat.completions.create(
+            **sql_request(state["query"], schema_index.prompt_schema(state["query"]), examples))
+        tracing.record_llm(response)
+        apply_generated_sql(state, schema_fp, response.choices[0].message.content)
+    except Exception as e:
+        log.error("generate_sql failed: %s", e)
+        if not out_of_time(state, "generate_sql"):
+            fallback_sql(state)
+
+    return state
+
+async def aplan_query(state: GraphState):
+    deadline.start(state)
+    schema_fp = schema_index.fingerprint()
+    if plan_from_cache(state, schema_fp):
+        state["plan_ok"] = True
+        return state
+    if not llm_in_time(state):
+        # detect_intent (מקומי) ו-generate_sql יחליטו מה אפשר עוד לעשות
+        state["plan_ok"] = False
+        return state
+
+    try:
+        response = await llm(aclient, state).chat.completions.create(**combined_request(state["query"], schema_index.prompt_schema(state["query"])))
+        tracing.record_llm(response)
+        state["plan_ok"] = apply_combined(state, schema_fp, response)
+    except Exception as e:
+        log.error("plan_query failed: %s", e)
+        state["plan_ok"] = False
+
+    return state
+
+async def aapply_sql_guardrails(state: GraphState):
+    if deadline.expired(state):
+        return state
+    try:
+        result, sql, static_findings = static_result(state["sql"])
+        if result is None and not db_in_time(state):
+            result = explain_skipped(sql, static_findings)
+        elif result is None:
+            async with db.acheckout(readonly=True) as conn:
+                await aset_statement_timeout(conn, deadline.statement_timeout_ms(state))
+                result = await aapply_guardrails(conn, sql, static_findings=static_findings)
+        apply_guardrail_result(state, result)
+        if not result["ok"]:
+            out_of_time(state, "apply_sql_guardrails")
+    except Exception as e:
+        guardrail_failed(state, e)
+
+    return state
+
+async def arepair_sql(state: GraphState):
+    if not repair_needed(state):
+        return state
+    search = repair_search(state)
+    try:
+        async with db.acheckout(readonly=True) as conn:
+            await aset_statement_timeout(conn, deadline.statement_timeout_ms(state))
+            best = await repair.arun(conn, search)
+        if best is None and repair.REPAIR_CONFIG["llm"] and llm_in_time(state):
+            schema = schema_index.prompt_schema(state["query"])
+            llm_repair(search, await llm(aclient, state).chat.completions.create(
+                **repair_request(state["query"], state["sql"], state.get("reasons", []), schema)))
+            async with db.acheckout(readonly=True) as conn:
+                await aset_statement_timeout(conn, deadline.statement_timeout_ms(state))
+                await repair.arun(conn, search)
+        apply_repair(state, search)
+    except Exception as e:
+        log.error("repair_sql failed: %s", e)
+
+    return state
+
+async def aexecute_sql(state: GraphState):
+    if defer_to_stream(state) or out_of_time(state, "execute_sql"):
+        return state
+
+    budget = RowBudget()
+    try:
+        await result_cache.acheck_versions()
+        if cached_result(state, budget):
+            learn_example(state)
+            return state
+        async with db.acheckout(readonly=True) as conn:
+            await aset_statement_timeout(conn, deadline.statement_timeout_ms(state))
+            result = await afetch_columnar(conn, state["sql"], budget)
+            fresh = db.fresh_read()
+        apply_result(state, result)
+        apply_budget(state, budget)
+        store_result(state, result, budget, fresh)
+        learn_example(state)
+    except Exception as e:
+        execution_failed(state, e)
+
+    return state
+
+async def areduce_viz_data(state: GraphState):
+    plan = reduction_plan(state)
+    if plan is None:
+        return state
+
+    result = None
+    if plan["sql"] and db_in_time(state):
+        try:
+            async with db.acheckout(readonly=True) as conn:
+                await aset_statement_timeout(conn, deadline.statement_timeout_ms(state))
+                result = await afetch_columnar(conn, plan["sql"], RowBudget())
+        except Exception as e:
+            log.warning("reduce_viz_data failed, reducing locally: %s", e)
+    apply_reduction(state, plan, result)
+    return state
+
+async def agenerate_viz_spec(state: GraphState):
+    if local_viz_spec(state):
+        return state
+
+    rows = state["rows"]
+    if out_of_time(state, "generate_viz_spec", deadline.DEADLINE_CONFIG["min_llm"]):
+        state["viz_spec"] = viz.text_spec(rows)
+        state["viz_source"] = "fallback"
+        return state
+    try:
+        response = await llm(aclient, state).chat.completions.create(**viz_request(state["query"], rows, viz.field_types(rows, state.get("columns"))))
+        tracing.record_llm(response)
+        state["viz_spec"] = parse_viz_spec(response, rows)
+        state["viz_source"] = "llm"
+    except Exception as e:
+        log.error("generate_viz_spec failed: %s", e)
+        out_of_time(state, "generate_viz_spec")
+        state["viz_spec"] = viz.text_spec(rows)
+        state["viz_source"] = "fallback"
+
+    return state
+
+async def aspeculate_viz(state: GraphState):
+    if not SPECULATIVE_VIZ or not viz.VIZ_CONFIG["llm_stylist"] or not db_in_time(state):
+        return state
+    try:
+        async with db.acheckout(scoped=False, readonly=True) as conn:
+            await aset_statement_timeout(conn, deadline.statement_timeout_ms(state))
+            state["viz_columns"] = await adescribe(conn, state["sql"])
+    except Exception as e:
+        log.warning("describe_sql failed: %s", e)
+    if not speculation_needed(state):
+        return state
+    try:
+        apply_speculation(state, await llm(aclient, state).chat.completions.create(
+            **viz_request(state["query"], [], viz.field_types([], state["viz_columns"]))))
+    except Exception as e:
+        log.warning("speculate_viz failed: %s", e)
+    return state
+
+async def afinish_viz(state: GraphState):
+    if local_viz_spec(state):
+        discard_speculation(state)
+        return state
+    if use_speculation(state):
+        return state
+    return await agenerate_viz_spec(state)
+
+def wants_download(state):
     q = state["query"].lower()
     if "download" in q or "export" in q or "save" in q:
+        return True
+    # במצב combined ה-LLM כבר החליט (למשל "תייצא" / "להוריד" שאין בהם מילת מפתח)
+    return state.get("llm_action") == "download"
+
+def decide_action(state: GraphState):
+    if wants_download(state):
         state["action"] = "download"
     else:
         state["action"] = "display"
     return state
 
 def download_node(state: GraphState):
-    path = save_to_csv(state["rows"])
-    state["file_path"] = path
+    # הייצוא עצמו מוזרם מה-endpoint ישירות מה-DB (export.py), בלי קובץ זמני
     return state
 
 def display_node(state: GraphState):
     return state
 
+def sql_ready(state: GraphState):
+    # סוף ענף ה-SQL בגרף המקבילי (אחרי guardrails / repair)
+    return state
+
+def sql_blocked(state):
+    # חסום ב-guardrails, או שה-deadline נגמר לפני שהיה SQL
+    return not state.get("guardrail_ok", True) or not state.get("sql")
+
+def join_plan(state: GraphState):
+    # נקודת המפגש של intent, action וה-SQL; decide_action רץ לפני ה-guardrails -
+    # שאילתה חסומה לא יורדת כקובץ (ה-export היה מריץ אותה בלי guardrails)
+    if sql_blocked(state):
+        state["action"] = "display"
+    return state
+
 # ---------- Build Graph ----------
 
-def build_graph():
+def partial_update(fn):
+    """node בגרף המקבילי: רץ על עותק של ה-state ומחזיר רק מה שהשתנה (notices כ-added/removed),
+    כדי שענפים שרצים באותו שלב לא יכתבו אותו מפתח"""
+    def snapshot(state):
+        return {key: copy.copy(value) if isinstance(value, (list, dict)) else value for key, value in state.items()}
+
+    def changes(state, updated):
+        changed = {key: value for key, value in updated.items()
+                   if key not in state or (value is not state[key] and value != state[key])}
+        if "notices" in changed:
+            before = state.get("notices") or []
+            changed["notices"] = {"added": [n for n in changed["notices"] if n not in before],
+                                  "removed": [n for n in before if n not in changed["notices"]]}
+        return changed
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def node(state):
+            return changes(state, await fn(snapshot(state)))
+    else:
+        @functools.wraps(fn)
+        def node(state):
+            return changes(state, fn(snapshot(state)))
+    return node
+
+def route_planned(state):
+    """אחרי המפגש: חסום / בלי SQL -> display; viz -> ההרצה וה-spec הספקולטיבי במקביל; sql -> ההרצה"""
+    if sql_blocked(state):
+        return "display_node"
+    if state["intent"] == "viz":
+        return ["execute_sql", "speculate_viz"]
+    return "execute_sql"
+
+def build_parallel_graph(use_async=False):
+    """מצב parallel: intent ו-action במקביל ל-generate_sql -> guardrails, ול-viz -
+    spec ספקולטיבי מ-LIMIT 0 במקביל להרצה. כל node מחזיר רק את מה ששינה (partial_update)"""
+    graph = StateGraph(ParallelGraphState)
+    add_node = lambda name, fn: graph.add_node(name, tracing.traced(name, partial_update(fn)))
+
+    add_node("start_request", start_request)
+    add_node("detect_intent", adetect_intent if use_async else detect_intent)
+    add_node("generate_sql", agenerate_sql if use_async else generate_sql)
+    add_node("apply_rollups", apply_rollups)
+    add_node("apply_sql_guardrails", aapply_sql_guardrails if use_async else apply_sql_guardrails)
+    add_node("repair_sql", arepair_sql if use_async else repair_sql)
+    add_node("sql_ready", sql_ready)
+    add_node("decide_action", decide_action)
+    add_node("join_plan", join_plan)
+    add_node("execute_sql", aexecute_sql if use_async else execute_sql)
+    add_node("speculate_viz", aspeculate_viz if use_async else speculate_viz)
+    add_node("reduce_viz_data", areduce_viz_data if use_async else reduce_viz_data)
+    add_node("finish_viz", afinish_viz if use_async else finish_viz)
+    add_node("download_node", download_node)
+    add_node("display_node", display_node)
+
+    graph.set_entry_point("start_request")
+    # שלושה ענפים במקביל; join_plan מחכה לשלושתם
+    graph.add_edge("start_request", "detect_intent")
+    graph.add_edge("start_request", "decide_action")
+    graph.add_edge("start_request", "generate_sql")
+    graph.add_edge("generate_sql", "apply_rollups")
+    graph.add_edge("apply_rollups", "apply_sql_guardrails")
+    graph.add_conditional_edges(
+        "apply_sql_guardrails",
+        lambda s: s.get("guardrail_ok", True),
+        {
+            True: "sql_ready",
+            False: "repair_sql"
+        }
+    )
+    graph.add_edge("repair_sql", "sql_ready")
+    graph.add_edge(["detect_intent", "decide_action", "sql_ready"], "join_plan")
+    graph.add_conditional_edges("join_plan", route_planned, ["execute_sql", "speculate_viz", "display_node"])
+
+    route_action = {"download": "download_node", "display": "display_node"}
+    graph.add_conditional_edges(
+        "execute_sql",
+        lambda s: s["action"] if s["intent"] == "sql" else "viz",
+        {**route_action, "viz": "reduce_viz_data"}
+    )
+    # ה-spec הסופי מחכה גם להרצה (והקטנה) וגם לספקולציה
+    graph.add_edge(["reduce_viz_data", "speculate_viz"], "finish_viz")
+    graph.add_conditional_edges("finish_viz", lambda s: s["action"], route_action)
+
+    graph.add_edge("download_node", END)
+    graph.add_edge("display_node", END)
+
+    return graph.compile()
+
+def build_graph(use_async=False, mode=None):
+    """בונה את הגרף; use_async=True רושם את ה-nodes האסינכרוניים (להרצה עם ainvoke).
+    mode: "two_step" / "combined" / "parallel" (ברירת מחדל: NL2SQL_PIPELINE_MODE)"""
+    mode = mode or PIPELINE_MODE
+    if mode == "parallel":
+        return build_parallel_graph(use_async)
+    if mode not in ("two_step", "combined"):
+        raise ValueError(f"Unknown pipeline mode: {mode}")
     graph = StateGraph(GraphState)
+    # כל node עטוף ב-tracing (זמן, טוקנים, זמן DB, verdict -> /metrics ולוג לכל בקשה)
+    add_node = lambda name, fn: graph.add_node(name, tracing.traced(name, fn))
 
-    graph.add_node("detect_intent", detect_intent)
-    graph.add_node("generate_sql", generate_sql)
-    graph.add_node("apply_sql_guardrails", apply_sql_guardrails)
-    graph.add_node("execute_sql", execute_sql)
-    graph.add_node("generate_viz_spec", generate_viz_spec)
-    graph.add_node("decide_action", decide_action)
-    graph.add_node("download_node", download_node)
-    graph.add_node("display_node", display_node)
+    if mode == "combined":
+        add_node("plan_query", aplan_query if use_async else plan_query)
+    add_node("detect_intent", adetect_intent if use_async else detect_intent)
+    add_node("generate_sql", agenerate_sql if use_async else generate_sql)
+    add_node("apply_rollups", apply_rollups)
+    add_node("apply_sql_guardrails", aapply_sql_guardrails if use_async else apply_sql_guardrails)
+    add_node("repair_sql", arepair_sql if use_async else repair_sql)
+    add_node("execute_sql", aexecute_sql if use_async else execute_sql)
+    add_node("reduce_viz_data", areduce_viz_data if use_async else reduce_viz_data)
+    add_node("generate_viz_spec", agenerate_viz_spec if use_async else generate_viz_spec)
+    add_node("decide_action", decide_action)
+    add_node("download_node", download_node)
+    add_node("display_node", display_node)
 
-    graph.set_entry_point("detect_intent")
+    if mode == "combined":
+        graph.set_entry_point("plan_query")
+        # תשובה משולבת תקינה - ישר ל-guardrails; אחרת המסלול הרגיל
+        graph.add_conditional_edges(
+            "plan_query",
+            lambda s: s.get("plan_ok", False),
+            {
+                True: "apply_rollups",
+                False: "detect_intent",
+            }
+        )
+    else:
+        graph.set_entry_point("detect_intent")
 
     graph.add_conditional_edges(
         "detect_intent",
@@ -469,12 +1236,22 @@ def build_graph():
         }
     )
 
-    graph.add_edge("generate_sql", "apply_sql_guardrails")
+    graph.add_edge("generate_sql", "apply_rollups")
+    graph.add_edge("apply_rollups", "apply_sql_guardrails")
     
-    # בדיקת guardrails - אם נחסם, עובר ישר ל-display
+    # בדיקת guardrails - אם נחסם, ניסיון תיקון; אם גם הוא נכשל - ישר ל-display
     graph.add_conditional_edges(
         "apply_sql_guardrails",
         lambda s: s.get("guardrail_ok", True),
+        {
+            True: "execute_sql",
+            False: "repair_sql"
+        }
+    )
+
+    graph.add_conditional_edges(
+        "repair_sql",
+        lambda s: s.get("guardrail_ok", True),
         {
             True: "execute_sql",
             False: "display_node"
@@ -487,10 +1264,11 @@ def build_graph():
         lambda s: s["intent"],
         {
             "sql": "decide_action",
-            "viz": "generate_viz_spec",
+            "viz": "reduce_viz_data",
         }
     )
 
+    graph.add_edge("reduce_viz_data", "generate_viz_spec")
     graph.add_edge("generate_viz_spec", "decide_action")
 
     graph.add_conditional_edges(
@@ -1,6 +1,20 @@
 import psycopg2
 import json
+import os
 import re
+import threading
+import time
+
+import sqlglot
+from sqlglot import exp
+
+import db
+import sqlcheck
+import tracing
+from catalog import catalog
+from cache import MemoryCache, NullCache, fingerprint
+
+log = tracing.get_logger("guardrails")
 
 THRESHOLDS = {
     "require_limit": True,
@@ -10,8 +24,132 @@ THRESHOLDS = {
     "max_sort_rows_no_limit": 10_000,
     "max_nested_loop_sides": 5_000,
     "default_limit": 10,
+    "max_limit": 10_000,  # LIMIT גדול מזה מוקטן בשלב הסטטי
 }
 
+# טבלאות גדולות כשה-catalog לא נטען (אין DB בזמן העלייה)
+LARGE_TABLES = {t.strip() for t in os.getenv("GUARDRAIL_LARGE_TABLES", "orders,items").split(",") if t.strip()}
+
+def known_large_tables(thresholds=THRESHOLDS):
+    """טבלאות שסריקה מלאה שלהן כבדה: לפי אומדן השורות ב-catalog (אותו סף כמו Seq Scan ב-EXPLAIN)"""
+    if catalog.loaded:
+        return catalog.large_tables(thresholds["max_seqscan_rows"])
+    return LARGE_TABLES
+
+PLAN_CACHE_CONFIG = {
+    "enabled": os.getenv("GUARDRAIL_PLAN_CACHE", "1") == "1",
+    "max_entries": int(os.getenv("GUARDRAIL_PLAN_CACHE_MAX_ENTRIES", "2000")),
+    "ttl": float(os.getenv("GUARDRAIL_PLAN_CACHE_TTL", "600")) or None,
+    "stats_interval": float(os.getenv("GUARDRAIL_PLAN_CACHE_STATS_INTERVAL", "30")),  # שניות בין בדיקות גרסה
+}
+
+# גרסת ה-stats/schema: ANALYZE מעדכן את ה-counters, DDL משנה את ה-xmin של השורה ב-pg_class
+STATS_VERSION_SQL = """
+SELECT
+    (SELECT coalesce(sum(analyze_count + autoanalyze_count), 0) FROM pg_stat_user_tables),
+    (SELECT md5(coalesce(string_agg(c.oid::text || ':' || c.xmin::text, ',' ORDER BY c.oid), ''))
+       FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+      WHERE n.nspname NOT IN ('pg_catalog', 'information_schema') AND n.nspname NOT LIKE 'pg_toast%')
+"""
+
+def _keep_literal(node):
+    # ערכי LIMIT/OFFSET ומיקומים ב-ORDER BY / GROUP BY משנים את התוכנית;
+    # ערך בתנאי (WHERE / HAVING / ON) קובע את ה-selectivity - "pass" ל-customer_id = 1 לא תקף לכל ערך
+    if node.find_ancestor(exp.Limit, exp.Offset, exp.Fetch, exp.Where, exp.Having, exp.Join):
+        return True
+    return isinstance(node.parent, (exp.Ordered, exp.Group))
+
+def sql_fingerprint(sql):
+    """SQL מנורמל למפתח cache: literals שלא משפיעים על התוכנית (רשימת ה-SELECT, CASE) הופכים ל-placeholder,
+    עיצוב אחיד"""
+    try:
+        tree = sqlglot.parse_one(sql, read="postgres")
+    except sqlglot.errors.ParseError:
+        return " ".join(sql.split()).rstrip(";")
+
+    def parameterize(node):
+        if isinstance(node, exp.Literal) and not _keep_literal(node):
+            return exp.Placeholder()
+        return node
+
+    return tree.transform(parameterize).sql(dialect="postgres", normalize=True)
+
+class PlanCache:
+    """cache של (ok, findings) מ-EXPLAIN לפי fingerprint של ה-SQL.
+    מתרוקן כשגרסת ה-stats/schema משתנה (נבדק לכל היותר פעם ב-stats_interval)"""
+
+    def __init__(self, backend, stats_interval=30):
+        self.backend = backend
+        self.stats_interval = stats_interval
+        self._version = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._stats = {"version_checks": 0, "invalidations": 0}
+
+    def key(self, sql, thresholds):
+        return fingerprint(sql_fingerprint(sql) + json.dumps(thresholds, sort_keys=True))
+
+    def _due(self):
+        # רק בקשה אחת בכל חלון בודקת את הגרסה
+        now = time.monotonic()
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < self.stats_interval:
+                return False
+            self._checked_at = now
+            self._stats["version_checks"] += 1
+            return True
+
+    def _observe(self, version):
+        with self._lock:
+            changed = self._version is not None and version != self._version
+            self._version = version
+            if changed:
+                self._stats["invalidations"] += 1
+        if changed:
+            self.backend.clear()
+
+    def check_version(self):
+        """על חיבור נפרד ל-primary: ב-replica מוני ה-ANALYZE מקומיים ולא רואים את ה-ANALYZE של ה-primary"""
+        if not self._due():
+            return
+        try:
+            with db.checkout(scoped=False) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(STATS_VERSION_SQL)
+                    self._observe(tuple(cur.fetchone()))
+        except Exception as e:
+            log.warning("plan cache version check failed: %s", e)
+
+    async def acheck_version(self):
+        if not self._due():
+            return
+        try:
+            async with db.acheckout(scoped=False) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(STATS_VERSION_SQL)
+                    self._observe(tuple(await cur.fetchone()))
+        except Exception as e:
+            log.warning("plan cache version check failed: %s", e)
+
+    def get(self, key):
+        cached = self.backend.get(key)
+        if cached is None:
+            return None
+        # עותק - guardrail_result וה-graph מוסיפים ל-findings
+        return cached["ok"], json.loads(cached["findings"])
+
+    def set(self, key, ok, findings):
+        self.backend.set(key, {"ok": ok, "findings": json.dumps(findings)})
+
+    def stats(self):
+        with self._lock:
+            return {**self.backend.stats(), **self._stats, "stats_version": self._version}
+
+plan_cache = PlanCache(
+    MemoryCache(PLAN_CACHE_CONFIG["max_entries"], PLAN_CACHE_CONFIG["ttl"]) if PLAN_CACHE_CONFIG["enabled"] else NullCache(),
+    PLAN_CACHE_CONFIG["stats_interval"],
+)
+
 def explain_json(conn, sql):
     """מריץ EXPLAIN (FORMAT JSON) על השאילתה"""
     with conn.cursor() as cur:
@@ -19,6 +157,13 @@ def explain_json(conn, sql):
         # psycopg2 מחזיר מערך עם JSON יחיד
         return cur.fetchone()[0][0]  # dict: {"Plan": {...}, ...}
 
+async def aexplain_json(conn, sql):
+    """כמו explain_json, על חיבור psycopg אסינכרוני"""
+    async with conn.cursor() as cur:
+        await cur.execute("EXPLAIN (FORMAT JSON) " + sql)
+        row = await cur.fetchone()
+        return row[0][0]
+
 def has_limit_node(plan):
     """בודק אם יש Limit node בעץ התוכנית"""
     if plan.get("Node Type") == "Limit":
@@ -76,26 +221,24 @@ def walk_plan(plan, findings):
         walk_plan(child, findings)
 
 def add_limit_to_sql(sql, limit_value=None):
-    """מוסיף LIMIT לשאילתה אם אין"""
+    """מוסיף LIMIT לשאילתה החיצונית אם אין (LIMIT בתוך CTE/תת-שאילתה לא נחשב)"""
     if limit_value is None:
         limit_value = THRESHOLDS["default_limit"]
-    
-    # בדיקה אם יש כבר LIMIT
-    sql_upper = sql.upper()
-    if "LIMIT" in sql_upper:
+
+    try:
+        tree = sqlcheck.parse(sql)
+    except ValueError:
+        return sql, False  # לא מתפרסר - השלב הסטטי של ה-guardrails יחסום
+    if not isinstance(tree, sqlglot.exp.Query) or tree.args.get("limit") is not None:
         return sql, False  # כבר יש LIMIT
-    
-    # הוספת LIMIT בסוף
-    sql = sql.rstrip().rstrip(';')
-    sql_with_limit = f"{sql} LIMIT {limit_value};"
-    
-    return sql_with_limit, True
 
-def explain_guardrail(conn, sql, thresholds=THRESHOLDS):
-    """מריץ guardrail על השאילתה"""
-    findings = {
+    return sqlcheck.with_limit(sql, tree, limit_value), True
+
+def new_findings():
+    return {
         "limit_present": False,
         "root_rows": 0,
+        "total_cost": None,  # Total Cost של שורש התוכנית (לדיווח על החיסכון ב-auto-repair)
         "max_node_bytes": 0,
         "max_node_rows": 0,
         "seq_scans_heavy": [],
@@ -103,70 +246,147 @@ def explain_guardrail(conn, sql, thresholds=THRESHOLDS):
         "nested_loop_heavy": [],
         "large_aggregates": [],
         "possible_cross_join": False,
+        "cartesian_joins": [],
+        "unbounded_scans": [],
+        "static": False,  # הוכרע בשלב הסטטי, בלי EXPLAIN
         "reasons": [],
         "notices": []
     }
-    
+
+def evaluate_plan(plan_root, sql, thresholds=THRESHOLDS):
+    """מחיל את הכללים על תוכנית EXPLAIN ומחזיר (ok, findings)"""
+    findings = new_findings()
+    ok = True
+    log.debug("evaluating plan", extra={"fields": {"sql": sql, "plan": plan_root}})
+    findings["limit_present"] = has_limit_node(plan_root)
+    findings["root_rows"] = int(plan_root.get("Plan Rows", 0) or 0)
+    findings["total_cost"] = float(plan_root.get("Total Cost", 0) or 0)
+    walk_plan(plan_root, findings)
+    # כללים
+    if thresholds["require_limit"] and not findings["limit_present"]:
+        findings["notices"].append("Query has no LIMIT, adding LIMIT.")
+
+    if findings["root_rows"] > thresholds["max_root_rows"]:
+        findings["reasons"].append(f"Estimated result too large ({findings['root_rows']} rows).")
+        ok = False
+
+    if findings["max_node_bytes"] > thresholds["max_node_bytes"]:
+        findings["reasons"].append("Operators process too many bytes (estimated).")
+        ok = False
+        
+    if findings["seq_scans_heavy"]:
+        findings["reasons"].append("Heavy sequential scans on large tables.")
+        ok = False
+        
+    if findings["sort_nodes"] and not findings["limit_present"]:
+        findings["reasons"].append("Large SORT without LIMIT upstream.")
+        ok = False
+        
+    if findings["nested_loop_heavy"]:
+        findings["reasons"].append("Heavy nested loop join (both sides large).")
+        ok = False
+        
+    if findings["large_aggregates"]:
+        ok = False
+        findings["reasons"].append("Large aggregation operations.")
+        
+    if findings["possible_cross_join"]:
+        findings["reasons"].append("Possible cross join (no join condition found).")
+        ok = False
+
+    return ok, findings
+
+def static_guardrail(sql, thresholds=THRESHOLDS, large_tables=None):
+    """השלב הסטטי (AST, בלי DB): מחזיר (verdict, sql, findings).
+    verdict: "block" - נחסם, "pass" - בטוח בלי EXPLAIN, "explain" - גבולי, ממשיך ל-EXPLAIN על ה-sql המתוקן"""
+    large_tables = known_large_tables(thresholds) if large_tables is None else large_tables
+    findings = new_findings()
+    findings["static"] = True
     try:
-        ok = True
-        plan_root = explain_json(conn, sql)["Plan"]
-        print(plan_root)
-        print(sql)
-        findings["limit_present"] = has_limit_node(plan_root)
-        findings["root_rows"] = int(plan_root.get("Plan Rows", 0) or 0)
-        walk_plan(plan_root, findings)
-        # כללים
-        if thresholds["require_limit"] and not findings["limit_present"]:
-            findings["notices"].append("Query has no LIMIT, adding LIMIT.")
-
-        if findings["root_rows"] > thresholds["max_root_rows"]:
-            findings["reasons"].append(f"Estimated result too large ({findings['root_rows']} rows).")
-            ok = False
-
-        if findings["max_node_bytes"] > thresholds["max_node_bytes"]:
-            findings["reasons"].append("Operators process too many bytes (estimated).")
-            ok = False
-            
-        if findings["seq_scans_heavy"]:
-            findings["reasons"].append("Heavy sequential scans on large tables.")
-            ok = False
-            
-        if findings["sort_nodes"] and not findings["limit_present"]:
-            findings["reasons"].append("Large SORT without LIMIT upstream.")
-            ok = False
-            
-        if findings["nested_loop_heavy"]:
-            findings["reasons"].append("Heavy nested loop join (both sides large).")
-            ok = False
-            
-        if findings["large_aggregates"]:
-            ok = False
-            findings["reasons"].append("Large aggregation operations.")
-            
-        if findings["possible_cross_join"]:
-            findings["reasons"].append("Possible cross join (no join condition found).")
-            ok = False
+        facts = sqlcheck.analyze(sql, large_tables)
+    except ValueError as e:
+        findings["reasons"].append(str(e))
+        return "block", sql, findings
+
+    if facts["statement_error"]:
+        findings["reasons"].append(facts["statement_error"])
+        return "block", sql, findings
 
+    # LIMIT על השאילתה החיצונית: מוסיפים אם חסר, מקטינים אם גדול מדי
+    if facts["limit"] is None:
+        if thresholds["require_limit"]:
+            sql = sqlcheck.with_limit(sql, facts["tree"], thresholds["default_limit"])
+            findings["notices"].append(f"Query has no LIMIT, added LIMIT {thresholds['default_limit']}.")
+            facts["limit"] = thresholds["default_limit"]
+    elif facts["limit"] > thresholds["max_limit"]:
+        sql = sqlcheck.with_limit(sql, facts["tree"], thresholds["max_limit"])
+        findings["notices"].append(f"LIMIT {facts['limit']} lowered to {thresholds['max_limit']}.")
+        facts["limit"] = thresholds["max_limit"]
+    findings["limit_present"] = facts["limit"] is not None
+
+    findings["cartesian_joins"] = facts["cartesian_joins"]
+    findings["unbounded_scans"] = facts["unbounded_scans"]
+    verdict = "explain"
+    if any(not j["derived"] for j in facts["cartesian_joins"]):
+        findings["possible_cross_join"] = True
+        findings["reasons"].append("Cartesian join (JOIN without a join condition).")
+        verdict = "block"
+    if facts["unbounded_scans"]:
+        findings["reasons"].append(f"Unbounded scan on large table(s): {', '.join(facts['unbounded_scans'])}.")
+        verdict = "block"
+    if verdict == "block":
+        return verdict, sql, findings
+
+    # בטוח: טבלה אחת, עם LIMIT, וטבלה קטנה או סריקה שה-LIMIT עוצר
+    large = facts["tables"][0] in large_tables if facts["tables"] else False
+    if facts["simple"] and findings["limit_present"] and (not large or not (facts["filtered"] or facts["consumes_all"])):
+        verdict = "pass"
+    return verdict, sql, findings
+
+def explain_guardrail(conn, sql, thresholds=THRESHOLDS):
+    """מריץ guardrail על השאילתה (verdict מה-plan cache אם קיים)"""
+    try:
+        plan_cache.check_version()
+        key = plan_cache.key(sql, thresholds)
+        cached = plan_cache.get(key)
+        if cached is not None:
+            return cached
+        plan_root = explain_json(conn, sql)["Plan"]
+        ok, findings = evaluate_plan(plan_root, sql, thresholds)
+        plan_cache.set(key, ok, findings)
         return ok, findings
         
     except Exception as e:
+        findings = new_findings()
+        findings["reasons"].append(f"EXPLAIN failed: {str(e)}")
+        return False, findings
+
+async def aexplain_guardrail(conn, sql, thresholds=THRESHOLDS):
+    """כמו explain_guardrail, על חיבור psycopg אסינכרוני"""
+    try:
+        await plan_cache.acheck_version()
+        key = plan_cache.key(sql, thresholds)
+        cached = plan_cache.get(key)
+        if cached is not None:
+            return cached
+        plan_root = (await aexplain_json(conn, sql))["Plan"]
+        ok, findings = evaluate_plan(plan_root, sql, thresholds)
+        plan_cache.set(key, ok, findings)
+        return ok, findings
+
+    except Exception as e:
+        findings = new_findings()
         findings["reasons"].append(f"EXPLAIN failed: {str(e)}")
         return False, findings
 
-def apply_guardrails(conn, sql, thresholds=THRESHOLDS):
-    """מחיל guardrails על השאילתה ומחזיר שאילתה מתוקנת"""
+def guardrail_result(sql, ok, findings):
     notices = []
     reasons = []
     
-    # בדיקת guardrails ישירות על השאילתה (LIMIT כבר נוסף ב-generate_sql)
-    ok, findings = explain_guardrail(conn, sql, thresholds)
-    
     # הוספת notices מה-guardrails
     notices.extend(findings.get("notices", []))
     reasons.extend(findings.get("reasons", []))
     
-    print(5,reasons)
-    print(6,findings)
     result = {
         "sql": sql,
         "ok": ok,
@@ -176,6 +396,41 @@ def apply_guardrails(conn, sql, thresholds=THRESHOLDS):
         "reasons": reasons,
     }
 
-    print(result)
-    
+    tracing.record_verdict(ok, findings.get("static", False))
+    log.debug("guardrail verdict", extra={"fields": {"ok": ok, "reasons": reasons, "notices": notices}})
     return result
+
+def merge_findings(static_findings, findings):
+    """findings של EXPLAIN + מה שהשלב הסטטי מצא (notices/reasons קודם)"""
+    merged = dict(findings)
+    merged["notices"] = static_findings["notices"] + findings["notices"]
+    merged["reasons"] = static_findings["reasons"] + findings["reasons"]
+    merged["cartesian_joins"] = static_findings.get("cartesian_joins", [])
+    merged["unbounded_scans"] = static_findings.get("unbounded_scans", [])
+    return merged
+
+def static_result(sql, thresholds=THRESHOLDS):
+    """השלב הסטטי כתוצאת guardrail: (result, sql, findings); result=None -> צריך EXPLAIN"""
+    verdict, sql, findings = static_guardrail(sql, thresholds)
+    if verdict == "explain":
+        return None, sql, findings
+    return guardrail_result(sql, verdict == "pass", findings), sql, findings
+
+def apply_guardrails(conn, sql, thresholds=THRESHOLDS, static_findings=None):
+    """מחיל guardrails על השאילתה ומחזיר שאילתה מתוקנת.
+    static_findings: השלב הסטטי כבר רץ (ה-sql כבר מתוקן) - רק EXPLAIN"""
+    if static_findings is None:
+        result, sql, static_findings = static_result(sql, thresholds)
+        if result is not None:
+            return result
+    ok, findings = explain_guardrail(conn, sql, thresholds)
+    return guardrail_result(sql, ok, merge_findings(static_findings, findings))
+
+async def aapply_guardrails(conn, sql, thresholds=THRESHOLDS, static_findings=None):
+    """כמו apply_guardrails, על חיבור psycopg אסינכרוני"""
+    if static_findings is None:
+        result, sql, static_findings = static_result(sql, thresholds)
+        if result is not None:
+            return result
+    ok, findings = await aexplain_guardrail(conn, sql, thresholds)
+    return guardrail_result(sql, ok, merge_findings(static_findings, findings))
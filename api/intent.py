@@ -0,0 +1,71 @@
+import os
+import re
+
+# סף ביטחון שמעליו לא פונים ל-LLM (מעל 1 = fast path כבוי)
+FAST_PATH_THRESHOLD = float(os.getenv("INTENT_FAST_PATH_THRESHOLD", "0.75"))
+
+# תחיליות עבריות שנצמדות למילה (ה, ב, ל, ו, כ, ש, מ): "בגרף", "והתרשים", "לייצא"
+_HE = r"(?<!\w)[והבלכשמ]{0,2}"
+_END = r"(?!\w)"
+
+# (תבנית, משקל). משקל 1 = מילה מפורשת, 0.4-0.5 = רמז חלש
+VIZ_PATTERNS = [
+    (r"\b(?:chart|charts|graph|graphs|plot|plots|plotted|visuali[sz]e|visuali[sz]ation|histogram|heatmap|scatter|pie|dashboard)\b", 1.0),
+    (r"\b(?:bar|line|area)\s+(?:chart|graph)\b", 1.0),
+    (_HE + r"(?:גרף|גרפים|תרשים|תרשימים|דיאגרמה|דיאגרמת|היסטוגרמה|ויזואליזציה|ויזואליזציית|עוגה|עוגת|פאי)" + _END, 1.0),
+    (r"\b(?:trend|trends|distribution|breakdown|compare|comparison)\b", 0.4),
+    (r"\bover time\b", 0.4),
+    (_HE + r"(?:מגמה|מגמת|מגמות|התפלגות|השוואה|השוואת|להשוות)" + _END, 0.4),
+    (r"(?<!\w)לאורך (?:זמן|הזמן|השנה)" + _END, 0.4),
+]
+
+SQL_PATTERNS = [
+    (r"\b(?:list|table|rows|records|how many|count|number of|export|download|csv|save|details|which)\b", 1.0),
+    (r"\b(?:all|each|every)\b", 0.5),
+    (_HE + r"(?:רשימה|רשימת|טבלה|טבלת|שורות|רשומות|כמה|מספר|ייצא|לייצא|תייצא|הורד|להוריד|תוריד|שמור|פרטי|פרטים|איזה|אילו|מי)" + _END, 1.0),
+    (_HE + r"(?:כל|עבור כל)" + _END, 0.5),
+]
+
+# "בלי גרף" / "not as a chart" - מבטל את המילה הויזואלית
+NEGATED_VIZ = [
+    (r"\b(?:no|without|not as|not in|instead of)\s+(?:an?\s+)?(?:chart|graph|plot|visuali[sz]ation)\b", 2.0),
+    (_HE + r"(?:בלי|ללא|לא)\s+[והבלכשמ]{0,2}(?:גרף|תרשים|ויזואליזציה)" + _END, 2.0),
+]
+
+_COMPILED = {
+    "viz": [(re.compile(p, re.IGNORECASE), w) for p, w in VIZ_PATTERNS],
+    "sql": [(re.compile(p, re.IGNORECASE), w) for p, w in SQL_PATTERNS],
+    "negated_viz": [(re.compile(p, re.IGNORECASE), w) for p, w in NEGATED_VIZ],
+}
+
+# החלקה: ככל שהיא גדולה יותר צריך יותר ראיות כדי להגיע לביטחון גבוה
+_SMOOTHING = 0.5
+
+
+def _score(patterns, text):
+    return sum(w for rx, w in patterns if rx.search(text))
+
+
+def classify_intent(query):
+    """מסווג מקומי (regex) -> (intent, confidence); confidence 0.5 = אין ראיות"""
+    text = (query or "").lower()
+    viz = _score(_COMPILED["viz"], text)
+    sql = _score(_COMPILED["sql"], text)
+    negated = _score(_COMPILED["negated_viz"], text)
+    if negated:
+        viz = max(0.0, viz - negated / 2)
+        sql += negated
+
+    if viz == sql:
+        return "sql", 0.5
+    intent = "viz" if viz > sql else "sql"
+    winner, loser = max(viz, sql), min(viz, sql)
+    confidence = 0.5 + 0.5 * (winner - loser) / (winner + loser + _SMOOTHING)
+    return intent, round(confidence, 3)
+
+
+def fast_path_intent(query, threshold=None):
+    """intent אם הסיווג המקומי בטוח מספיק, אחרת None (צריך LLM)"""
+    threshold = FAST_PATH_THRESHOLD if threshold is None else threshold
+    intent, confidence = classify_intent(query)
+    return intent if confidence >= threshold else None
@@ -1,64 +1,118 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import psycopg2
-import sqlglot
 from openai import OpenAI
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import json
-from graph import build_graph
+from graph import build_graph, sql_cache
+from guardrails import plan_cache
+from result_cache import result_cache
+from rollups import rollup_rewriter
+from fewshot import fewshot_index
+from schema_index import schema_index
+from catalog import catalog
+from executor import astream_ndjson
+from singleflight import singleflight
+import batch
+import deadline
+import export
+import encoding
+import sqlcheck
+import tracing
+import db
 
 import os
 
+log = tracing.get_logger("api")
+
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
-graph = build_graph()
+# /ask רץ על הגרף האסינכרוני (ainvoke) - בלי לחסום את ה-threadpool של ה-worker
+graph = build_graph(use_async=True)
 
-DATABASE_URL = os.getenv("DATABASE_URL", "postgres://app:app@db:5432/demo")
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 class QueryRequest(BaseModel):
     sql: str
+    result_format: str = "rows"  # rows | columnar | arrow
 
 def validate_sql(sql: str):
-    try:
-        parsed = sqlglot.parse_one(sql, read="postgres")
-        print(parsed)
-        print(parsed.key)
-        if parsed.key != "select":
-            raise ValueError("Only SELECT queries are allowed")
-        # אפשר להוסיף בדיקות נוספות: LIMIT, deny-list, וכו'
-        return True
-    except Exception as e:
-        raise ValueError(f"Invalid SQL: {e}")
+    # אותן בדיקות כמו בשלב הסטטי של ה-guardrails: משפט יחיד, קריאה בלבד
+    error = sqlcheck.statement_error(sqlcheck.parse(sql))
+    if error:
+        raise ValueError(error)
+    return True
 
 @app.post("/query")
 def run_query(req: QueryRequest):
     try:
         validate_sql(req.sql)
+        check_result_format(req.result_format)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        cur.execute(req.sql)
-        rows = cur.fetchall()
-        colnames = [desc[0] for desc in cur.description]
-        cur.close()
-        conn.close()
+        # validate_sql מאשר SELECT בלבד - יכול לרוץ על replica
+        with db.checkout(readonly=True) as conn:
+            with conn.cursor() as cur:
+                cur.execute(req.sql)
+                rows = cur.fetchall()
+                description = cur.description
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB Error: {e}")
 
-    return {"columns": colnames, "rows": rows}
+    if req.result_format == "rows":
+        return {"columns": [desc[0] for desc in description], "rows": rows}
+    return columnar_response(encoding.to_columns(description, rows), req.result_format, {"sql": req.sql})
+
+def check_result_format(result_format):
+    if result_format not in encoding.RESULT_FORMATS:
+        raise ValueError(f"Unknown result_format: {result_format} (expected one of {', '.join(encoding.RESULT_FORMATS)})")
+    if result_format == "arrow" and encoding.pa is None:
+        raise ValueError("result_format arrow requires pyarrow")
+
+def columnar_response(columnar, result_format, meta):
+    """columnar: JSON עם header + מערך לכל עמודה; arrow: Arrow IPC stream (meta ב-schema metadata)"""
+    if result_format == "arrow":
+        return Response(encoding.to_arrow_ipc(columnar, meta), media_type=encoding.ARROW_MEDIA_TYPE)
+    return JSONResponse({**meta, "columns": columnar["columns"], "data": columnar["data"]})
+
+def export_response(sql, fmt, compress):
+    """StreamingResponse שמזרים את התוצאה ישירות מה-DB (בלי קובץ זמני)"""
+    try:
+        export.check_format(fmt)
+    except export.ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(
+        export.stream_export(sql, fmt, compress),
+        media_type=export.media_type(fmt, compress),
+        headers={"Content-Disposition": f'attachment; filename="{export.filename(fmt, compress)}"'},
+    )
+
+class ExportRequest(BaseModel):
+    sql: str
+    format: str = "csv"   # csv | ndjson | parquet | arrow
+    gzip: bool = False
+
+@app.post("/export")
+def run_export(req: ExportRequest):
+    try:
+        validate_sql(req.sql)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return export_response(req.sql, req.format, req.gzip)
 
 class NLRequest(BaseModel):
     question: str
 
 @app.post("/nl2sql")
 def nl2sql(req: NLRequest):
-    schema = open("docs/schema_summaries.md").read()
+    # שאלות זהות במקביל (למשל רענון dashboard) - קריאת LLM אחת
+    return singleflight.do(singleflight.key(req.question, endpoint="nl2sql"), lambda: generate_nl2sql(req.question))
+
+def generate_nl2sql(question):
+    schema = schema_index.prompt_schema(question)
 
     prompt = f"""
 You are a helpful assistant that generates PostgreSQL SELECT queries ONLY.
@@ -66,7 +120,7 @@ Return output in JSON with keys: intent, sql.
 Schema:
 {schema}
 
-User question: {req.question}
+User question: {question}
 """
     resp = client.chat.completions.create(
         model="gpt-4o-mini",
@@ -81,32 +135,206 @@ User question: {req.question}
 
 class QueryRequest(BaseModel):
     question: str
+    stream: bool = False  # NDJSON: שורה לכל רשומה במקום JSON אחד עם כל ה-rows
+    format: str = "csv"   # פורמט הקובץ כשה-action הוא download
+    gzip: bool = False
+    result_format: str = "rows"  # rows | columnar | arrow
+    deadline: float = 0  # שניות לכל הבקשה (0 = REQUEST_DEADLINE_SECONDS; לא יותר ממנו)
+    timeline: bool = False  # ציר הזמן של ה-nodes והשרשרת הקריטית בתגובה
 
 @app.post("/ask")
-def ask(req: QueryRequest):
-    result = graph.invoke({"query": req.question})
+async def ask(req: QueryRequest):
+    try:
+        check_result_format(req.result_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    if result.get("action") == "download":
-        return FileResponse(result["file_path"], filename="result.csv")
-    else:
-        response_data = {
+    inputs = {"query": req.question, "stream": req.stream, "result_format": req.result_format}
+    deadline.start(inputs, req.deadline or None)
+
+    async def run_graph():
+        # חיבור אחד מה-pool לכל הבקשה (EXPLAIN + הרצה)
+        async with db.arequest_scope():
+            return await graph.ainvoke(inputs)
+
+    # trace אחד לכל ה-nodes; בקשות זהות במקביל מחכות להרצה אחת של הגרף
+    with tracing.request_trace("ask") as trace:
+        # התקציב בפועל במפתח: תוצאה שנחתכה ב-deadline קצר לא מוגשת לבקשה עם deadline ארוך
+        key = singleflight.key(req.question, stream=req.stream, result_format=req.result_format,
+                               deadline=inputs.get("deadline_s"))
+        result = await singleflight.ado(key, run_graph)
+
+    # שאילתה חסומה (או בלי SQL) לא מיוצאת - התשובה הרגילה עם ה-reasons
+    if result.get("action") == "download" and result.get("guardrail_ok", True) and result.get("sql"):
+        return export_response(result["sql"], req.format, req.gzip)
+
+    if result.get("streamed"):
+        header = {
             "intent": result.get("intent"),
             "sql": result.get("sql"),
-            "rows": result.get("rows"),
-            "viz_spec": result.get("viz_spec"),
-            "notices": result.get("notices", [])
+            "notices": result.get("notices", []),
         }
-        
-        # אם השאילתה נחסמה, הוסף reasons
-        if result.get("blocked") is True or (not result.get("guardrail_ok", True)):
-            response_data["blocked"] = True
-            # קח קודם מ-state["reasons"], ואם לא קיים – נצלול ל-findings
-            reasons = result.get("reasons")
-            if not reasons:
-                reasons = (result.get("findings") or {}).get("reasons", [])
-            response_data["reasons"] = reasons
-        
-        return JSONResponse(response_data)
+        # ההזרמה עצמה מוגבלת במה שנשאר מה-deadline
+        return StreamingResponse(astream_ndjson(result["sql"], header, statement_timeout_ms=deadline.statement_timeout_ms(result)),
+                                 media_type="application/x-ndjson")
+
+    if result.get("columnar"):
+        meta = {
+            "intent": result.get("intent"),
+            "sql": result.get("sql"),
+            "notices": result.get("notices", []),
+        }
+        return columnar_response(result["columnar"], req.result_format, meta)
+
+    else:
+        payload = answer_payload(result)
+        if req.timeline:
+            # בקשה שהצטרפה להרצה של בקשה זהה (single-flight) - בלי nodes משלה
+            payload["timeline"] = trace.timeline_summary()
+        return JSONResponse(payload)
+
+def answer_payload(result):
+    """תגובת ה-JSON של /ask (וכל שורה של /ask/batch) מתוך ה-state של הגרף"""
+    response_data = {
+        "intent": result.get("intent"),
+        "sql": result.get("sql"),
+        "rows": result.get("rows"),
+        "viz_spec": result.get("viz_spec"),
+        "notices": result.get("notices", [])
+    }
+    if result.get("repair"):
+        response_data["repair"] = result["repair"]
+    timing = deadline.timing(result)
+    if timing is not None:
+        response_data["timing"] = timing
+
+    # אם השאילתה נחסמה, הוסף reasons
+    if result.get("blocked") is True or (not result.get("guardrail_ok", True)):
+        response_data["blocked"] = True
+        # קח קודם מ-state["reasons"], ואם לא קיים – נצלול ל-findings
+        reasons = result.get("reasons")
+        if not reasons:
+            reasons = (result.get("findings") or {}).get("reasons", [])
+        response_data["reasons"] = reasons
+
+    return response_data
+
+class BatchRequest(BaseModel):
+    questions: list[str]
+    concurrency: int = 0  # workers במקביל (0 = BATCH_CONCURRENCY)
+
+def batch_payload(result):
+    payload = answer_payload(result)
+    if result.get("streamed"):
+        # בקשת ייצוא: ב-batch אין קובץ - ה-SQL חוזר ואפשר להעביר אותו ל-/export
+        payload["action"] = "download"
+        payload["notices"] = payload["notices"] + ["Export requests are not run in a batch; pass the SQL to /export."]
+    return payload
+
+@app.post("/ask/batch")
+async def ask_batch(req: BatchRequest):
+    """הרבה שאלות בבקשה אחת: כפילויות רצות פעם אחת, עד concurrency workers במקביל,
+    ותשובה בזרימה (NDJSON) - שורה לכל שאלה ברגע שהיא מסתיימת"""
+    if not req.questions:
+        raise HTTPException(status_code=400, detail="questions must not be empty")
+    if len(req.questions) > batch.BATCH_CONFIG["max_questions"]:
+        raise HTTPException(status_code=400, detail=f"At most {batch.BATCH_CONFIG['max_questions']} questions per batch")
+
+    async def answer(question):
+        # לכל שאלה deadline משלה, מהרגע שה-worker מתחיל אותה
+        inputs = deadline.start({"query": question, "stream": False, "result_format": "rows"})
+
+        async def run_graph():
+            # ה-scope בתוך ה-task של ה-single-flight, כמו ב-/ask
+            async with db.arequest_scope():
+                return await graph.ainvoke(inputs)
+
+        # אותו מפתח כמו /ask - שאלה שכבר רצה שם במקביל לא תרוץ פעמיים
+        with tracing.request_trace("ask_batch"):
+            key = singleflight.key(question, stream=False, result_format="rows", deadline=inputs.get("deadline_s"))
+            return await singleflight.ado(key, run_graph)
+
+    return StreamingResponse(batch.ndjson(req.questions, answer, batch_payload, req.concurrency),
+                             media_type="application/x-ndjson")
+
+class ExampleRequest(BaseModel):
+    question: str
+    sql: str
+
+@app.get("/examples")
+def examples(q: str = "", k: int = 0):
+    """הדוגמאות שייכנסו לפרומפט של השאלה q (עם ה-score), ואם יש - הדוגמה שתחליף את ה-LLM"""
+    if not q:
+        return fewshot_index.stats()
+    matches = fewshot_index.search(q, k or None)
+    return {"question": q, "examples": matches, "exact": fewshot_index.exact(q, matches)}
+
+@app.post("/examples")
+def add_example(req: ExampleRequest):
+    """זוג שאלה/SQL שאושר: נכנס לאינדקס ולקובץ FEWSHOT_PATH, וגם לקיצור בלי LLM"""
+    try:
+        validate_sql(req.sql)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    example = fewshot_index.add(req.question, req.sql.strip(), "accepted")
+    if example is None:
+        raise HTTPException(status_code=400, detail="question and sql must not be empty")
+    return example
+
+@app.on_event("startup")
+async def open_pool():
+    await db.get_apool()
+    try:
+        db.get_pool().open()
+    except Exception as e:
+        # ה-DB עוד לא למעלה - ה-pool יתמלא בשימוש הראשון
+        log.warning("DB pool warmup failed: %s", e)
+    load_catalog()
+    fewshot_index.load()
+    # בדיקות תקינות/lag של ה-replicas (DATABASE_REPLICA_URLS)
+    db.router.start()
+    # רענון ברקע: NOTIFY על DDL + רענון מלא כל CATALOG_REFRESH_INTERVAL
+    catalog.start()
+
+def load_catalog():
+    """טעינה מלאה של ה-catalog (ואיתו אינדקס ה-schema); בלי DB - האינדקס נבנה מהקובץ בלבד"""
+    try:
+        catalog.refresh()
+        error = None
+    except Exception as e:
+        log.error("catalog refresh failed: %s", e)
+        error = str(e)
+    schema_index.load()
+    return error
+
+@app.on_event("shutdown")
+async def close_pool():
+    catalog.stop()
+    db.router.stop()
+    await db.aclose_pool()
+    db.close_pool()
+
+@app.get("/stats")
+def stats():
+    return {"pool": db.pool_stats(), "apool": db.apool_stats(), "sql_cache": sql_cache.stats(),
+            "plan_cache": plan_cache.stats(), "schema_index": schema_index.stats(),
+            "catalog": catalog.stats(), "singleflight": singleflight.stats(),
+            "result_cache": result_cache.stats(), "rollups": rollup_rewriter.stats(),
+            "fewshot": fewshot_index.stats(), "db_router": db.router_stats()}
+
+@app.post("/schema/reload")
+def schema_reload():
+    error = load_catalog()
+    return {"ok": error is None, "error": error, "catalog": catalog.stats(), "schema_index": schema_index.stats()}
+
+@app.get("/metrics")
+def metrics():
+    # Prometheus: זמן לכל node, טוקנים, זמן DB, שורות ו-verdicts
+    payload = tracing.metrics_payload()
+    if payload is None:
+        raise HTTPException(status_code=501, detail="prometheus_client is not installed")
+    body, content_type = payload
+    return Response(content=body, media_type=content_type)
 
 @app.get("/healthz")
 def healthz():
@@ -0,0 +1,266 @@
+import os
+from collections import deque
+
+from sqlglot import exp
+
+import sqlcheck
+import tracing
+from guardrails import THRESHOLDS, known_large_tables, static_guardrail, explain_guardrail, aexplain_guardrail
+from schema_index import schema_index
+
+log = tracing.get_logger("repair")
+
+REPAIR_CONFIG = {
+    "enabled": os.getenv("GUARDRAIL_REPAIR", "1") == "1",
+    "max_explains": int(os.getenv("GUARDRAIL_REPAIR_MAX_EXPLAINS", "6")),   # תקציב EXPLAIN לכל שאילתה חסומה
+    "date_window_days": int(os.getenv("GUARDRAIL_REPAIR_DATE_DAYS", "90")),
+    "llm": os.getenv("GUARDRAIL_REPAIR_LLM", "1") == "1",                    # ניסיון אחד עם ה-findings כ-feedback
+}
+
+_NUMERIC_TYPES = ("smallint", "integer", "bigint", "numeric", "decimal", "real", "double precision", "money")
+_DATE_TYPES = ("date", "timestamp")
+
+
+# ---------- עזרים על ה-AST ----------
+
+def _columns(table):
+    info = schema_index.ensure_loaded().tables.get(table)
+    return info["columns"] if info else []
+
+
+def _date_column(table):
+    # עמודת התאריך הראשונה; בלי טיפוסים (קובץ ה-summaries) - לפי השם
+    columns = _columns(table)
+    for column in columns:
+        if (column.get("type") or "").startswith(_DATE_TYPES):
+            return column["name"]
+    for column in columns:
+        if column.get("type") is None and column["name"].endswith(("_date", "_at")):
+            return column["name"]
+    return None
+
+
+def _is_measure(column):
+    name = column["name"]
+    if name == "id" or name.endswith("_id"):
+        return False
+    if column.get("type"):
+        return column["type"].startswith(_NUMERIC_TYPES)
+    return any(part in name for part in ("amount", "price", "qty", "total", "quantity"))
+
+
+def _outer_tables(select):
+    """[(alias, table)] של FROM/JOIN ב-SELECT החיצוני (טבלאות בלבד)"""
+    from_ = select.args.get("from_") or select.args.get("from")
+    sources = [from_.this] if from_ else []
+    sources.extend(j.this for j in select.args.get("joins") or [])
+    return [(s.alias_or_name, s.name) for s in sources if isinstance(s, exp.Table) and isinstance(s.this, exp.Identifier)]
+
+
+def _references(node, alias, column, single_table):
+    if node is None:
+        return False
+    return any(c.name == column and (c.table == alias or (not c.table and single_table)) for c in node.find_all(exp.Column))
+
+
+# ---------- אסטרטגיות: (tree, findings, thresholds) -> (tree, notice) או None ----------
+
+def tighten_limit(tree, findings, thresholds):
+    """LIMIT גדול -> ברירת המחדל (Top-N sort / סריקה שנעצרת מוקדם)"""
+    limit = sqlcheck.outer_limit(tree)
+    if limit is None or limit <= thresholds["default_limit"]:
+        return None
+    return tree.limit(thresholds["default_limit"]), f"LIMIT lowered from {limit} to {thresholds['default_limit']}."
+
+
+def date_range(tree, findings, thresholds):
+    """טבלה גדולה בלי תנאי על עמודת התאריך שלה -> רק N הימים האחרונים"""
+    if not isinstance(tree, exp.Select):
+        return None
+    heavy = {s.get("relation") for s in findings.get("seq_scans_heavy", [])} | set(findings.get("unbounded_scans", []))
+    large = heavy or known_large_tables(thresholds)
+    sources = _outer_tables(tree)
+    days = REPAIR_CONFIG["date_window_days"]
+    predicates, restricted = [], []
+    for alias, table in sources:
+        column = _date_column(table) if table in large else None
+        if column is None or _references(tree.args.get("where"), alias, column, len(sources) == 1):
+            continue
+        predicates.append(exp.condition(f"{alias}.{column} >= CURRENT_DATE - INTERVAL '{days} days'", dialect="postgres"))
+        restricted.append(f"{table}.{column}")
+    if not predicates:
+        return None
+    tree = tree.where(*predicates, dialect="postgres")
+    return tree, f"Restricted {', '.join(restricted)} to the last {days} days."
+
+
+def summarize(tree, findings, thresholds):
+    """שורות בודדות מטבלה אחת -> שורת סיכום (COUNT + SUM של העמודות המספריות)"""
+    if not isinstance(tree, exp.Select) or tree.args.get("group") or tree.args.get("distinct"):
+        return None
+    if tree.find(exp.AggFunc, exp.Window) or len(_outer_tables(tree)) != 1 or tree.args.get("joins"):
+        return None
+    _, table = _outer_tables(tree)[0]
+    columns = {c["name"]: c for c in _columns(table)}
+    selected = []
+    for projection in tree.selects:
+        if isinstance(projection, exp.Star):
+            selected.extend(columns)
+        elif isinstance(projection, exp.Column) and projection.name in columns:
+            selected.append(projection.name)
+    measures = [name for name in dict.fromkeys(selected) if _is_measure(columns[name])]
+    projections = [exp.alias_(exp.Count(this=exp.Star()), "row_count")]
+    projections += [exp.alias_(exp.Sum(this=exp.column(name)), f"total_{name}") for name in measures]
+    tree = tree.select(*projections, append=False)
+    tree.set("order", None)
+    return tree, "Returned a summary (row count and totals) instead of the individual rows."
+
+
+STRATEGIES = [("tighten_limit", tighten_limit), ("date_range", date_range), ("aggregate", summarize)]
+
+
+# ---------- חיפוש ----------
+
+class RepairSearch:
+    """חיפוש BFS על צירופי אסטרטגיות, החל מהשאילתה החסומה: כל רמה מוערכת (סטטי ואז EXPLAIN) לפני שמרחיבים
+    את הווריאנטים שנכשלו. עוצר ברמה הראשונה שיש בה וריאנט שעובר, או כשתקציב ה-EXPLAIN נגמר.
+    candidates() מחזיר וריאנטים להרצת EXPLAIN; המריץ (סינכרוני או async) מחזיר את התוצאה ב-record()"""
+
+    def __init__(self, sql, findings, thresholds=THRESHOLDS, max_explains=None, has_time=None):
+        self.sql = sql
+        self.thresholds = thresholds
+        self.findings = findings or {}
+        self.max_explains = REPAIR_CONFIG["max_explains"] if max_explains is None else max_explains
+        self.base_cost = self.findings.get("total_cost")
+        self.has_time = has_time or (lambda: True)   # deadline של הבקשה: False = לא מתחילים EXPLAIN נוסף
+        self.explains = 0
+        self.variants = []      # כל מה שהוערך: {"sql", "strategies", "notices", "ok", "cost", "reasons"}
+        self._seen = set()
+        self._pending = deque()  # וריאנטים שנוספו מבחוץ (תשובת ה-LLM)
+
+    def baseline(self, findings):
+        self.base_cost = findings.get("total_cost")
+
+    def _key(self, tree):
+        return sqlcheck.canonical(tree)
+
+    def _expand(self, parent):
+        """ילדים של וריאנט: כל אסטרטגיה שעוד לא הוחלה (לפי הסדר, בלי פרמוטציות)"""
+        try:
+            tree = sqlcheck.parse(parent["sql"])
+        except ValueError:
+            return []
+        applied = [name for name, _ in STRATEGIES if name in parent["strategies"]]
+        start = max((i + 1 for i, (name, _) in enumerate(STRATEGIES) if name in applied), default=0)
+        children = []
+        for name, strategy in STRATEGIES[start:]:
+            try:
+                rewritten = strategy(tree.copy(), parent.get("findings") or self.findings, self.thresholds)
+            except Exception as e:
+                log.warning("repair strategy %s failed: %s", name, e)
+                continue
+            if rewritten is None:
+                continue
+            new_tree, notice = rewritten
+            key = self._key(new_tree)
+            if key in self._seen:
+                continue
+            self._seen.add(key)
+            children.append({"sql": new_tree.sql(dialect="postgres") + ";", "strategies": parent["strategies"] + [name],
+                             "notices": parent["notices"] + [notice]})
+        return children
+
+    def _static(self, variant):
+        # השלב הסטטי על הווריאנט (LIMIT, cartesian, סריקה לא חסומה); False = נחסם בלי EXPLAIN
+        verdict, variant["sql"], findings = static_guardrail(variant["sql"], self.thresholds)
+        if verdict == "block":
+            self._store(variant, False, findings)
+            return False
+        return True
+
+    def _store(self, variant, ok, findings):
+        variant.update(ok=ok, cost=findings.get("total_cost"), reasons=findings.get("reasons", []), findings=findings)
+        self.variants.append(variant)
+
+    def add(self, sql, strategy, notice):
+        """וריאנט מבחוץ (למשל ה-SQL שה-LLM החזיר עם ה-findings כ-feedback)"""
+        self._pending.append({"sql": sql, "strategies": [strategy], "notices": [notice]})
+        self.max_explains = max(self.max_explains, self.explains + 1)   # גם כשהתקציב נגמר - ניסיון אחד
+
+    def candidates(self):
+        try:
+            self._seen.add(self._key(sqlcheck.parse(self.sql)))
+        except ValueError:
+            return
+        level = list(self._pending) or self._expand({"sql": self.sql, "strategies": [], "notices": []})
+        self._pending.clear()
+        while level and self.explains < self.max_explains and self.has_time():
+            failed = []
+            for variant in level:
+                if self.explains >= self.max_explains or not self.has_time():
+                    break
+                if self._static(variant):
+                    self.explains += 1
+                    yield variant
+                if not variant["ok"]:
+                    failed.append(variant)
+            if self.best() is not None:
+                return
+            level = [child for parent in failed for child in self._expand(parent)]
+
+    def record(self, variant, ok, findings):
+        self._store(variant, ok, findings)
+
+    def best(self):
+        """הווריאנט הזול ביותר שעבר (עלות לא ידועה - אחרון)"""
+        passing = [v for v in self.variants if v["ok"]]
+        if not passing:
+            return None
+        return min(passing, key=lambda v: (v["cost"] is None, v["cost"] or 0))
+
+    def report(self):
+        best = self.best()
+        report = {
+            "ok": best is not None,
+            "explains": self.explains,
+            "deadline_hit": not self.has_time(),
+            "original_cost": self.base_cost,
+            "variants": [{"strategies": v["strategies"], "ok": v["ok"], "cost": v["cost"], "reasons": v["reasons"]}
+                         for v in self.variants],
+        }
+        if best is not None:
+            report.update(strategy="+".join(best["strategies"]), cost=best["cost"])
+            if self.base_cost is not None and best["cost"] is not None:
+                report["cost_saved"] = round(self.base_cost - best["cost"], 2)
+                report["cost_saved_pct"] = round(100 * (self.base_cost - best["cost"]) / self.base_cost, 1) \
+                    if self.base_cost else 0.0
+        return report
+
+
+def repairable(sql, findings):
+    """חסימה על עלות (לא שגיאת תחביר / פקודת כתיבה / EXPLAIN שנכשל)"""
+    if not REPAIR_CONFIG["enabled"]:
+        return False
+    try:
+        tree = sqlcheck.parse(sql)
+    except ValueError:
+        return False
+    if sqlcheck.statement_error(tree) is not None:
+        return False
+    return not any(r.startswith("EXPLAIN failed") for r in (findings or {}).get("reasons", []))
+
+
+def run(conn, search):
+    if search.base_cost is None:
+        search.baseline(explain_guardrail(conn, search.sql, search.thresholds)[1])
+    for variant in search.candidates():
+        search.record(variant, *explain_guardrail(conn, variant["sql"], search.thresholds))
+    return search.best()
+
+
+async def arun(conn, search):
+    if search.base_cost is None:
+        search.baseline((await aexplain_guardrail(conn, search.sql, search.thresholds))[1])
+    for variant in search.candidates():
+        search.record(variant, *await aexplain_guardrail(conn, variant["sql"], search.thresholds))
+    return search.best()
@@ -0,0 +1,277 @@
+import json
+import os
+import threading
+import time
+
+from sqlglot import exp
+
+import db
+import sqlcheck
+import tracing
+from cache import MemoryCache, NullCache, SQLiteCache, fingerprint
+from catalog import catalog
+
+log = tracing.get_logger("result_cache")
+
+
+def _freshness(spec):
+    # "orders=60,items=60,*=5" -> {"orders": 60.0, "items": 60.0, "*": 5.0}
+    windows = {}
+    for part in spec.split(","):
+        table, _, seconds = part.partition("=")
+        if table.strip() and seconds.strip():
+            windows[table.strip()] = float(seconds)
+    return windows
+
+
+RESULT_CACHE_CONFIG = {
+    "enabled": os.getenv("RESULT_CACHE", "1") == "1",
+    "max_bytes": int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),   # גבול הזיכרון (JSON של התוצאות)
+    "max_entries": int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "2000")),
+    "ttl": float(os.getenv("RESULT_CACHE_TTL", "3600")),                             # גיל מקסימלי בכל מקרה
+    "time_ttl": float(os.getenv("RESULT_CACHE_TIME_TTL", "60")),                     # גיל מקסימלי לשאילתה עם now()/current_date
+    "path": os.getenv("RESULT_CACHE_PATH", ""),                                      # tier על דיסק (SQLite); ריק = כבוי
+    "disk_max_entries": int(os.getenv("RESULT_CACHE_DISK_MAX_ENTRIES", "10000")),
+    # "stats": מוני pg_stat_user_tables (נבדקים לכל היותר כל check_interval); "notify": טריגרים (db/init/005)
+    "invalidation": os.getenv("RESULT_CACHE_INVALIDATION", "stats"),
+    "check_interval": float(os.getenv("RESULT_CACHE_CHECK_INTERVAL", "2")),
+    # כמה שניות מותר להחזיר תוצאה גם אם הטבלה השתנתה (אגרגציות כבדות על טבלאות שמתעדכנות כל הזמן)
+    "freshness": _freshness(os.getenv("RESULT_CACHE_FRESHNESS", "")),
+}
+
+# הערוץ שהטריגרים ב-db/init/005_table_change_notify.sql שולחים אליו (payload = שם הטבלה)
+CHANGE_CHANNEL = "nl2sql_table_change"
+
+# מוני שינויים לכל טבלה; n_live_tup תופס גם TRUNCATE (שלא נספר ב-n_tup_del).
+# המונים מתעדכנים בסוף טרנזקציה (בהשהיה של עד ~שנייה) - ל-invalidation מיידי יש את מצב notify
+TABLE_VERSIONS_SQL = """
+SELECT relname, n_tup_ins + n_tup_upd + n_tup_del, n_live_tup
+FROM pg_stat_user_tables
+WHERE schemaname = ANY(%s)
+"""
+
+# פונקציות שהתוצאה שלהן משתנה בכל הרצה - שאילתה כזו לא נשמרת
+# (sqlglot: random() -> Rand, gen_random_uuid() -> Uuid; השאר Anonymous לפי השם)
+VOLATILE_FUNCTIONS = {"rand", "random", "uuid", "gen_random_uuid", "setseed", "clock_timestamp", "timeofday",
+                      "nextval", "currval", "txid_current", "pg_sleep"}
+
+
+# הזמן של תחילת הטרנזקציה: יציב בתוך הרצה, אבל "30 הימים האחרונים" זזים - נשמרות רק ל-time_ttl
+# (sqlglot: now() -> CurrentTimestamp, CURRENT_DATE -> CurrentDate)
+TIME_FUNCTIONS = {"now", "current_timestamp", "current_date", "current_time", "localtime", "localtimestamp",
+                  "statement_timestamp", "transaction_timestamp"}
+
+
+def _function_names(tree):
+    return {(node.name if isinstance(node, exp.Anonymous) else node.sql_name()).lower() for node in tree.find_all(exp.Func)}
+
+
+def _is_volatile(tree):
+    return bool(_function_names(tree) & VOLATILE_FUNCTIONS)
+
+
+def _is_time_relative(tree):
+    return bool(_function_names(tree) & TIME_FUNCTIONS)
+
+
+def table_shapes(tables):
+    """שם טבלה -> fingerprint של העמודות והטיפוסים שלה (שם קצר, כמו ב-referenced_tables)"""
+    columns = {}
+    for t in sorted(tables.values(), key=lambda t: t["identity"]):
+        columns.setdefault(t["name"], []).append([(c["name"], c["type"]) for c in t["columns"]])
+    return {name: fingerprint(json.dumps(shape)) for name, shape in columns.items()}
+
+
+class ResultCache:
+    """cache של תוצאות execute_sql לפי SQL קנוני, עם invalidation לכל טבלה שהשאילתה קוראת.
+    רשומה תקפה אם לכל טבלה שלה: גרסת הטבלה לא השתנתה, או שהגיל שלה בתוך חלון ה-freshness של הטבלה"""
+
+    def __init__(self, memory, disk=None, ttl=None, invalidation="stats", check_interval=2.0, freshness=None,
+                 schemas=None, time_ttl=None):
+        self.memory = memory
+        self.disk = disk or NullCache()
+        self.ttl = ttl
+        self.time_ttl = time_ttl
+        self.invalidation = invalidation
+        self.check_interval = check_interval
+        self.freshness = freshness or {}
+        self.schemas = schemas or catalog.schemas
+        self.versions = {}       # table -> גרסה (מוני pg_stat או מונה NOTIFY מקומי)
+        self.shapes = {}         # table -> fingerprint של העמודות/טיפוסים מה-catalog
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "stale": 0, "skipped": 0, "version_checks": 0,
+                       "table_changes": 0, "schema_changes": 0}
+
+    # ---------- גרסאות טבלאות ----------
+
+    def _due(self):
+        if self.invalidation != "stats":
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = now
+            return True
+
+    def _observe(self, rows):
+        versions = {}
+        for name, modifications, live in rows:
+            # אותו שם בכמה schemas - גרסה משולבת
+            versions[name] = f"{versions[name]}|{modifications}:{live}" if name in versions else f"{modifications}:{live}"
+        with self._lock:
+            self._stats["version_checks"] += 1
+            self._stats["table_changes"] += sum(1 for t, v in versions.items() if self.versions.get(t, v) != v)
+            self.versions = versions
+
+    def check_versions(self):
+        """רענון גרסאות הטבלאות (במצב stats, לכל היותר פעם ב-check_interval), תמיד על ה-primary:
+        ב-replica המונים של pg_stat_user_tables לא סופרים שינויים שהגיעו ב-replication"""
+        if not self._due():
+            return
+        try:
+            with db.checkout(scoped=False) as conn:
+                with conn.cursor() as cur:
+                    cur.execute(TABLE_VERSIONS_SQL, (self.schemas,))
+                    self._observe(cur.fetchall())
+        except Exception as e:
+            log.warning("result cache version check failed: %s", e)
+
+    async def acheck_versions(self):
+        if not self._due():
+            return
+        try:
+            async with db.acheckout(scoped=False) as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(TABLE_VERSIONS_SQL, (self.schemas,))
+                    self._observe(await cur.fetchall())
+        except Exception as e:
+            log.warning("result cache version check failed: %s", e)
+
+    def tables_changed(self, payloads):
+        """handler ל-NOTIFY (מצב notify): כל הודעה מקדמת את גרסת הטבלה"""
+        with self._lock:
+            for table in set(payloads):
+                self.versions[table] = self.versions.get(table, 0) + 1
+                self._stats["table_changes"] += 1
+
+    def schema_changed(self, changed_catalog):
+        """listener של ה-catalog: רשומה של טבלה שהעמודות/הטיפוסים שלה השתנו לא תקפה יותר (נבדק ב-_valid);
+        אינדקס חדש לא פוסל כלום, וה-tier שעל הדיסק שורד אתחול כשהמבנה לא השתנה"""
+        shapes = table_shapes(changed_catalog.tables)
+        with self._lock:
+            self._stats["schema_changes"] += sum(1 for t, s in shapes.items() if self.shapes.get(t, s) != s)
+            self.shapes = shapes
+
+    # ---------- lookup / store ----------
+
+    def key(self, sql, params=None):
+        """(key, tables, ttl) לשאילתה; None אם אי אפשר לשמור אותה (לא מתפרסרת / volatile / בלי טבלאות)"""
+        try:
+            tree = sqlcheck.parse(sql)
+        except ValueError:
+            return None
+        tables = sqlcheck.referenced_tables(tree)
+        if not tables or _is_volatile(tree):
+            return None
+        ttl = self.ttl
+        if self.time_ttl and _is_time_relative(tree):
+            ttl = min(ttl, self.time_ttl) if ttl else self.time_ttl
+        return fingerprint(sqlcheck.canonical(tree) + "\x00" + json.dumps(params or {}, sort_keys=True)), tables, ttl
+
+    def _window(self, table):
+        return self.freshness.get(table, self.freshness.get("*", 0.0))
+
+    def _valid(self, entry, ttl):
+        age = time.time() - entry["created"]
+        if ttl and age > ttl:
+            return False
+        with self._lock:
+            versions = dict(self.versions)
+            shapes = dict(self.shapes)
+        if any(shapes.get(t) != s for t, s in entry.get("shapes", {}).items()):
+            return False
+        return all(versions.get(t) == v or age <= self._window(t) for t, v in entry["versions"].items())
+
+    def get(self, sql, params=None):
+        """{"result", "truncated", "age"} או None"""
+        keyed = self.key(sql, params)
+        if keyed is None:
+            return None
+        key, _, ttl = keyed
+        entry = self.memory.get(key)
+        if entry is None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        if entry is not None and not self._valid(entry, ttl):
+            self.memory.delete(key)
+            self.disk.delete(key)
+            with self._lock:
+                self._stats["stale"] += 1
+            entry = None
+        with self._lock:
+            self._stats["hits" if entry is not None else "misses"] += 1
+        if entry is None:
+            return None
+        return {"result": entry["result"], "truncated": entry["truncated"], "age": time.time() - entry["created"]}
+
+    def set(self, sql, result, truncated=None, params=None):
+        keyed = self.key(sql, params)
+        if keyed is None:
+            with self._lock:
+                self._stats["skipped"] += 1
+            return False
+        key, tables, _ = keyed
+        with self._lock:
+            versions = {t: self.versions.get(t) for t in tables}
+            shapes = {t: self.shapes.get(t) for t in tables}
+        entry = {"tables": tables, "versions": versions, "shapes": shapes, "created": time.time(),
+                 "result": result, "truncated": truncated}
+        payload = json.dumps(entry, default=str)
+        if self.memory.set(key, entry, size=len(payload)) is False:
+            # גדול מכל ה-cache בזיכרון - רק לדיסק
+            with self._lock:
+                self._stats["skipped"] += 1
+        self.disk.set(key, entry)
+        with self._lock:
+            self._stats["stores"] += 1
+        return True
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            stats = {
+                "invalidation": self.invalidation,
+                "freshness": self.freshness,
+                "tables_tracked": len(self.versions),
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+            }
+        return {**stats, "memory": self.memory.stats(), "disk": self.disk.stats()}
+
+
+def make_result_cache(config=RESULT_CACHE_CONFIG):
+    if not config["enabled"]:
+        return ResultCache(NullCache(), invalidation=config["invalidation"])
+    disk = SQLiteCache(config["path"], max_entries=config["disk_max_entries"], ttl=config["ttl"]) if config["path"] else None
+    return ResultCache(
+        MemoryCache(config["max_entries"], config["ttl"], max_bytes=config["max_bytes"]),
+        disk=disk,
+        ttl=config["ttl"],
+        time_ttl=config["time_ttl"],
+        invalidation=config["invalidation"],
+        check_interval=config["check_interval"],
+        freshness=config["freshness"],
+    )
+
+
+result_cache = make_result_cache()
+catalog.subscribe(result_cache.schema_changed)
+if result_cache.invalidation == "notify":
+    catalog.on_notify(CHANGE_CHANNEL, result_cache.tables_changed)
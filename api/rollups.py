@@ -0,0 +1,301 @@
+import os
+import threading
+
+from sqlglot import exp
+
+import sqlcheck
+import tracing
+from catalog import catalog
+from schema_index import schema_index
+
+log = tracing.get_logger("rollups")
+
+ROLLUP_CONFIG = {
+    "enabled": os.getenv("ROLLUPS", "1") == "1",
+}
+
+_ITEM_MEASURES = {
+    "items.qty": "qty",
+    "items.qty * items.unit_price": "revenue",
+    "items.unit_price * items.qty": "revenue",
+}
+
+# ה-rollups מ-db/init/006_rollups.sql (לפי סדר עדיפות - הקטן קודם).
+# facts: טבלאות העובדה שה-rollup מחליף; fact_joins: תנאי ה-JOIN ביניהן שה-rollup כבר מכיל;
+# dimensions: עמודת עובדה -> עמודת ה-rollup; measures: הביטוי בתוך SUM -> עמודת ה-rollup;
+# count: עמודת ה-COUNT(*); casts: טיפוס התוצאה המקורי (SUM על bigint מחזיר numeric)
+ROLLUPS = [
+    {
+        "name": "rollup_daily_revenue",
+        "facts": ["orders"],
+        "fact_joins": [],
+        "dimensions": {"orders.order_date": "day"},
+        "measures": {"orders.total_amount": "revenue"},
+        "count": "orders",
+        "casts": {"orders": "BIGINT"},
+    },
+    {
+        "name": "rollup_customer_orders",
+        "facts": ["orders"],
+        "fact_joins": [],
+        "dimensions": {"orders.customer_id": "customer_id"},
+        "measures": {"orders.total_amount": "revenue"},
+        "count": "orders",
+        "casts": {"orders": "BIGINT"},
+    },
+    {
+        "name": "rollup_customer_items",
+        "facts": ["items", "orders"],
+        "fact_joins": [{"items.order_id", "orders.id"}],
+        "dimensions": {"orders.customer_id": "customer_id"},
+        "measures": _ITEM_MEASURES,
+        "count": "lines",
+        "casts": {"lines": "BIGINT", "qty": "BIGINT"},
+    },
+    {
+        "name": "rollup_sku_sales",
+        "facts": ["items"],
+        "fact_joins": [],
+        "dimensions": {"items.sku": "sku", "items.product_name": "product_name"},
+        "measures": _ITEM_MEASURES,
+        "count": "lines",
+        "casts": {"lines": "BIGINT", "qty": "BIGINT"},
+    },
+]
+
+
+class _NoMatch(Exception):
+    pass
+
+
+def _conjuncts(node):
+    return list(node.flatten()) if isinstance(node, exp.And) else [node]
+
+
+def _sources(tree):
+    """[{"alias", "table", "join"}] לכל מקור ב-FROM/JOIN; None אם יש משהו שאינו טבלה או JOIN פנימי עם ON"""
+    from_ = tree.args.get("from_") or tree.args.get("from")
+    if from_ is None or not isinstance(from_.this, exp.Table):
+        return None
+    sources = [{"alias": from_.this.alias_or_name, "table": from_.this.name, "join": None, "node": from_.this}]
+    for join in tree.args.get("joins") or []:
+        # LEFT/RIGHT/FULL משנים את המשמעות של COUNT על שורות חסרות; USING/NATURAL/פסיק - בלי ON מפורש
+        if (not isinstance(join.this, exp.Table) or join.side or join.kind not in ("", "INNER")
+                or join.args.get("method") or join.args.get("using") or join.args.get("on") is None):
+            return None
+        sources.append({"alias": join.this.alias_or_name, "table": join.this.name, "join": join, "node": join.this})
+    aliases = [s["alias"] for s in sources]
+    if len(set(aliases)) != len(aliases) or not all(isinstance(s["node"].this, exp.Identifier) for s in sources):
+        return None
+    return sources
+
+
+class _Query:
+    """שאילתה אחת מול rollup אחד: פענוח עמודות והחלפתן"""
+
+    def __init__(self, tree, sources, rollup):
+        self.tree = tree
+        self.sources = sources
+        self.rollup = rollup
+        self.tables = {s["alias"]: s["table"] for s in sources}
+        self.outputs = {s.alias for s in tree.selects if s.alias}
+        self.facts = set(rollup["facts"])
+        first = next(s for s in sources if s["table"] in self.facts)
+        self.alias = first["alias"] if first["alias"] != first["table"] else rollup["name"]
+
+    def _columns(self, table):
+        info = schema_index.tables.get(table)
+        return {c["name"] for c in info["columns"]} if info else set()
+
+    def resolve(self, column):
+        """(alias, table, column) לעמודה; None לעמודת פלט (alias מה-SELECT); _NoMatch אם לא ידוע"""
+        name = column.name
+        if column.table:
+            if column.table not in self.tables:
+                raise _NoMatch(f"unknown alias {column.table}")
+            return column.table, self.tables[column.table], name
+        owners = [alias for alias, table in self.tables.items() if name in self._columns(table)]
+        if len(owners) == 1:
+            return owners[0], self.tables[owners[0]], name
+        if not owners and name in self.outputs:
+            return None
+        raise _NoMatch(f"cannot resolve column {name}")
+
+    def qualified(self, node):
+        # הביטוי עם שמות טבלאות במקום aliases ("items.qty * items.unit_price") להשוואה מול measures
+        def qualify(column):
+            if not isinstance(column, exp.Column):
+                return column
+            resolved = self.resolve(column)
+            if resolved is None:
+                raise _NoMatch("output alias inside an aggregate")
+            return exp.column(resolved[2], table=resolved[1])
+
+        return node.transform(qualify).sql(dialect="postgres").lower()
+
+    def measure(self, agg):
+        """SUM(measure) / COUNT(*) -> אגרגציה על עמודת ה-rollup"""
+        if agg.find(exp.Distinct) is not None:
+            raise _NoMatch("DISTINCT aggregate")
+        if isinstance(agg, exp.Count):
+            arg = agg.this
+            if not isinstance(arg, exp.Star):
+                # COUNT(pk) של טבלת עובדה = COUNT(*)
+                resolved = self.resolve(arg) if isinstance(arg, exp.Column) else None
+                if resolved is None or resolved[1] not in self.facts or resolved[2] != "id":
+                    raise _NoMatch("COUNT of a non-key expression")
+            name = self.rollup["count"]
+            total = exp.func("COALESCE", exp.Sum(this=exp.column(name, table=self.alias)), exp.Literal.number(0))
+        elif isinstance(agg, exp.Sum):
+            name = self.rollup["measures"].get(self.qualified(agg.this))
+            if name is None:
+                raise _NoMatch("SUM of an expression the rollup does not hold")
+            total = exp.Sum(this=exp.column(name, table=self.alias))
+        else:
+            raise _NoMatch(f"{agg.sql_name()} cannot be computed from the rollup")
+        cast = self.rollup["casts"].get(name)
+        return exp.Cast(this=total, to=exp.DataType.build(cast)) if cast else total
+
+    def dimension(self, column):
+        resolved = self.resolve(column)
+        if resolved is None:
+            return column
+        alias, table, name = resolved
+        if table not in self.facts:
+            return exp.column(name, table=alias)
+        target = self.rollup["dimensions"].get(f"{table}.{name}")
+        if target is None:
+            raise _NoMatch(f"{table}.{name} is not a dimension of the rollup")
+        return exp.column(target, table=self.alias)
+
+    def is_fact_join(self, condition):
+        if not isinstance(condition, exp.EQ):
+            return False
+        sides = [condition.this, condition.expression]
+        if not all(isinstance(s, exp.Column) for s in sides):
+            return False
+        resolved = [self.resolve(s) for s in sides]
+        if any(r is None or r[1] not in self.facts for r in resolved):
+            return False
+        pair = {f"{r[1]}.{r[2]}" for r in resolved}
+        if pair not in self.rollup["fact_joins"]:
+            raise _NoMatch(f"join {' = '.join(sorted(pair))} is not part of the rollup")
+        return True
+
+    def rewrite(self):
+        tree = self.tree
+        fact_sources = [s for s in self.sources if s["table"] in self.facts]
+        if sorted(s["table"] for s in fact_sources) != sorted(self.facts):
+            raise _NoMatch("fact tables do not match")
+
+        # מקורות: טבלת העובדה הראשונה -> ה-rollup, השאר יורדות (תנאי ה-JOIN שלהן שאינם בין עובדות -> WHERE)
+        joined, moved = set(), []
+        placed = False
+        for source in self.sources:
+            join = source["join"]
+            conditions = _conjuncts(join.args["on"]) if join is not None else []
+            kept = []
+            for condition in conditions:
+                if self.is_fact_join(condition):
+                    joined.add(frozenset(f"{r[1]}.{r[2]}" for r in
+                                         (self.resolve(condition.this), self.resolve(condition.expression))))
+                else:
+                    kept.append(condition)
+            if source["table"] not in self.facts:
+                continue
+            if not placed:
+                table = exp.Table(this=exp.to_identifier(self.rollup["name"]))
+                if self.alias != self.rollup["name"]:
+                    table.set("alias", exp.TableAlias(this=exp.to_identifier(self.alias)))
+                source["node"].replace(table)
+                if join is not None:
+                    if not kept:
+                        raise _NoMatch("rollup would be cross joined")
+                    join.set("on", exp.and_(*kept))
+                placed = True
+            else:
+                moved.extend(kept)
+                join.pop()
+        if {frozenset(j) for j in self.rollup["fact_joins"]} != joined:
+            raise _NoMatch("fact tables are not joined the way the rollup is")
+        if moved:
+            where = tree.args.get("where")
+            tree.where(exp.and_(*moved, *([where.this] if where is not None else [])), append=False, copy=False)
+
+        for agg in list(tree.find_all(exp.AggFunc)):
+            agg.replace(self.measure(agg))
+        for column in list(tree.find_all(exp.Column)):
+            if column.table == self.alias and column.find_ancestor(exp.Sum) is not None:
+                continue   # עמודות ה-rollup שנוצרו מהאגרגציות
+            column.replace(self.dimension(column))
+        return tree
+
+
+class RollupRewriter:
+    """מנתב שאילתות אגרגציה על orders/items ל-rollups הממומשים (db/init/006_rollups.sql).
+    השכתוב נעשה רק כשהתוצאה זהה: כל עמודת עובדה מחוץ לאגרגציה היא dimension של ה-rollup,
+    כל אגרגציה היא SUM של measure או COUNT(*), וה-JOINs פנימיים"""
+
+    def __init__(self, rollups=ROLLUPS, enabled=True):
+        self.rollups = rollups
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {"checked": 0, "rewritten": 0, "by_rollup": {}}
+
+    @staticmethod
+    def _available(rollup):
+        # בלי catalog (עדיין לא נטען) - סומכים על ה-init scripts
+        return not catalog.loaded or catalog.table(rollup["name"]) is not None
+
+    @staticmethod
+    def _candidate(tree):
+        if not isinstance(tree, exp.Select) or tree.args.get("with"):
+            return False
+        if any(s is not tree for s in tree.find_all(exp.Select)) or tree.find(exp.Window):
+            return False
+        if any(star.find_ancestor(exp.Count) is None for star in tree.find_all(exp.Star)):
+            return False
+        # בלי GROUP BY ובלי אגרגציה - שורה לכל רשומה, אין מה לקצר
+        return tree.args.get("group") is not None or tree.find(exp.AggFunc) is not None
+
+    def rewrite(self, sql):
+        """(sql, rollup) אם השאילתה ניתנת לחישוב מ-rollup, אחרת None"""
+        if not self.enabled or not sql:
+            return None
+        try:
+            tree = sqlcheck.parse(sql)
+        except ValueError:
+            return None
+        if not self._candidate(tree):
+            return None
+        sources = _sources(tree)
+        if sources is None:
+            return None
+        schema_index.ensure_loaded()
+        with self._lock:
+            self._stats["checked"] += 1
+
+        tables = {s["table"] for s in sources}
+        for rollup in self.rollups:
+            if not set(rollup["facts"]) <= tables or not self._available(rollup):
+                continue
+            copy = tree.copy()
+            try:
+                rewritten = _Query(copy, _sources(copy), rollup).rewrite()
+            except _NoMatch as e:
+                log.debug("rollup %s does not match: %s", rollup["name"], e)
+                continue
+            with self._lock:
+                self._stats["rewritten"] += 1
+                self._stats["by_rollup"][rollup["name"]] = self._stats["by_rollup"].get(rollup["name"], 0) + 1
+            return rewritten.sql(dialect="postgres") + ";", rollup["name"]
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {"enabled": self.enabled, "rollups": [r["name"] for r in self.rollups],
+                    "checked": self._stats["checked"], "rewritten": self._stats["rewritten"],
+                    "by_rollup": dict(self._stats["by_rollup"])}
+
+
+rollup_rewriter = RollupRewriter(enabled=ROLLUP_CONFIG["enabled"])
@@ -0,0 +1,277 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from cache import fingerprint, normalize_question
+from catalog import catalog
+
+SCHEMA_PATH = "docs/schema_summaries.md"
+
+SCHEMA_INDEX_CONFIG = {
+    "prune": os.getenv("SCHEMA_PRUNE", "1") == "1",  # 0 = תמיד כל ה-schema
+}
+
+# כשה-catalog לא נטען (אין DB) וגם אין קובץ
+DEFAULT_SCHEMA = """
+customers(id, name, country)
+orders(id, customer_id, order_date, total_amount)
+items(id, order_id, sku, product_name, qty, unit_price)
+"""
+
+_TABLE_LINE = re.compile(r"^\s*(\w+)\s*\(([^)]*)\)\s*$")
+_ALIASES_LINE = re.compile(r"^\s*--\s*aliases\s*:\s*(.*)$", re.IGNORECASE)
+
+# תחיליות עבריות שנצמדות למילה ("מישראל", "ללקוחות")
+_HE_PREFIX = re.compile(r"^[והבלכשמ]{1,2}(?=\w{3,})")
+
+
+def estimate_tokens(text):
+    # אומדן גס (~4 תווים לטוקן) - מספיק להשוואה בין פרומפט מלא למקוצץ
+    return max(1, len(text) // 4)
+
+
+def _terms(text):
+    """מילים מנורמלות + וריאנטים בלי תחילית עברית / סיומת רבים באנגלית"""
+    terms = set()
+    for word in normalize_question(text).replace("_", " ").split():
+        terms.add(word)
+        stripped = _HE_PREFIX.sub("", word)
+        terms.add(stripped)
+        if word.endswith("s") and len(word) > 3:
+            terms.add(word[:-1])
+        if stripped.endswith(("ים", "ות")) and len(stripped) > 4:
+            terms.add(stripped[:-2])
+    return terms
+
+
+def parse_summaries(text):
+    """קובץ ה-summaries -> {table: {"columns", "notes", "aliases"}}; שורות שאינן טבלה/הערה מתעלמים מהן"""
+    tables = {}
+    current = None
+    for line in text.splitlines():
+        m = _TABLE_LINE.match(line)
+        stripped = line.strip()
+        if m:
+            current = m.group(1)
+            cols = [c.strip() for c in m.group(2).split(",") if c.strip()]
+            tables[current] = {"columns": [{"name": c, "type": None} for c in cols], "notes": [], "aliases": []}
+        elif current and stripped.startswith("--"):
+            aliases = _ALIASES_LINE.match(line)
+            if aliases:
+                tables[current]["aliases"].extend(a.strip() for a in aliases.group(1).split(",") if a.strip())
+            else:
+                tables[current]["notes"].append(stripped)
+        elif stripped:
+            current = None
+    return tables
+
+
+class SchemaIndex:
+    """אינדקס של ה-schema לפרומפט: טבלאות, עמודות, FKs וערכים לדוגמה.
+    נבנה מה-catalog החי + ההערות/aliases בקובץ ה-summaries; נבנה מחדש כשאחד מהם משתנה"""
+
+    def __init__(self, path=SCHEMA_PATH, catalog=catalog):
+        self.path = path
+        self.catalog = catalog
+        self.tables = {}
+        self.edges = {}   # table -> {שכן: "a.x = b.y"}
+        self.source = None
+        self.version = None
+        self.loaded_at = None
+        self._mtime = None
+        self._full_text = ""
+        self._lock = threading.Lock()
+        self._stats = {"prompts": 0, "pruned": 0, "full_tokens": 0, "prompt_tokens": 0, "reloads": 0}
+
+    # ---------- בנייה ----------
+
+    def _file_mtime(self):
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return None
+
+    def _read_summaries(self):
+        try:
+            with open(self.path) as f:
+                return parse_summaries(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def _catalog_tables(self):
+        """טבלאות ה-catalog בפורמט של האינדקס (FK מרובה עמודות -> זוגות)"""
+        if not self.catalog.loaded:
+            return None
+        return {
+            name: {
+                "columns": [{"name": c["name"], "type": c["type"]} for c in t["columns"]],
+                "fks": [(col, fk["ref_table"], ref_col)
+                        for fk in t["fks"] for col, ref_col in zip(fk["columns"] or [], fk["ref_columns"] or [])],
+                "samples": t["samples"],
+            }
+            for name, t in self.catalog.named_tables().items()
+        }
+
+    def _build(self, db_tables, summaries):
+        tables = {}
+        edges = {}
+        for name, info in (db_tables or summaries or parse_summaries(DEFAULT_SCHEMA)).items():
+            summary = summaries.get(name, {})
+            tables[name] = {
+                "columns": info["columns"],
+                "notes": summary.get("notes", []),
+                "aliases": summary.get("aliases", []),
+                "samples": info.get("samples", {}),
+                "fks": info.get("fks", []),
+            }
+        for name, info in tables.items():
+            for column, ref_table, ref_column in info["fks"] or self._inferred_fks(info, tables):
+                if ref_table in tables:
+                    cond = f"{name}.{column} = {ref_table}.{ref_column}"
+                    edges.setdefault(name, {})[ref_table] = cond
+                    edges.setdefault(ref_table, {})[name] = cond
+        for name, info in tables.items():
+            info["terms"] = self._table_terms(name, info)
+        return tables, edges
+
+    @staticmethod
+    def _inferred_fks(info, tables):
+        # בלי DB (רק הקובץ): customer_id -> customers.id לפי מוסכמת השמות
+        fks = []
+        for column in info["columns"]:
+            if column["name"].endswith("_id"):
+                base = column["name"][:-3]
+                for ref_table in (base, base + "s", base + "es"):
+                    if ref_table in tables:
+                        fks.append((column["name"], ref_table, "id"))
+                        break
+        return fks
+
+    def _table_terms(self, name, info):
+        # משקל לכל מונח: שם טבלה/alias חזק, עמודה/ערך לדוגמה חלש יותר
+        terms = {}
+        for column in info["columns"]:
+            for t in _terms(column["name"]):
+                terms[t] = max(terms.get(t, 0), 1)
+        for values in info["samples"].values():
+            for value in values:
+                for t in _terms(str(value)):
+                    terms[t] = max(terms.get(t, 0), 2)
+        for alias in [name] + info["aliases"]:
+            for t in _terms(alias):
+                terms[t] = 3
+        return terms
+
+    def load(self, *_):
+        """בנייה מחדש מה-catalog והקובץ (נקרא גם כ-listener של ה-catalog)"""
+        db_tables = self._catalog_tables()
+        summaries = self._read_summaries()
+        tables, edges = self._build(db_tables, summaries)
+        full = self.render(tables, edges, list(tables))
+        with self._lock:
+            self.tables, self.edges = tables, edges
+            self.source = "catalog" if db_tables else ("file" if summaries else "default")
+            self.version = fingerprint(full)
+            self.loaded_at = time.time()
+            self._mtime = self._file_mtime()
+            self._full_text = full
+            self._stats["reloads"] += 1
+        return self
+
+    def ensure_loaded(self):
+        """טעינה עצלה + hot reload כשקובץ ה-summaries השתנה"""
+        if self.version is None or self._file_mtime() != self._mtime:
+            self.load()
+        return self
+
+    # ---------- שליפה ----------
+
+    def relevant_tables(self, question):
+        """הטבלאות שהשאלה נוגעת בהן + הטבלאות במסלול ה-FK ביניהן; אין התאמה -> כולן"""
+        self.ensure_loaded()
+        terms = _terms(question)
+        scores = {name: sum(w for t, w in info["terms"].items() if t in terms) for name, info in self.tables.items()}
+        selected = [name for name, score in sorted(scores.items(), key=lambda kv: -kv[1]) if score > 0]
+        if not selected:
+            return list(self.tables)
+        return self._expand_fk_paths(selected)
+
+    def _fk_path(self, start, goal):
+        # BFS על גרף ה-FK (לא מכוון)
+        prev = {start: None}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            if node == goal:
+                path = []
+                while node is not None:
+                    path.append(node)
+                    node = prev[node]
+                return path
+            for neighbor in self.edges.get(node, {}):
+                if neighbor not in prev:
+                    prev[neighbor] = node
+                    queue.append(neighbor)
+        return []
+
+    def _expand_fk_paths(self, selected):
+        result = list(selected)
+        for i, a in enumerate(selected):
+            for b in selected[i + 1:]:
+                for table in self._fk_path(a, b):
+                    if table not in result:
+                        result.append(table)
+        return result
+
+    @staticmethod
+    def render(tables, edges, names):
+        """טקסט ה-schema לפרומפט, באותו פורמט של קובץ ה-summaries"""
+        lines = []
+        for name in [n for n in tables if n in names]:  # סדר קבוע, לא לפי ציון
+            info = tables[name]
+            lines.append(f"{name}({', '.join(c['name'] for c in info['columns'])})")
+            lines.extend(info["notes"])
+            noted = " ".join(info["notes"])
+            for column, values in info["samples"].items():
+                if column not in noted:
+                    lines.append(f"-- {column} values: {', '.join(map(str, values))}")
+        joins = sorted({cond for name in names for other, cond in edges.get(name, {}).items() if other in names})
+        if joins:
+            lines.append("")
+            lines.append("-- joins: " + "; ".join(joins))
+        return "\n".join(lines) + "\n"
+
+    def prompt_schema(self, question):
+        """ה-schema לפרומפט של השאלה: רק הטבלאות הרלוונטיות (SCHEMA_PRUNE=0 -> הכל)"""
+        self.ensure_loaded()
+        names = self.relevant_tables(question) if SCHEMA_INDEX_CONFIG["prune"] else list(self.tables)
+        text = self.render(self.tables, self.edges, names)
+        with self._lock:
+            self._stats["prompts"] += 1
+            self._stats["pruned"] += len(names) < len(self.tables)
+            self._stats["full_tokens"] += estimate_tokens(self._full_text)
+            self._stats["prompt_tokens"] += estimate_tokens(text)
+        return text
+
+    def fingerprint(self):
+        """גרסת ה-schema המלא - למפתח ה-sql_cache (לא תלוי בקיצוץ לפי שאלה)"""
+        return self.ensure_loaded().version
+
+    def stats(self):
+        with self._lock:
+            full, used = self._stats["full_tokens"], self._stats["prompt_tokens"]
+            return {
+                "source": self.source,
+                "version": self.version,
+                "tables": len(self.tables),
+                "loaded_at": self.loaded_at,
+                **self._stats,
+                "tokens_saved": full - used,
+                "token_savings_rate": round(1 - used / full, 3) if full else 0.0,
+            }
+
+
+schema_index = SchemaIndex()
+catalog.subscribe(schema_index.load)
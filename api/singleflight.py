@@ -0,0 +1,165 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import tracing
+from cache import fingerprint, normalize_question
+
+SINGLEFLIGHT_CONFIG = {
+    "enabled": os.getenv("SINGLEFLIGHT", "1") == "1",
+    "reuse_ttl": float(os.getenv("SINGLEFLIGHT_REUSE_TTL", "0")),   # שניות לשימוש חוזר בתוצאה שהסתיימה (0 = רק בזמן ריצה)
+    "max_recent": int(os.getenv("SINGLEFLIGHT_MAX_RECENT", "1000")),
+}
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """איחוד בקשות זהות שרצות במקביל: הראשונה מריצה, השאר מחכות לתוצאה שלה.
+    do() לקוד סינכרוני (threads), ado() לקוד async; reuse_ttl > 0 - גם תוצאה שהסתיימה לפני רגע"""
+
+    def __init__(self, reuse_ttl=0.0, max_recent=1000, enabled=True):
+        self.reuse_ttl = reuse_ttl
+        self.max_recent = max_recent
+        self.enabled = enabled
+        self._calls = {}    # key -> _Call (do)
+        self._tasks = {}    # key -> asyncio.Task (ado)
+        self._recent = {}   # key -> (result, expires_at)
+        self._lock = threading.Lock()
+        self._stats = {"executions": 0, "coalesced": 0, "reused": 0, "errors": 0}
+
+    @staticmethod
+    def key(question, **params):
+        """שאלה מנורמלת + הפרמטרים שמשפיעים על התוצאה"""
+        return fingerprint(normalize_question(question) + "\x00" + json.dumps(params, sort_keys=True, default=str))
+
+    # ---------- תוצאות אחרונות (תחת lock) ----------
+
+    def _reuse(self, key):
+        item = self._recent.get(key)
+        if item is None:
+            return None
+        result, expires_at = item
+        if expires_at < time.monotonic():
+            del self._recent[key]
+            return None
+        return result
+
+    def _remember(self, key, result):
+        if self.reuse_ttl <= 0:
+            return
+        now = time.monotonic()
+        if len(self._recent) >= self.max_recent:
+            self._recent = {k: v for k, v in self._recent.items() if v[1] >= now}
+            while len(self._recent) >= self.max_recent:
+                self._recent.pop(next(iter(self._recent)))
+        self._recent[key] = (result, now + self.reuse_ttl)
+
+    def _count(self, outcome):
+        self._stats[outcome] += 1
+        tracing.record_singleflight(outcome)
+
+    @staticmethod
+    def _copy(result):
+        # כל מבקש מקבל dict משלו (ה-endpoint לא משנה את השורות עצמן)
+        return dict(result) if isinstance(result, dict) else result
+
+    # ---------- סינכרוני ----------
+
+    def do(self, key, fn):
+        if not self.enabled:
+            return fn()
+        with self._lock:
+            reused = self._reuse(key)
+            if reused is not None:
+                self._count("reused")
+                return self._copy(reused)
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._count("coalesced")
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return self._copy(call.result)
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if call.error is None:
+                    self._count("executions")
+                    self._remember(key, call.result)
+                else:
+                    self._count("errors")
+            call.event.set()
+        return self._copy(call.result)
+
+    # ---------- async ----------
+
+    async def _arun(self, key, fn):
+        try:
+            result = await fn()
+        except BaseException:
+            with self._lock:
+                self._count("errors")
+            raise
+        else:
+            with self._lock:
+                self._count("executions")
+                self._remember(key, result)
+            return result
+        finally:
+            with self._lock:
+                if self._tasks.get(key) is asyncio.current_task():
+                    del self._tasks[key]
+
+    async def ado(self, key, fn):
+        """fn: פונקציה שמחזירה coroutine. ההרצה היא task נפרד - ביטול של המבקש הראשון לא מבטל לאחרים"""
+        if not self.enabled:
+            return await fn()
+        with self._lock:
+            reused = self._reuse(key)
+            if reused is not None:
+                self._count("reused")
+                return self._copy(reused)
+            task = self._tasks.get(key)
+            if task is None or task.get_loop() is not asyncio.get_running_loop():
+                task = self._tasks[key] = asyncio.ensure_future(self._arun(key, fn))
+            else:
+                self._count("coalesced")
+        return self._copy(await asyncio.shield(task))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "reuse_ttl": self.reuse_ttl,
+                "in_flight": len(self._calls) + len(self._tasks),
+                "recent": len(self._recent),
+                **self._stats,
+            }
+
+
+singleflight = SingleFlight(
+    reuse_ttl=SINGLEFLIGHT_CONFIG["reuse_ttl"],
+    max_recent=SINGLEFLIGHT_CONFIG["max_recent"],
+    enabled=SINGLEFLIGHT_CONFIG["enabled"],
+)
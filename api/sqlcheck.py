@@ -0,0 +1,172 @@
+import sqlglot
+from sqlglot import exp
+
+# פעולות כתיבה שיכולות להסתתר גם בתוך CTE (WITH d AS (DELETE ... RETURNING *))
+WRITE_NODES = (exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Into, exp.Create, exp.Drop,
+               exp.Alter, exp.TruncateTable, exp.Command)
+
+
+# מה שמחייב לקרוא את כל הקלט לפני השורה הראשונה (LIMIT לא עוצר את הסריקה)
+def _consumes_all(select):
+    if select.args.get("group") or select.args.get("order") or select.args.get("distinct"):
+        return True
+    if select.args.get("joins"):
+        return True
+    return any(select.find_all(exp.AggFunc, exp.Window))
+
+
+def parse(sql):
+    """משפט SQL יחיד -> AST; ValueError אם לא מתפרסר או שיש יותר ממשפט אחד"""
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="postgres") if s is not None]
+    except sqlglot.errors.ParseError as e:
+        raise ValueError(f"Invalid SQL: {e}")
+    if not statements:
+        raise ValueError("Empty SQL")
+    if len(statements) > 1:
+        raise ValueError("Only a single statement is allowed")
+    return statements[0]
+
+
+def statement_error(tree):
+    """סיבת חסימה אם זו לא שאילתת קריאה בלבד, אחרת None"""
+    if not isinstance(tree, exp.Query):
+        return f"Only SELECT queries are allowed (got {tree.key.upper()})"
+    node = tree.find(*WRITE_NODES)
+    if node is not None:
+        return f"Only SELECT queries are allowed ({node.key.upper()} inside the query)"
+    return None
+
+
+def outer_limit(tree):
+    """ערך ה-LIMIT/FETCH של השאילתה החיצונית; None אם אין (או LIMIT ALL / ביטוי)"""
+    node = tree.args.get("limit")
+    if node is None:
+        return None
+    value = node.args.get("count") if isinstance(node, exp.Fetch) else node.expression
+    if isinstance(value, exp.Literal) and not value.is_string:
+        try:
+            return int(value.this)
+        except ValueError:
+            return None
+    return None
+
+
+def with_limit(sql, tree, limit_value):
+    """SQL עם LIMIT על השאילתה החיצונית (לא בתוך CTE/תת-שאילתה)"""
+    if tree.args.get("limit") is None and "--" not in sql:
+        # אין LIMIT חיצוני - מוסיפים בסוף בלי לשנות את הטקסט המקורי
+        return f"{sql.strip().rstrip(';').rstrip()} LIMIT {limit_value};"
+    return tree.limit(limit_value).sql(dialect="postgres") + ";"
+
+
+def _cte_names(tree):
+    return {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+
+
+def _is_table(node, ctes):
+    # טבלה אמיתית: לא CTE ולא פונקציה בתפקיד טבלה (generate_series)
+    return isinstance(node, exp.Table) and isinstance(node.this, exp.Identifier) and node.name not in ctes
+
+
+def referenced_tables(tree):
+    """כל הטבלאות האמיתיות שהשאילתה קוראת (כולל בתוך CTE/תת-שאילתות), בלי שמות CTE"""
+    ctes = _cte_names(tree)
+    return sorted({t.name for t in tree.find_all(exp.Table) if _is_table(t, ctes)})
+
+
+def canonical(tree):
+    """SQL קנוני: רווחים, אותיות ומזהים לא מצוטטים מנורמלים, בלי הערות (למפתח cache של תוצאות)"""
+    return tree.sql(dialect="postgres", normalize=True, comments=False)
+
+
+def _own_tables(select, ctes):
+    """הטבלאות שה-SELECT סורק ישירות (FROM + JOIN), בלי תת-שאילתות"""
+    sources = []
+    from_ = select.args.get("from_") or select.args.get("from")  # השם השתנה בין גרסאות sqlglot
+    if from_:
+        sources.append(from_.this)
+    sources.extend(j.this for j in select.args.get("joins") or [])
+    return [s for s in sources if _is_table(s, ctes)]
+
+
+def _linked_in_where(where, alias):
+    # FROM a, b WHERE a.id = b.a_id: שוויון בין עמודה של הטבלה לעמודה של טבלה אחרת
+    if where is None:
+        return False
+    for eq in where.find_all(exp.EQ):
+        left, right = eq.this, eq.expression
+        if isinstance(left, exp.Column) and isinstance(right, exp.Column):
+            tables = {left.table, right.table}
+            if (alias in tables and len(tables) == 2) or "" in tables:
+                return True
+    return False
+
+
+def cartesian_joins(tree):
+    """JOINs בלי תנאי: CROSS JOIN, ON TRUE, או פסיק בלי שוויון מקשר ב-WHERE"""
+    ctes = _cte_names(tree)
+    found = []
+    for select in tree.find_all(exp.Select):
+        where = select.args.get("where")
+        for join in select.args.get("joins") or []:
+            target = join.this
+            # USING / NATURAL מקשרים לפי שמות העמודות
+            if isinstance(target, exp.Lateral) or join.args.get("using") or join.args.get("method"):
+                continue
+            on = join.args.get("on")
+            if on is not None and not (isinstance(on, exp.Boolean) and on.this):
+                continue
+            if on is None and join.args.get("kind") != "CROSS" and _linked_in_where(where, target.alias_or_name):
+                continue
+            found.append({
+                "table": target.alias_or_name,
+                "kind": "on_true" if on is not None else (join.args.get("kind") or "comma").lower(),
+                "derived": not _is_table(target, ctes),  # תת-שאילתה/פונקציה - אולי קטנה
+            })
+    return found
+
+
+def unbounded_scans(tree, large_tables):
+    """טבלאות גדולות שנסרקות במלואן: אין WHERE ב-SELECT שסורק אותן וה-SELECT צורך את כל הקלט"""
+    ctes = _cte_names(tree)
+    found = []
+    for select in tree.find_all(exp.Select):
+        if select.args.get("where") is not None or not _consumes_all(select):
+            continue
+        for table in _own_tables(select, ctes):
+            if table.name in large_tables:
+                found.append(table.name)
+    return sorted(set(found))
+
+
+def analyze(sql, large_tables=()):
+    """עובדות סטטיות על השאילתה, לשימוש ה-guardrails (בלי DB)"""
+    tree = parse(sql)
+    facts = {
+        "tree": tree,
+        "statement_error": statement_error(tree),
+        "limit": None,
+        "cartesian_joins": [],
+        "unbounded_scans": [],
+        "tables": [],
+        "simple": False,
+        "consumes_all": False,
+        "filtered": False,
+    }
+    if facts["statement_error"]:
+        return facts
+    ctes = _cte_names(tree)
+    selects = list(tree.find_all(exp.Select))
+    facts["limit"] = outer_limit(tree)
+    facts["cartesian_joins"] = cartesian_joins(tree)
+    facts["unbounded_scans"] = unbounded_scans(tree, large_tables)
+    facts["tables"] = referenced_tables(tree)
+    # SELECT יחיד על טבלה אחת, בלי JOIN/CTE/UNION/תת-שאילתות
+    facts["simple"] = (
+        isinstance(tree, exp.Select) and len(selects) == 1 and not tree.args.get("with")
+        and not tree.args.get("joins") and len(_own_tables(tree, ctes)) == 1
+    )
+    facts["consumes_all"] = isinstance(tree, exp.Select) and _consumes_all(tree)
+    facts["filtered"] = isinstance(tree, exp.Select) and tree.args.get("where") is not None
+    return facts
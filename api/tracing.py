@@ -0,0 +1,348 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+
+try:
+    import prometheus_client as prom
+except ImportError:  # /metrics זמין רק אם prometheus_client מותקן
+    prom = None
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # spans רק אם opentelemetry-api מותקן
+    otel_trace = None
+
+TRACING_CONFIG = {
+    "log_level": os.getenv("LOG_LEVEL", "INFO").upper(),
+    "log_format": os.getenv("LOG_FORMAT", "json"),          # json | text
+    "otel": os.getenv("NL2SQL_OTEL", "0") == "1",           # spans ל-OpenTelemetry (exporter לפי OTEL_* env)
+}
+
+# הבקשה וה-node הנוכחיים (contextvars - עובר גם ל-tasks של הגרף האסינכרוני)
+_current_trace = contextvars.ContextVar("nl2sql_trace", default=None)
+_current_node = contextvars.ContextVar("nl2sql_node", default=None)
+
+
+# ---------- Logging ----------
+
+class JsonFormatter(logging.Formatter):
+    """שורת JSON לכל רשומה: זמן, רמה, logger, הודעה, request_id/node ושדות מ-extra={"fields": {...}}"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        trace = _current_trace.get()
+        if trace is not None:
+            entry["request_id"] = trace.request_id
+        node = _current_node.get()
+        if node is not None:
+            entry["node"] = node
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging():
+    """handler אחד ל-logger "nl2sql" (פעם אחת לתהליך)"""
+    root = logging.getLogger("nl2sql")
+    if root.handlers:
+        return root
+    handler = logging.StreamHandler()
+    if TRACING_CONFIG["log_format"] == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root.addHandler(handler)
+    root.setLevel(TRACING_CONFIG["log_level"])
+    root.propagate = False
+    return root
+
+
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(f"nl2sql.{name}")
+
+
+log = get_logger("tracing")
+
+
+# ---------- Prometheus ----------
+
+class _NoopMetric:
+    # כשאין prometheus_client: אותו API, בלי כלום
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, value=1):
+        pass
+
+
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_ROW_BUCKETS = (0, 1, 10, 100, 1_000, 10_000, 100_000, 1_000_000)
+
+if prom is not None:
+    NODE_SECONDS = prom.Histogram("nl2sql_node_seconds", "Wall time per graph node", ["node"], buckets=_LATENCY_BUCKETS)
+    NODE_ERRORS = prom.Counter("nl2sql_node_errors_total", "Exceptions raised out of a graph node", ["node"])
+    REQUEST_SECONDS = prom.Histogram("nl2sql_request_seconds", "Wall time per request", ["endpoint"],
+                                     buckets=_LATENCY_BUCKETS)
+    LLM_TOKENS = prom.Counter("nl2sql_llm_tokens_total", "LLM tokens by node", ["node", "direction"])
+    LLM_CALLS = prom.Counter("nl2sql_llm_calls_total", "LLM calls by node", ["node"])
+    DB_SECONDS = prom.Histogram("nl2sql_db_seconds", "Time a DB connection was held per checkout", ["node"],
+                                buckets=_LATENCY_BUCKETS)
+    ROWS_RETURNED = prom.Histogram("nl2sql_rows_returned", "Rows returned by execute_sql", buckets=_ROW_BUCKETS)
+    GUARDRAIL_VERDICTS = prom.Counter("nl2sql_guardrail_verdicts_total", "Guardrail verdicts", ["verdict", "tier"])
+    SINGLEFLIGHT = prom.Counter("nl2sql_singleflight_total", "Single-flight outcomes per request", ["outcome"])
+    GUARDRAIL_REPAIRS = prom.Counter("nl2sql_guardrail_repairs_total", "Guardrail auto-repair outcomes",
+                                     ["outcome", "strategy"])
+    VIZ_SPECULATIONS = prom.Counter("nl2sql_viz_speculations_total", "Speculative viz specs (parallel graph) by outcome",
+                                    ["outcome"])
+else:
+    NODE_SECONDS = NODE_ERRORS = REQUEST_SECONDS = LLM_TOKENS = LLM_CALLS = DB_SECONDS = ROWS_RETURNED = \
+        GUARDRAIL_VERDICTS = SINGLEFLIGHT = GUARDRAIL_REPAIRS = VIZ_SPECULATIONS = _NoopMetric()
+
+
+def metrics_payload():
+    """(body, content_type) ל-/metrics; None אם prometheus_client לא מותקן"""
+    if prom is None:
+        return None
+    return prom.generate_latest(), prom.CONTENT_TYPE_LATEST
+
+
+# ---------- OpenTelemetry ----------
+
+def _setup_tracer():
+    if not TRACING_CONFIG["otel"] or otel_trace is None:
+        return None
+    try:
+        # עם ה-SDK וה-OTLP exporter מותקנים: provider שמייצא לפי OTEL_EXPORTER_OTLP_ENDPOINT.
+        # בלעדיהם - ה-provider הגלובלי (למשל של opentelemetry-instrument)
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", "nl2sql-api")}))
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        otel_trace.set_tracer_provider(provider)
+    except ImportError:
+        pass
+    return otel_trace.get_tracer("nl2sql")
+
+
+tracer = _setup_tracer()
+
+
+def _span(name, **attributes):
+    if tracer is None:
+        return nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def _span_attributes(**attributes):
+    if tracer is not None:
+        otel_trace.get_current_span().set_attributes(attributes)
+
+
+# ---------- Trace לכל בקשה ----------
+
+class Trace:
+    """מה שנאסף על בקשה אחת: זמן לכל node, טוקנים, זמן DB, שורות ו-verdict"""
+
+    def __init__(self, endpoint):
+        self.request_id = uuid.uuid4().hex[:16]
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.nodes = []          # [(node, seconds)]
+        self.timeline = []       # [(node, start, end)] בשניות מתחילת הבקשה
+        self.llm_calls = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.db_seconds = 0.0
+        self.rows = None
+        self.verdict = None      # "pass" | "block"
+        self.verdict_tier = None  # "static" | "explain"
+        self.shared = None       # single-flight: "executions" | "coalesced" | "reused"
+
+    def summary(self):
+        return {
+            "request_id": self.request_id,
+            "endpoint": self.endpoint,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "nodes_ms": {name: round(seconds * 1000, 3) for name, seconds in self.nodes},
+            "critical_path_ms": round(sum(end - start for _, start, end in critical_path(self.timeline)) * 1000, 3),
+            "llm_calls": self.llm_calls,
+            "tokens_in": self.tokens_in,
+            "tokens_out": self.tokens_out,
+            "db_ms": round(self.db_seconds * 1000, 3),
+            "rows": self.rows,
+            "verdict": self.verdict,
+            "verdict_tier": self.verdict_tier,
+            "shared": self.shared,
+        }
+
+
+    def timeline_summary(self):
+        """ציר הזמן של ה-nodes: מתי כל אחד רץ, השרשרת הקריטית וכמה זמן חסכה ההרצה במקביל"""
+        path = critical_path(self.timeline)
+        serial = sum(end - start for _, start, end in self.timeline)
+        span = max((end for _, _, end in self.timeline), default=0.0) - min((start for _, start, _ in self.timeline), default=0.0)
+        return {
+            "nodes": [{"node": name, "start_ms": round(start * 1000, 3), "end_ms": round(end * 1000, 3)}
+                      for name, start, end in sorted(self.timeline, key=lambda t: t[1])],
+            "critical_path": [name for name, _, _ in path],
+            "critical_path_ms": round(sum(end - start for _, start, end in path) * 1000, 3),
+            "serial_ms": round(serial * 1000, 3),
+            "overlap_ms": round(max(serial - span, 0.0) * 1000, 3),
+        }
+
+
+def critical_path(timeline):
+    """השרשרת שקבעה את זמן הבקשה: מה-node שהסתיים אחרון, אחורה דרך ה-node שהסתיים אחרון לפני שהוא התחיל"""
+    if not timeline:
+        return []
+    current = max(timeline, key=lambda t: t[2])
+    path = [current]
+    while True:
+        before = [t for t in timeline if t[2] <= current[1]]
+        if not before:
+            return path[::-1]
+        current = max(before, key=lambda t: t[2])
+        path.append(current)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def request_trace(endpoint):
+    """trace לבקשה: כל ה-nodes שרצים בתוכה נרשמים אליו; בסוף - metric ושורת לוג אחת"""
+    trace = Trace(endpoint)
+    token = _current_trace.set(trace)
+    try:
+        with _span(f"nl2sql.{endpoint}", request_id=trace.request_id):
+            yield trace
+    finally:
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - trace.started)
+        log.info("request", extra={"fields": trace.summary()})
+        _current_trace.reset(token)
+
+
+@contextmanager
+def _node_scope(name):
+    token = _current_node.set(name)
+    start = time.perf_counter()
+    try:
+        with _span(f"nl2sql.node.{name}"):
+            yield
+    except Exception:
+        NODE_ERRORS.labels(name).inc()
+        raise
+    finally:
+        end = time.perf_counter()
+        seconds = end - start
+        NODE_SECONDS.labels(name).observe(seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.nodes.append((name, seconds))
+            trace.timeline.append((name, start - trace.started, end - trace.started))
+        log.debug("node done", extra={"fields": {"ms": round(seconds * 1000, 3)}})
+        _current_node.reset(token)
+
+
+def traced(name, fn):
+    """עוטף node של הגרף (סינכרוני או async) במדידת זמן, span ו-node נוכחי ללוגים"""
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(state):
+            with _node_scope(name):
+                return await fn(state)
+    else:
+        @functools.wraps(fn)
+        def wrapper(state):
+            with _node_scope(name):
+                return fn(state)
+    return wrapper
+
+
+# ---------- רישום מתוך ה-nodes ----------
+
+def record_llm(response):
+    """טוקנים מ-response.usage של OpenAI"""
+    usage = getattr(response, "usage", None)
+    tokens_in = getattr(usage, "prompt_tokens", 0) or 0
+    tokens_out = getattr(usage, "completion_tokens", 0) or 0
+    node = _current_node.get() or "none"
+    LLM_CALLS.labels(node).inc()
+    LLM_TOKENS.labels(node, "in").inc(tokens_in)
+    LLM_TOKENS.labels(node, "out").inc(tokens_out)
+    _span_attributes(**{"llm.tokens_in": tokens_in, "llm.tokens_out": tokens_out})
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.llm_calls += 1
+        trace.tokens_in += tokens_in
+        trace.tokens_out += tokens_out
+
+
+def record_db(seconds):
+    DB_SECONDS.labels(_current_node.get() or "none").observe(seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.db_seconds += seconds
+
+
+def record_rows(count):
+    ROWS_RETURNED.observe(count)
+    _span_attributes(**{"db.rows": count})
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.rows = count
+
+
+def record_verdict(ok, static):
+    verdict, tier = ("pass" if ok else "block"), ("static" if static else "explain")
+    GUARDRAIL_VERDICTS.labels(verdict, tier).inc()
+    _span_attributes(**{"guardrail.verdict": verdict, "guardrail.tier": tier})
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.verdict, trace.verdict_tier = verdict, tier
+
+
+def record_singleflight(outcome):
+    SINGLEFLIGHT.labels(outcome).inc()
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.shared = outcome
+
+
+def record_repair(ok, strategy=None):
+    GUARDRAIL_REPAIRS.labels("repaired" if ok else "failed", strategy or "none").inc()
+    _span_attributes(**{"guardrail.repaired": ok})
+
+
+def record_speculation(used):
+    """spec ספקולטיבי של הגרף המקבילי: נכנס לתשובה או נזרק"""
+    VIZ_SPECULATIONS.labels("used" if used else "discarded").inc()
+
+
+@contextmanager
+def db_timer():
+    """זמן החזקת חיבור DB (נקרא מ-db.checkout / db.acheckout)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_db(time.perf_counter() - start)
@@ -1,11 +1,15 @@
-import csv, uuid, os
+from datetime import date, datetime
+from decimal import Decimal
 
-def save_to_csv(rows):
-    os.makedirs("downloads", exist_ok=True)
-    path = f"downloads/result_{uuid.uuid4().hex[:8]}.csv"
-    if rows:
-        with open(path, "w", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=rows[0].keys())
-            writer.writeheader()
-            writer.writerows(rows)
-    return path
+def convert_to_json_serializable(obj):
+    """ממיר אובייקטים לא JSON-serializable לפורמט JSON"""
+    if isinstance(obj, date):
+        return obj.isoformat()
+    elif isinstance(obj, datetime):
+        return obj.isoformat()
+    elif isinstance(obj, Decimal):
+        return float(obj)
+    elif isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    else:
+        return obj
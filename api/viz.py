@@ -0,0 +1,269 @@
+import os
+import re
+from datetime import date, datetime
+
+from catalog import catalog
+
+VIZ_CONFIG = {
+    # LLM רק למקרים שהכללים לא מכסים (0 = אף פעם; אז spec טקסטואלי)
+    "llm_stylist": os.getenv("VIZ_LLM_STYLIST", "1") == "1",
+    "max_pie_slices": int(os.getenv("VIZ_MAX_PIE_SLICES", "8")),
+    "max_color_series": int(os.getenv("VIZ_MAX_COLOR_SERIES", "10")),
+}
+
+# חוזה העיצוב (זהה למה שה-prompt של ה-stylist דורש)
+STYLE = {
+    "width": 720,
+    "height": 420,
+    "background": "white",
+    "padding": {"left": 10, "right": 10, "top": 10, "bottom": 10},
+    "config": {
+        "view": {"stroke": None},
+        "font": "Inter, Arial, sans-serif",
+        "axis": {
+            "labelFontSize": 12,
+            "titleFontSize": 13,
+            "grid": True,
+            "gridOpacity": 0.25,
+            "labelColor": "#334155",
+            "titleColor": "#334155",
+            "tickColor": "#CBD5E1"
+        },
+        "legend": {"labelFontSize": 12, "titleFontSize": 13, "orient": "bottom"},
+        "header": {"labelFontSize": 12, "titleFontSize": 13},
+        "range": {"category": {"scheme": "tableau10"}},
+    },
+}
+
+# עמודות מספריות שהן בעצם ציר זמן/סדר ("year", "month")
+ORDINAL_NAMES = {"year", "quarter", "month", "week", "day", "hour", "dow"}
+
+# מילה עברית שלמה עם תחילית (ה, ב, ל, ו, כ, ש, מ) - "בקו", אבל לא ה"קו" שבתוך "לקוחות"
+_HE = r"(?<!\w)[והבלכשמ]{0,2}"
+_END = r"(?!\w)"
+
+# בקשה מפורשת לסוג גרף בשאלה
+MARK_HINTS = [
+    ("arc", re.compile(r"\b(?:pie|donut|share|proportion)\b|" + _HE + r"(?:עוגה|עוגת|פאי|אחוז|אחוזים|חלק יחסי)" + _END,
+                       re.IGNORECASE)),
+    ("line", re.compile(r"\b(?:line|trend|over time)\b|" + _HE + r"(?:קו|קווים|מגמה|מגמת|לאורך)" + _END, re.IGNORECASE)),
+    ("point", re.compile(r"\b(?:scatter|correlation)\b|" + _HE + r"(?:פיזור|מתאם)" + _END, re.IGNORECASE)),
+    ("bar", re.compile(r"\b(?:bar|bars|histogram)\b|" + _HE + r"(?:עמודות|היסטוגרמה)" + _END, re.IGNORECASE)),
+]
+
+_DISTINCT_CAP = 51  # מעבר לזה לא צריך לדעת את הקרדינליות המדויקת
+
+
+def _value_type(value):
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, datetime):
+        return "datetime"
+    if isinstance(value, date):
+        return "date"
+    return "string"
+
+
+def _cardinality(rows, field):
+    seen = set()
+    for row in rows:
+        seen.add(row.get(field))
+        if len(seen) >= _DISTINCT_CAP:
+            break
+    return len(seen)
+
+
+def field_roles(rows, columns=None):
+    """[{"name", "role", "key", "cardinality"}] - role: temporal / quantitative / ordinal / nominal.
+    לפי טיפוס העמודה מ-cur.description (או מהערכים), מפתחות PK/FK מה-catalog הם nominal"""
+    if columns:
+        types = [(c["name"], c["type"]) for c in columns]
+    elif rows:
+        types = [(name, _value_type(value)) for name, value in rows[0].items()]
+    else:
+        return []
+    keys = catalog.key_columns()
+    roles = []
+    for name, col_type in types:
+        key = name in keys or name.endswith("_id") or name == "id"
+        if col_type in ("date", "datetime"):
+            role = "temporal"
+        elif col_type == "number" and key:
+            role = "nominal"
+        elif col_type == "number" and name.lower() in ORDINAL_NAMES:
+            role = "ordinal"
+        elif col_type == "number":
+            role = "quantitative"
+        else:
+            role = "nominal"
+        roles.append({"name": name, "role": role, "key": key, "cardinality": _cardinality(rows, name)})
+    return roles
+
+
+def field_types(rows, columns=None):
+    """{name: vega type} - לפרומפט של ה-stylist"""
+    return {f["name"]: f["role"] for f in field_roles(rows, columns)}
+
+
+def _title(text):
+    return text.replace("_", " ").title()
+
+
+def _number_format(rows, field):
+    values = [row.get(field) for row in rows[:200] if isinstance(row.get(field), (int, float))]
+    if values and all(float(v).is_integer() for v in values):
+        return "~s" if max(abs(v) for v in values) >= 10_000 else ",d"
+    return ",.2f"
+
+
+def _x_axis(rows, field):
+    # תוויות ארוכות -> הטיה והגבלת אורך
+    longest = max((len(str(row.get(field, ""))) for row in rows[:200]), default=0)
+    if longest > 8:
+        return {"labelAngle": -30, "labelLimit": 140, "labelOverlap": "greedy"}
+    return {}
+
+
+def _hinted_mark(query):
+    for mark, pattern in MARK_HINTS:
+        if pattern.search(query or ""):
+            return mark
+    return None
+
+
+def _spec(mark, encoding, title, fields):
+    spec = dict(STYLE)
+    spec["mark"] = mark
+    spec["encoding"] = {**encoding, "tooltip": [{"field": f["name"], "type": f["role"]} for f in fields]}
+    spec["title"] = title
+    return spec
+
+
+def _bar(rows, category, measure, color=None):
+    fields = [category] + ([measure] if measure else []) + ([color] if color else [])
+    if measure:
+        y = {"field": measure["name"], "type": "quantitative", "title": _title(measure["name"]),
+             "axis": {"format": _number_format(rows, measure["name"])}, "scale": {"nice": True}}
+        title = f"{_title(measure['name'])} by {_title(category['name'])}"
+    else:
+        # בלי מדד: ספירת שורות לכל קטגוריה
+        y = {"aggregate": "count", "type": "quantitative", "title": "Count"}
+        title = f"Count by {_title(category['name'])}"
+    x = {"field": category["name"], "type": category["role"], "title": _title(category["name"]),
+         "axis": _x_axis(rows, category["name"])}
+    if measure and category["role"] == "nominal":
+        x["sort"] = "-y"
+    encoding = {"x": x, "y": y}
+    if color:
+        encoding["color"] = {"field": color["name"], "type": "nominal", "title": _title(color["name"])}
+    return _spec({"type": "bar", "cornerRadius": 4, "binSpacing": 2}, encoding, title, fields)
+
+
+def _line(rows, time, measure, color=None):
+    fields = [time, measure] + ([color] if color else [])
+    encoding = {
+        "x": {"field": time["name"], "type": time["role"], "title": _title(time["name"])},
+        "y": {"field": measure["name"], "type": "quantitative", "title": _title(measure["name"]),
+              "axis": {"format": _number_format(rows, measure["name"])}, "scale": {"nice": True}},
+    }
+    if color:
+        encoding["color"] = {"field": color["name"], "type": "nominal", "title": _title(color["name"])}
+    title = f"{_title(measure['name'])} over {_title(time['name'])}"
+    return _spec({"type": "line", "point": len(rows) <= 60}, encoding, title, fields)
+
+
+def _arc(rows, category, measure):
+    encoding = {
+        "theta": {"field": measure["name"], "type": "quantitative", "stack": True},
+        "color": {"field": category["name"], "type": "nominal", "title": _title(category["name"])},
+    }
+    title = f"{_title(measure['name'])} by {_title(category['name'])}"
+    return _spec({"type": "arc", "innerRadius": 60}, encoding, title, [category, measure])
+
+
+def _scatter(rows, x, y, color=None):
+    fields = [x, y] + ([color] if color else [])
+    encoding = {
+        "x": {"field": x["name"], "type": "quantitative", "title": _title(x["name"]), "scale": {"zero": False}},
+        "y": {"field": y["name"], "type": "quantitative", "title": _title(y["name"]), "scale": {"zero": False}},
+    }
+    if color:
+        encoding["color"] = {"field": color["name"], "type": "nominal", "title": _title(color["name"])}
+    title = f"{_title(y['name'])} vs {_title(x['name'])}"
+    return _spec({"type": "point", "filled": True, "opacity": 0.7}, encoding, title, fields)
+
+
+def _histogram(rows, measure):
+    encoding = {
+        "x": {"field": measure["name"], "type": "quantitative", "bin": {"maxbins": 30}, "title": _title(measure["name"])},
+        "y": {"aggregate": "count", "type": "quantitative", "title": "Count"},
+    }
+    return _spec({"type": "bar", "cornerRadius": 4, "binSpacing": 2}, encoding,
+                 f"Distribution of {_title(measure['name'])}", [measure])
+
+
+def _binned_histogram(rows, start, end):
+    # bins שחושבו ב-Postgres (viz_reduce): x/x2 כבר מחולקים, y הוא הספירה
+    encoding = {
+        "x": {"field": start, "type": "quantitative", "bin": {"binned": True}, "title": _title(start)},
+        "x2": {"field": end},
+        "y": {"field": "count", "type": "quantitative", "title": "Count"},
+    }
+    fields = [{"name": start, "role": "quantitative"}, {"name": end, "role": "quantitative"},
+              {"name": "count", "role": "quantitative"}]
+    return _spec({"type": "bar", "cornerRadius": 4, "binSpacing": 2}, encoding,
+                 f"Distribution of {_title(start)}", fields)
+
+
+def recommend(query, rows, columns=None, reduction=None):
+    """spec מעוצב לפי תפקידי העמודות (ובקשה מפורשת בשאלה); None אם הכללים לא מכסים את המקרה.
+    reduction: ה-viz_reduction מה-state (למשל histogram שכבר חולק ל-bins)"""
+    if reduction and reduction.get("fields") and reduction["strategy"] == "bin":
+        return _binned_histogram(rows, *reduction["fields"])
+    fields = field_roles(rows, columns)
+    temporal = [f for f in fields if f["role"] == "temporal"]
+    ordinal = [f for f in fields if f["role"] == "ordinal"]
+    quantitative = [f for f in fields if f["role"] == "quantitative"]
+    # קטגוריה: קודם שדה תיאורי (name, country), מפתח (customer_id) רק אם אין אחר
+    nominal = sorted((f for f in fields if f["role"] == "nominal"), key=lambda f: f["key"])
+    series = next((f for f in nominal if not f["key"] and 1 < f["cardinality"] <= VIZ_CONFIG["max_color_series"]), None)
+    hint = _hinted_mark(query)
+
+    if quantitative and (temporal or ordinal) and hint in (None, "line"):
+        return _line(rows, (temporal or ordinal)[0], quantitative[0], series)
+    if quantitative and temporal and hint == "bar":
+        # עמודות לאורך ציר הזמן (לא histogram של המדד)
+        return _bar(rows, temporal[0], quantitative[0], series)
+    if quantitative and (nominal or ordinal):
+        category = (nominal or ordinal)[0]
+        if hint == "arc" and category["cardinality"] <= VIZ_CONFIG["max_pie_slices"]:
+            return _arc(rows, category, quantitative[0])
+        if hint == "point" and len(quantitative) >= 2:
+            color = category if category["cardinality"] <= VIZ_CONFIG["max_color_series"] else None
+            return _scatter(rows, quantitative[0], quantitative[1], color)
+        color = series if series is not None and series is not category else None
+        return _bar(rows, category, quantitative[0], color)
+    if len(quantitative) >= 2:
+        return _scatter(rows, quantitative[0], quantitative[1])
+    if len(quantitative) == 1 and len(rows) > 1:
+        return _histogram(rows, quantitative[0])
+    # בלי מדד: ספירה לפי הקטגוריה עם הכי מעט ערכים (אם יש חזרות)
+    groupable = [f for f in nominal + ordinal + temporal if 1 < f["cardinality"] < min(len(rows), _DISTINCT_CAP)]
+    if groupable:
+        return _bar(rows, min(groupable, key=lambda f: f["cardinality"]), None)
+    return None
+
+
+def text_spec(rows):
+    """כשאין גרף מתאים: רשימה טקסטואלית של השדה הראשון"""
+    if not rows:
+        return {"mark": "text", "text": "No data available"}
+    field = next(iter(rows[0].keys()))
+    return {
+        **{k: v for k, v in STYLE.items() if k != "config"},
+        "mark": "text",
+        "encoding": {"text": {"field": field, "type": "nominal"}},
+        "title": "Data List",
+    }
@@ -0,0 +1,183 @@
+import os
+import re
+from datetime import datetime
+
+import sqlglot
+from sqlglot import exp
+
+import sqlcheck
+import viz
+
+VIZ_REDUCE_CONFIG = {
+    "max_points": int(os.getenv("VIZ_MAX_POINTS", "500")),   # מקסימום נקודות שנשלחות לגרף
+    "bins": int(os.getenv("VIZ_HISTOGRAM_BINS", "30")),
+}
+
+# מדדים שמצטברים בסכום; כל השאר (מחיר, ממוצע) - ממוצע לכל bucket
+_ADDITIVE = re.compile(r"count|total|sum|amount|revenue|sales|qty|quantity|orders|items|num", re.IGNORECASE)
+
+# גודל bucket לפי טווח הזמן: הגרעין הראשון שמשאיר לכל היותר max_points נקודות
+GRAINS = [("hour", 3600), ("day", 86400), ("week", 604800), ("month", 2678400), ("quarter", 7948800), ("year", 31622400)]
+
+
+def _col(name, table="src"):
+    return exp.column(exp.to_identifier(name, quoted=True), table=exp.to_identifier(table))
+
+
+def _agg(field):
+    func = "sum" if _ADDITIVE.search(field["name"]) else "avg"
+    return exp.alias_(exp.func(func, _col(field["name"])), field["name"], quoted=True)
+
+
+def _grain_case(time_field, max_points):
+    t = _col(time_field["name"]).sql(dialect="postgres")
+    whens = " ".join(f"WHEN span <= {seconds} * {max_points} THEN '{grain}'" for grain, seconds in GRAINS[:-1])
+    return sqlglot.parse_one(
+        f"SELECT CASE {whens} ELSE '{GRAINS[-1][0]}' END AS grain "
+        f"FROM (SELECT coalesce(extract(epoch FROM max({t})::timestamp - min({t})::timestamp), 0) AS span FROM src) AS s",
+        read="postgres",
+    )
+
+
+def _time_buckets(tree, time_field, measures, series, max_points):
+    """date_trunc לגרעין שנבחר ב-Postgres לפי טווח התאריכים"""
+    select = [exp.alias_(exp.Anonymous(this="date_trunc", expressions=[exp.column("grain", "bounds"), _col(time_field["name"])]),
+                         time_field["name"], quoted=True)]
+    select += [_agg(m) for m in measures]
+    group = [exp.Literal.number(1)]
+    if series:
+        select.append(exp.alias_(_col(series["name"]), series["name"], quoted=True))
+        group.append(exp.Literal.number(len(select)))
+    limit = max_points * max(1, series["cardinality"] if series else 1)
+    return (sqlglot.select(*select).from_("src").join("bounds", join_type="cross")
+            .group_by(*group).order_by(exp.Literal.number(1)).limit(limit)
+            .with_("src", as_=tree).with_("bounds", as_=_grain_case(time_field, max_points)))
+
+
+def _top_categories(tree, category, measures, series, max_points, order_by_category):
+    """GROUP BY קטגוריה: N הגדולות לפי המדד הראשון (או ספירה); ordinal נשאר מסודר לפי הערך"""
+    select = [exp.alias_(_col(category["name"]), category["name"], quoted=True)]
+    group = [exp.Literal.number(1)]
+    if series:
+        select.append(exp.alias_(_col(series["name"]), series["name"], quoted=True))
+        group.append(exp.Literal.number(2))
+    if measures:
+        select += [_agg(m) for m in measures]
+        metric = exp.to_identifier(measures[0]["name"], quoted=True)
+    else:
+        select.append(exp.alias_(exp.Count(this=exp.Star()), "count", quoted=True))
+        metric = exp.to_identifier("count", quoted=True)
+    query = sqlglot.select(*select).from_("src").group_by(*group).with_("src", as_=tree)
+    order = exp.Literal.number(1) if order_by_category else exp.Ordered(this=metric, desc=True, nulls_first=False)
+    return query.order_by(order).limit(max_points)
+
+
+def _histogram(tree, measure, bins):
+    """width_bucket ל-bins בין המינימום למקסימום; כל שורה = bin עם התחלה, סוף וספירה"""
+    m = _col(measure["name"]).sql(dialect="postgres")
+    start = exp.to_identifier(measure["name"], quoted=True).sql(dialect="postgres")
+    end = exp.to_identifier(f"{measure['name']}_end", quoted=True).sql(dialect="postgres")
+    return sqlglot.parse_one(
+        f"""SELECT lo + (b - 1) * (hi - lo)::numeric / {bins} AS {start}, lo + b * (hi - lo)::numeric / {bins} AS {end}, count(*) AS "count"
+        FROM (
+            SELECT bounds.lo, bounds.hi,
+                   CASE WHEN bounds.hi = bounds.lo THEN 1 ELSE least(width_bucket({m}, bounds.lo, bounds.hi, {bins}), {bins}) END AS b
+            FROM src CROSS JOIN (SELECT min({m}) AS lo, max({m}) AS hi FROM src) AS bounds
+            WHERE {m} IS NOT NULL
+        ) AS binned
+        GROUP BY lo, hi, b
+        ORDER BY b""",
+        read="postgres",
+    ).with_("src", as_=tree)
+
+
+def _sample(tree, max_points):
+    return sqlglot.select("*").from_("src").order_by(exp.func("random")).limit(max_points).with_("src", as_=tree)
+
+
+def plan_reduction(sql, rows, columns=None, max_points=None):
+    """תוכנית הקטנה לגרף כשיש יותר מ-max_points שורות; None אם אין צורך.
+    {"strategy", "sql" (השאילתה המקורית עטופה ב-CTE; None אם לא מתפרסרת), "fields", "description"}"""
+    max_points = max_points or VIZ_REDUCE_CONFIG["max_points"]
+    if len(rows) <= max_points:
+        return None
+    fields = viz.field_roles(rows, columns)
+    temporal = [f for f in fields if f["role"] == "temporal"]
+    ordinal = [f for f in fields if f["role"] == "ordinal"]
+    measures = [f for f in fields if f["role"] == "quantitative"]
+    nominal = sorted((f for f in fields if f["role"] == "nominal"), key=lambda f: f["key"])
+    series = next((f for f in nominal if not f["key"] and 1 < f["cardinality"] <= viz.VIZ_CONFIG["max_color_series"]), None)
+
+    try:
+        tree = sqlcheck.parse(sql)
+    except ValueError:
+        tree = None
+
+    if temporal and measures:
+        plan = {"strategy": "time_bucket", "fields": {"time": temporal[0], "measures": measures, "series": series},
+                "description": f"date_trunc on {temporal[0]['name']}"}
+        build = lambda: _time_buckets(tree, temporal[0], measures, series, max_points)
+    elif nominal or ordinal:
+        category = (nominal or ordinal)[0]
+        group_series = series if series is not None and series is not category else None
+        plan = {"strategy": "top_n", "fields": {"category": category, "measures": measures, "series": group_series},
+                "description": f"GROUP BY {category['name']}"}
+        build = lambda: _top_categories(tree, category, measures, group_series, max_points, category["role"] == "ordinal")
+    elif len(measures) == 1:
+        plan = {"strategy": "bin", "fields": {"measure": measures[0], "end": f"{measures[0]['name']}_end"},
+                "description": f"{VIZ_REDUCE_CONFIG['bins']} bins of {measures[0]['name']}"}
+        build = lambda: _histogram(tree, measures[0], VIZ_REDUCE_CONFIG["bins"])
+    else:
+        plan = {"strategy": "sample", "fields": {}, "description": "random sample"}
+        build = lambda: _sample(tree, max_points)
+
+    plan["sql"] = build().sql(dialect="postgres") if tree is not None else None
+    plan["max_points"] = max_points
+    return plan
+
+
+def lttb(points, threshold):
+    """Largest-Triangle-Three-Buckets: threshold נקודות ששומרות על צורת הסדרה. points = [(x, y, item)]"""
+    if threshold >= len(points) or threshold < 3:
+        return [p[2] for p in points[:max(threshold, 0)]] if threshold < 3 else [p[2] for p in points]
+    sampled = [points[0][2]]
+    every = (len(points) - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # ממוצע ה-bucket הבא
+        start, end = int((i + 1) * every) + 1, min(int((i + 2) * every) + 1, len(points))
+        avg_x = sum(p[0] for p in points[start:end]) / max(end - start, 1)
+        avg_y = sum(p[1] for p in points[start:end]) / max(end - start, 1)
+        # הנקודה ב-bucket הנוכחי עם המשולש הגדול ביותר
+        best, best_area = None, -1.0
+        ax, ay = points[a][0], points[a][1]
+        for j in range(int(i * every) + 1, int((i + 1) * every) + 1):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best][2])
+        a = best
+    sampled.append(points[-1][2])
+    return sampled
+
+
+def _as_number(value, index):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        return float(index)
+
+
+def reduce_locally(plan, rows):
+    """כשההקטנה ב-Postgres נכשלה: LTTB לסדרת זמן, אחרת דגימה במרווחים קבועים"""
+    max_points = plan["max_points"]
+    fields = plan["fields"]
+    if plan["strategy"] == "time_bucket" and not fields["series"]:
+        time, measure = fields["time"]["name"], fields["measures"][0]["name"]
+        ordered = sorted((r for r in rows if r.get(time) is not None and r.get(measure) is not None), key=lambda r: str(r[time]))
+        points = [(_as_number(r[time], i), float(r[measure]), r) for i, r in enumerate(ordered)]
+        return lttb(points, max_points), "LTTB downsampling"
+    step = len(rows) / max_points
+    return [rows[int(i * step)] for i in range(max_points)], "sampling"
@@ -0,0 +1,32 @@
+-- שינויי DDL -> NOTIFY nl2sql_ddl, כדי שה-catalog של ה-API יתרענן בלי polling
+-- payload: "<object_type> <object_identity>", למשל "table public.orders"
+
+CREATE OR REPLACE FUNCTION nl2sql_notify_ddl() RETURNS event_trigger AS $$
+DECLARE
+  r record;
+BEGIN
+  FOR r IN SELECT object_type, object_identity FROM pg_event_trigger_ddl_commands() LOOP
+    IF r.object_identity IS NOT NULL THEN
+      PERFORM pg_notify('nl2sql_ddl', r.object_type || ' ' || r.object_identity);
+    END IF;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION nl2sql_notify_drop() RETURNS event_trigger AS $$
+DECLARE
+  r record;
+BEGIN
+  FOR r IN SELECT object_type, object_identity FROM pg_event_trigger_dropped_objects() LOOP
+    IF r.object_identity IS NOT NULL THEN
+      PERFORM pg_notify('nl2sql_ddl', r.object_type || ' ' || r.object_identity);
+    END IF;
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP EVENT TRIGGER IF EXISTS nl2sql_ddl_end;
+CREATE EVENT TRIGGER nl2sql_ddl_end ON ddl_command_end EXECUTE FUNCTION nl2sql_notify_ddl();
+
+DROP EVENT TRIGGER IF EXISTS nl2sql_ddl_drop;
+CREATE EVENT TRIGGER nl2sql_ddl_drop ON sql_drop EXECUTE FUNCTION nl2sql_notify_drop();
@@ -0,0 +1,23 @@
+-- שינויי נתונים -> NOTIFY nl2sql_table_change עם שם הטבלה, ל-result cache של ה-API
+-- (RESULT_CACHE_INVALIDATION=notify). טריגר ברמת statement: NOTIFY אחד לכל פקודה, נשלח ב-COMMIT.
+-- טבלה נוספת: SELECT nl2sql_watch_table('public.my_table');
+
+CREATE OR REPLACE FUNCTION nl2sql_notify_change() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('nl2sql_table_change', TG_TABLE_NAME);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION nl2sql_watch_table(target regclass) RETURNS void AS $$
+BEGIN
+  EXECUTE format('DROP TRIGGER IF EXISTS nl2sql_table_change ON %s', target);
+  EXECUTE format(
+    'CREATE TRIGGER nl2sql_table_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s '
+    'FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_notify_change()', target);
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT nl2sql_watch_table('customers');
+SELECT nl2sql_watch_table('orders');
+SELECT nl2sql_watch_table('items');
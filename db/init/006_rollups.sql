@@ -0,0 +1,184 @@
+-- rollups: אגרגציות ממומשות על orders/items, שמתעדכנות באופן אינקרמנטלי בטריגרים ברמת statement
+-- (delta מ-transition tables, upsert אחד לכל פקודה). api/rollups.py משכתב שאילתות מתאימות אליהן.
+-- בנייה מחדש מלאה: SELECT nl2sql_rebuild_rollups();
+
+CREATE TABLE IF NOT EXISTS rollup_daily_revenue (
+  day DATE NOT NULL UNIQUE,
+  orders BIGINT NOT NULL,
+  revenue NUMERIC NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rollup_customer_orders (
+  customer_id INT UNIQUE NULLS NOT DISTINCT,
+  orders BIGINT NOT NULL,
+  revenue NUMERIC NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rollup_customer_items (
+  customer_id INT UNIQUE NULLS NOT DISTINCT,
+  lines BIGINT NOT NULL,
+  qty BIGINT NOT NULL,
+  revenue NUMERIC NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rollup_sku_sales (
+  sku TEXT,
+  product_name TEXT,
+  lines BIGINT NOT NULL,
+  qty BIGINT NOT NULL,
+  revenue NUMERIC NOT NULL,
+  UNIQUE NULLS NOT DISTINCT (sku, product_name)
+);
+
+-- ---------- בנייה מלאה ----------
+
+CREATE OR REPLACE FUNCTION nl2sql_rebuild_rollups() RETURNS void AS $$
+BEGIN
+  TRUNCATE rollup_daily_revenue, rollup_customer_orders, rollup_customer_items, rollup_sku_sales;
+
+  INSERT INTO rollup_daily_revenue (day, orders, revenue)
+  SELECT order_date, count(*), sum(total_amount) FROM orders GROUP BY order_date;
+
+  INSERT INTO rollup_customer_orders (customer_id, orders, revenue)
+  SELECT customer_id, count(*), sum(total_amount) FROM orders GROUP BY customer_id;
+
+  INSERT INTO rollup_customer_items (customer_id, lines, qty, revenue)
+  SELECT o.customer_id, count(*), sum(i.qty), sum(i.qty * i.unit_price)
+  FROM items i JOIN orders o ON o.id = i.order_id
+  GROUP BY o.customer_id;
+
+  INSERT INTO rollup_sku_sales (sku, product_name, lines, qty, revenue)
+  SELECT sku, product_name, count(*), sum(qty), sum(qty * unit_price) FROM items GROUP BY sku, product_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ---------- delta מ-orders ----------
+
+CREATE OR REPLACE FUNCTION nl2sql_rollup_orders() RETURNS trigger AS $$
+DECLARE
+  delta text;
+BEGIN
+  delta := CASE TG_OP
+    WHEN 'INSERT' THEN 'SELECT 1 AS sign, id, customer_id, order_date, total_amount FROM new_rows'
+    WHEN 'DELETE' THEN 'SELECT -1 AS sign, id, customer_id, order_date, total_amount FROM old_rows'
+    ELSE 'SELECT 1 AS sign, id, customer_id, order_date, total_amount FROM new_rows
+          UNION ALL SELECT -1, id, customer_id, order_date, total_amount FROM old_rows'
+  END;
+
+  EXECUTE format($q$
+    INSERT INTO rollup_daily_revenue AS r (day, orders, revenue)
+    SELECT order_date, sum(sign), sum(sign * total_amount) FROM (%s) d GROUP BY order_date
+    ON CONFLICT (day) DO UPDATE SET orders = r.orders + EXCLUDED.orders, revenue = r.revenue + EXCLUDED.revenue
+  $q$, delta);
+
+  EXECUTE format($q$
+    INSERT INTO rollup_customer_orders AS r (customer_id, orders, revenue)
+    SELECT customer_id, sum(sign), sum(sign * total_amount) FROM (%s) d GROUP BY customer_id
+    ON CONFLICT (customer_id) DO UPDATE SET orders = r.orders + EXCLUDED.orders, revenue = r.revenue + EXCLUDED.revenue
+  $q$, delta);
+
+  IF TG_OP = 'UPDATE' THEN
+    -- הזמנה שעברה ללקוח אחר: גם הפריטים שלה עוברים
+    INSERT INTO rollup_customer_items AS r (customer_id, lines, qty, revenue)
+    SELECT m.customer_id, sum(m.sign), sum(m.sign * i.qty), sum(m.sign * i.qty * i.unit_price)
+    FROM (
+      SELECT 1 AS sign, n.id, n.customer_id FROM new_rows n JOIN old_rows o ON o.id = n.id
+       WHERE n.customer_id IS DISTINCT FROM o.customer_id
+      UNION ALL
+      SELECT -1, o.id, o.customer_id FROM new_rows n JOIN old_rows o ON o.id = n.id
+       WHERE n.customer_id IS DISTINCT FROM o.customer_id
+    ) m
+    JOIN items i ON i.order_id = m.id
+    GROUP BY m.customer_id
+    ON CONFLICT (customer_id) DO UPDATE
+      SET lines = r.lines + EXCLUDED.lines, qty = r.qty + EXCLUDED.qty, revenue = r.revenue + EXCLUDED.revenue;
+    DELETE FROM rollup_customer_items WHERE lines = 0;
+  END IF;
+
+  DELETE FROM rollup_daily_revenue WHERE orders = 0;
+  DELETE FROM rollup_customer_orders WHERE orders = 0;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ---------- delta מ-items ----------
+
+CREATE OR REPLACE FUNCTION nl2sql_rollup_items() RETURNS trigger AS $$
+DECLARE
+  delta text;
+BEGIN
+  delta := CASE TG_OP
+    WHEN 'INSERT' THEN 'SELECT 1 AS sign, order_id, sku, product_name, qty, unit_price FROM new_rows'
+    WHEN 'DELETE' THEN 'SELECT -1 AS sign, order_id, sku, product_name, qty, unit_price FROM old_rows'
+    ELSE 'SELECT 1 AS sign, order_id, sku, product_name, qty, unit_price FROM new_rows
+          UNION ALL SELECT -1, order_id, sku, product_name, qty, unit_price FROM old_rows'
+  END;
+
+  EXECUTE format($q$
+    INSERT INTO rollup_sku_sales AS r (sku, product_name, lines, qty, revenue)
+    SELECT sku, product_name, sum(sign), sum(sign * qty), sum(sign * qty * unit_price)
+    FROM (%s) d GROUP BY sku, product_name
+    ON CONFLICT (sku, product_name) DO UPDATE
+      SET lines = r.lines + EXCLUDED.lines, qty = r.qty + EXCLUDED.qty, revenue = r.revenue + EXCLUDED.revenue
+  $q$, delta);
+
+  EXECUTE format($q$
+    INSERT INTO rollup_customer_items AS r (customer_id, lines, qty, revenue)
+    SELECT o.customer_id, sum(d.sign), sum(d.sign * d.qty), sum(d.sign * d.qty * d.unit_price)
+    FROM (%s) d JOIN orders o ON o.id = d.order_id
+    GROUP BY o.customer_id
+    ON CONFLICT (customer_id) DO UPDATE
+      SET lines = r.lines + EXCLUDED.lines, qty = r.qty + EXCLUDED.qty, revenue = r.revenue + EXCLUDED.revenue
+  $q$, delta);
+
+  DELETE FROM rollup_sku_sales WHERE lines = 0;
+  DELETE FROM rollup_customer_items WHERE lines = 0;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION nl2sql_rollup_truncate() RETURNS trigger AS $$
+BEGIN
+  IF TG_TABLE_NAME = 'orders' THEN
+    TRUNCATE rollup_daily_revenue, rollup_customer_orders, rollup_customer_items;
+  ELSE
+    TRUNCATE rollup_customer_items, rollup_sku_sales;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- transition tables מחייבים טריגר נפרד לכל אירוע
+DROP TRIGGER IF EXISTS nl2sql_rollup_ins ON orders;
+CREATE TRIGGER nl2sql_rollup_ins AFTER INSERT ON orders
+  REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_orders();
+DROP TRIGGER IF EXISTS nl2sql_rollup_upd ON orders;
+CREATE TRIGGER nl2sql_rollup_upd AFTER UPDATE ON orders
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_orders();
+DROP TRIGGER IF EXISTS nl2sql_rollup_del ON orders;
+CREATE TRIGGER nl2sql_rollup_del AFTER DELETE ON orders
+  REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_orders();
+DROP TRIGGER IF EXISTS nl2sql_rollup_truncate ON orders;
+CREATE TRIGGER nl2sql_rollup_truncate AFTER TRUNCATE ON orders
+  FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_truncate();
+
+DROP TRIGGER IF EXISTS nl2sql_rollup_ins ON items;
+CREATE TRIGGER nl2sql_rollup_ins AFTER INSERT ON items
+  REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_items();
+DROP TRIGGER IF EXISTS nl2sql_rollup_upd ON items;
+CREATE TRIGGER nl2sql_rollup_upd AFTER UPDATE ON items
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_items();
+DROP TRIGGER IF EXISTS nl2sql_rollup_del ON items;
+CREATE TRIGGER nl2sql_rollup_del AFTER DELETE ON items
+  REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_items();
+DROP TRIGGER IF EXISTS nl2sql_rollup_truncate ON items;
+CREATE TRIGGER nl2sql_rollup_truncate AFTER TRUNCATE ON items
+  FOR EACH STATEMENT EXECUTE FUNCTION nl2sql_rollup_truncate();
+
+SELECT nl2sql_rebuild_rollups();
+
+-- result cache במצב notify: גם שינויים ב-rollups (מהטריגרים למעלה) שולחים NOTIFY
+SELECT nl2sql_watch_table('rollup_daily_revenue');
+SELECT nl2sql_watch_table('rollup_customer_orders');
+SELECT nl2sql_watch_table('rollup_customer_items');
+SELECT nl2sql_watch_table('rollup_sku_sales');
@@ -0,0 +1,10 @@
+#!/bin/bash
+# משתמש replication ושורת pg_hba ל-db_replica (docker compose --profile replica)
+set -e
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+	CREATE ROLE replicator WITH REPLICATION LOGIN PASSWORD '${REPLICATION_PASSWORD:-replicator}';
+EOSQL
+
+# "host all all all" של ה-entrypoint לא כולל חיבורי replication
+echo "host replication replicator all scram-sha-256" >> "$PGDATA/pg_hba.conf"